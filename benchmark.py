@@ -0,0 +1,397 @@
+"""
+benchmarks for the market.py and calculation.py entry points on made up order books, no network needed.
+
+    python benchmark.py                              runs the default scales and compares with the baseline
+    python benchmark.py --scales 10k,100k,2m         runs other scales, 2m is about the size of The Forge
+    python benchmark.py --save-baseline              saves the results as the new baseline
+
+The order books and histories come from a seeded random generator so every run works on the same data. A fake esi
+client serves them as raw json pages, the same way EsiClient does with raw_body_only, so the parsing gets measured too.
+A benchmark that got more than --threshold slower (or bigger) than the baseline gets flagged and the exit code is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import calculation
+import fetch
+import market
+
+
+REGIONS = [10000002, 10000043]
+STATIONS = [60003760, 60008494]
+RANGES = ['region', 'station', 'solarsystem', '1', '2', '3', '5', '10', '20', '40']
+
+PAGE_SIZE = 1000
+HISTORY_DAYS = 90
+# amount of items whose histories get fetched, main_program gets a min_sell that leaves about this many
+HISTORY_ITEMS = 300
+
+DEFAULT_SCALES = '10k,100k,500k'
+DEFAULT_BASELINE = 'benchmark baseline.json'
+
+
+def parse_scale(scale):
+    """
+    :param scale: amount of orders like 10000, 10k or 2m
+    :return: the amount as an int
+    """
+    scale = scale.strip().lower()
+    multiplier = {'k': 1000, 'm': 1000000}.get(scale[-1:], 1)
+
+    return int(float(scale.rstrip('km')) * multiplier)
+
+
+def type_count(orders):
+    """
+    :param orders: amount of orders
+    :return: amount of different items in an order book that size, Jita has about 15000 with 2 million orders
+    """
+    return int(min(15000, max(200, orders // 130)))
+
+
+def make_orders(n, types=None, seed=0):
+    """
+    makes an order book that looks like a real one: a few items have most of the orders, sell orders are above and
+    buy orders below the price of the item.
+
+    :param n: amount of orders
+    :param types: amount of different items, by default what fits the amount of orders
+    :param seed: seed of the random generator
+    :return: dataframe with the columns ESI gives for orders and the region_id of every order
+    """
+    rng = np.random.default_rng(seed)
+    types = type_count(n) if types is None else types
+
+    type_ids = np.arange(18, 18 + types)
+    popularity = 1 / np.arange(1, types + 1) ** 0.9
+    type_id = rng.choice(type_ids, size=n, p=popularity / popularity.sum())
+
+    base_price = np.exp(rng.normal(11, 2.5, types))
+    is_buy_order = rng.random(n) < 0.45
+    spread = rng.lognormal(0, 0.15, n)
+    price = base_price[type_id - 18] * np.where(is_buy_order, 0.95 / spread, 1.05 * spread)
+
+    volume_total = rng.integers(1, 10000, n)
+    issued = pd.date_range('2026-09-01', periods=1000, freq='37min').strftime('%Y-%m-%dT%H:%M:%SZ').to_numpy()
+
+    return pd.DataFrame({
+        'order_id': np.arange(5000000000, 5000000000 + n),
+        'type_id': type_id,
+        'is_buy_order': is_buy_order,
+        'price': np.round(price, 2),
+        'volume_remain': np.maximum(1, (volume_total * rng.random(n)).astype(np.int64)),
+        'volume_total': volume_total,
+        'location_id': rng.choice(STATIONS, n),
+        'duration': 90,
+        'issued': rng.choice(issued, n),
+        'min_volume': 1,
+        'range': rng.choice(RANGES, n),
+        'system_id': 30000142,
+        'region_id': rng.choice(REGIONS, n),
+    })
+
+
+def make_history(region_id, type_id, days=HISTORY_DAYS, seed=0):
+    """
+    :param region_id: region ID
+    :param type_id: item ID
+    :param days: amount of days up to yesterday
+    :param seed: seed of the random generator, every item gets its own generator so histories don't depend on order
+    :return: list of history records like ESI gives them, some days have no trades
+    """
+    rng = np.random.default_rng([seed, region_id, type_id])
+
+    today = pd.Timestamp.now(tz='UTC').normalize().tz_localize(None)
+    dates = pd.date_range(end=today - pd.Timedelta(days=1), periods=days).strftime('%Y-%m-%d')
+    traded = rng.random(days) < 0.85
+
+    average = np.exp(rng.normal(11, 2.5)) * rng.lognormal(0, 0.05, days)
+    volume = rng.lognormal(rng.normal(4, 2), 0.5, days).astype(np.int64) + 1
+
+    return [{'date': date, 'average': round(float(price), 2), 'highest': round(float(price) * 1.05, 2),
+             'lowest': round(float(price) * 0.95, 2), 'order_count': int(count // 10 + 1), 'volume': int(count)}
+            for date, price, count, trade in zip(dates, average, volume, traded) if trade]
+
+
+def _encode(records):
+    return json.dumps(records, separators=(',', ':')).encode()
+
+
+class FakeApp(object):
+    """
+    stands in for the esi app, op makes the same fetch.Operations the fetch engine uses.
+    """
+
+    class _Operations(object):
+        def __getitem__(self, name):
+            return lambda **kwargs: fetch.Operation(name, **kwargs)
+
+    def __init__(self):
+        self.op = self._Operations()
+
+
+class FakeClient(object):
+    """
+    stands in for the esi client, serves the generated orders and histories as raw json bodies like EsiClient does
+    with raw_body_only. Pages get encoded once and kept, so benchmarks measure our parsing and not the fake server.
+    """
+
+    def __init__(self, orders, page_size=PAGE_SIZE, history_days=HISTORY_DAYS, seed=0):
+        """
+        :param orders: dataframe from make_orders
+        :param page_size: orders per page, ESI uses 1000
+        :param history_days: days of history of every item
+        :param seed: seed of the histories
+        """
+        self.page_size = page_size
+        self.history_days = history_days
+        self.seed = seed
+        self.requests = 0
+
+        records = orders.drop(columns='region_id')
+        self._books = {('region', region_id): records[orders['region_id'].to_numpy() == region_id]
+                       for region_id in REGIONS}
+        for station_id in STATIONS:
+            self._books[('structure', station_id)] = records[records['location_id'].to_numpy() == station_id]
+
+        self._bodies = dict()
+
+    def head(self, operation):
+        self.requests += 1
+        book = self._book(operation)
+        pages = max(1, -(-len(book) // self.page_size))
+
+        return fetch.Response(200, {'X-Pages': str(pages)}, None, raw_body_only=True)
+
+    def request(self, operation):
+        self.requests += 1
+
+        # the names endpoint gets a list of IDs, that has to be a tuple to be part of a key
+        key = (operation.name, tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                                            for name, value in operation.params.items())))
+        if key not in self._bodies:
+            self._bodies[key] = self._body(operation)
+
+        return fetch.Response(200, {'Content-Type': 'application/json'}, self._bodies[key], raw_body_only=True)
+
+    def multi_request(self, operations):
+        return [(operation, self.request(operation)) for operation in operations]
+
+    def _book(self, operation):
+        if operation.name == 'get_markets_structures_structure_id':
+            return self._books[('structure', int(operation.params['structure_id']))]
+
+        return self._books[('region', int(operation.params['region_id']))]
+
+    def _body(self, operation):
+        params = operation.params
+
+        if operation.name in ('get_markets_region_id_orders', 'get_markets_structures_structure_id'):
+            book = self._book(operation)
+
+            if 'type_id' in params:
+                book = book[book['type_id'].to_numpy() == int(params['type_id'])]
+            else:
+                page = int(params.get('page', 1))
+                book = book.iloc[(page - 1) * self.page_size:page * self.page_size]
+
+            return book.to_json(orient='records').encode()
+
+        if operation.name == 'get_markets_region_id_history':
+            return _encode(make_history(int(params['region_id']), int(params['type_id']), self.history_days,
+                                        self.seed))
+
+        if operation.name == 'get_universe_types_type_id':
+            type_id = int(params['type_id'])
+            return _encode({'type_id': type_id, 'name': f'Item {type_id}', 'packaged_volume': (type_id % 97 + 1) / 4})
+
+        if operation.name == 'post_universe_names':
+            return _encode([{'id': int(type_id), 'name': f'Item {type_id}', 'category': 'inventory_type'}
+                            for type_id in params['ids']])
+
+        raise KeyError(f'the fake client does not know {operation.name}')
+
+
+def make_esi(orders, seed=0):
+    """
+    :param orders: amount of orders in the generated order book
+    :param seed: seed of the random generator
+    :return: fake esi client and app
+    """
+    return FakeClient(make_orders(orders, seed=seed), seed=seed), FakeApp()
+
+
+def _scan_arguments(min_sell, client, app, sell_to_region=True):
+    return (STATIONS[0], REGIONS[0], REGIONS[1], min_sell, 0, 0, 0, 0.04, 0.02, False, False, sell_to_region, 30, 7,
+            client, app)
+
+
+def make_benchmarks(orders, seed=0):
+    """
+    :param orders: amount of orders in the generated order book
+    :param seed: seed of the random generator
+    :return: list of (name, function without arguments) for every entry point
+    """
+    client, app = make_esi(orders, seed)
+    region_id = REGIONS[0]
+
+    # the inputs of the benchmarks, made the same way main_program makes them
+    region_orders = market.request_all_orders_region(region_id, client, app)
+    summary = market.summarize_orders(region_orders)
+    prices = market.find_price(region_orders, is_buy_order=False, summary=summary)
+    history_items = prices.sort_values('price', ascending=False).index[:HISTORY_ITEMS].tolist()
+    histories = market.get_histories(history_items, region_id, client, app)
+    ladder = market.build_order_ladder(region_orders, is_buy_order=False)
+    quantities = pd.Series(100.0, index=prices.index)
+
+    # leaves about HISTORY_ITEMS items for main_program, prices get lowered by the taxes first
+    min_sell = float(prices['price'].nlargest(HISTORY_ITEMS).min()) * (1 - 0.06)
+
+    return [
+        ('request_all_orders_region', lambda: market.request_all_orders_region(region_id, client, app)),
+        ('request_all_orders_station', lambda: market.request_all_orders_station(STATIONS[0], client, app)),
+        ('summarize_orders', lambda: market.summarize_orders(region_orders)),
+        ('find_price', lambda: market.find_price(region_orders, is_buy_order=False)),
+        ('find_price_summary', lambda: market.find_price(region_orders, is_buy_order=False, summary=summary)),
+        ('get_left_on_market', lambda: market.get_left_on_market(region_orders, prices.index, False)),
+        ('build_order_ladder', lambda: market.build_order_ladder(region_orders, is_buy_order=False)),
+        ('fill_price', lambda: market.fill_price(ladder, quantities)),
+        ('get_histories', lambda: market.get_histories(history_items, region_id, client, app)),
+        ('volume_filter', lambda: market.volume_filter(histories, prices.loc[history_items], 30, 7)),
+        ('get_from_region', lambda: market.get_from_region(history_items[:20], region_id, client, app)),
+        ('get_item_data', lambda: market.get_item_data(history_items, client, app)),
+        ('request_type_names', lambda: market.request_type_names(history_items, client, app)),
+        ('main_program', lambda: calculation.main_program(*_scan_arguments(min_sell, client, app))),
+        ('main_program_partial', lambda: calculation.main_program(*_scan_arguments(min_sell, client, app),
+                                                                  partial=lambda items: None)),
+        ('main_program_station', lambda: calculation.main_program(*_scan_arguments(min_sell, client, app, False))),
+        ('batch_scan', lambda: calculation.batch_scan([(STATIONS[0], REGIONS[0], REGIONS[1]),
+                                                       (STATIONS[1], REGIONS[1], REGIONS[0])],
+                                                      *_scan_arguments(min_sell, client, app)[3:])),
+    ]
+
+
+def measure(function, repeats):
+    """
+    :param function: function without arguments
+    :param repeats: amount of timed runs, the fastest one counts
+    :return: dictionary with the seconds of the fastest run and the peak memory in bytes of an extra traced run
+    """
+    # the traced run also warms up the caches of the fake client
+    tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = list()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return {'seconds': min(times), 'peak_memory': peak_memory}
+
+
+def compare(results, baseline, threshold, noise=0.005):
+    """
+    :param results: dictionary with the results of this run, like run gives them
+    :param baseline: dictionary with the results of the baseline
+    :param threshold: fraction a benchmark can get slower or bigger before it counts as a regression
+    :param noise: seconds, differences smaller than this are never regressions
+    :return: list of (benchmark, what got worse, baseline value, new value)
+    """
+    regressions = list()
+
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+
+        old = baseline[key]
+        if result['seconds'] > old['seconds'] * (1 + threshold) and result['seconds'] - old['seconds'] > noise:
+            regressions.append((key, 'seconds', old['seconds'], result['seconds']))
+        if result['peak_memory'] > old['peak_memory'] * (1 + threshold) and result['peak_memory'] > 1000000:
+            regressions.append((key, 'peak_memory', old['peak_memory'], result['peak_memory']))
+
+    return regressions
+
+
+def run(scales, repeats=3, seed=0, only=None):
+    """
+    :param scales: list of amounts of orders
+    :param repeats: amount of timed runs of every benchmark, scales of a million or more get one
+    :param seed: seed of the random generator
+    :param only: optional list of benchmark names to run
+    :return: dictionary with 'scale/benchmark': result
+    """
+    results = dict()
+
+    for scale in scales:
+        for name, function in make_benchmarks(scale, seed):
+            if only and name not in only:
+                continue
+
+            result = measure(function, repeats if scale < 1000000 else 1)
+            results[f'{scale}/{name}'] = result
+            print(f'{scale:>9} {name:<28} {result["seconds"]:>10.4f} s {result["peak_memory"] / 2 ** 20:>10.1f} MB',
+                  flush=True)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks for market.py and calculation.py')
+    parser.add_argument('--scales', default=DEFAULT_SCALES, help='amounts of orders, like 10k,100k,2m')
+    parser.add_argument('--repeats', type=int, default=3, help='timed runs of every benchmark, the fastest counts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help='comma separated names of the benchmarks to run')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='json file with the baseline results')
+    parser.add_argument('--save-baseline', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='how much slower or bigger than the baseline counts as a regression, 0.25 is 25%%')
+    arguments = parser.parse_args(argv)
+
+    scales = [parse_scale(scale) for scale in arguments.scales.split(',')]
+    only = arguments.only.split(',') if arguments.only else None
+
+    results = run(scales, arguments.repeats, arguments.seed, only)
+
+    if arguments.save_baseline:
+        with open(arguments.baseline, 'w') as baseline_file:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(),
+                       'pandas': pd.__version__, 'seed': arguments.seed, 'results': results},
+                      baseline_file, indent=2)
+        print(f'baseline saved to {arguments.baseline}')
+        return 0
+
+    if not os.path.exists(arguments.baseline):
+        print(f'no baseline in {arguments.baseline}, save one with --save-baseline')
+        return 0
+
+    with open(arguments.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    if baseline.get('seed') != arguments.seed:
+        print(f'the baseline used seed {baseline.get("seed")}, the results are not comparable')
+        return 0
+
+    regressions = compare(results, baseline['results'], arguments.threshold)
+
+    for key, measurement, old, new in regressions:
+        print(f'REGRESSION {key} {measurement}: {old:.4g} -> {new:.4g} ({new / old - 1:+.0%})')
+
+    if not regressions:
+        print(f'no regressions compared to {arguments.baseline}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
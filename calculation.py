@@ -1,14 +1,25 @@
 import numpy as np
 import pandas as pd
 
-import time
+import contextvars
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import jobs
 import market
+import metrics
+import pipeline
+import snapshot
 
 
 def main_program(sell_station, sell_region, buy_region, min_sell,
                  min_per_day_sold, min_isk_volume, min_daily_profit, broker_fee,
                  transaction_tax, buy_from_buy_orders, sell_to_buy_orders,
-                 sell_to_region, history_size, days_not_sold_per_month, esi_client, esi_app):
+                 sell_to_region, history_size, days_not_sold_per_month, esi_client, esi_app,
+                 fill_quantity=None, order_snapshots=None, history_store=None, type_catalog=None,
+                 shared=None, progress=None, partial=None, price_feed=None, order_archive=None,
+                 pull_buy_region=None):
     """
 
     Function first pulls all item data from where you want to sell your items. Then it filters all items based on some
@@ -32,88 +43,338 @@ def main_program(sell_station, sell_region, buy_region, min_sell,
     :param days_not_sold_per_month: amount of days it the item hasn't sold any in the last month
     :param esi_client: ESI client
     :param esi_app: ESI app
+    :param fill_quantity: None to price everything off the best order, 'volume_per_day' to price at the average you pay
+    when buying (or selling to buy orders) a day worth of the item, or a number to price at that amount of every item
+    :param order_snapshots: optional dictionary with a snapshot.OrderSnapshot per region ID that gets kept between
+    scans, so only the orders that changed since the last scan of the sell region have to be processed
+    :param history_store: optional historydb.HistoryStore so histories only get downloaded once a day
+    :param type_catalog: optional typecatalog.TypeCatalog so the names and volumes of items only get downloaded once
+    :param shared: optional pipeline.SharedResults, orders, histories and item data in it get used instead of fetching
+    them again. Used by batch_scan to share everything between the routes.
+    :param progress: optional function that gets called with the name of a stage, the amount of stages that are done
+    and the amount of stages every time a stage is done
+    :param partial: optional function that gets called with provisional results while the histories are still coming
+    in, dataframes like the one this returns with only the items of a batch of histories. The items in them are also
+    in the result at the end.
+    :param price_feed: optional pricefeed.PriceFeed, the best prices of the regions and items that get pulled go in it
+    so the ore prices don't have to be fetched again. The scan itself always fetches its orders with esi_client.
+    :param order_archive: optional orderarchive.OrderArchive every region that gets pulled gets added to
+    :param pull_buy_region: True to pull the whole buy region at the start, next to the sell orders. False to only get
+    the orders of the items that pass the minimum sell price, one request per item. None picks whichever takes fewer
+    requests once the sell prices are there.
     :return: returns a pandas dataframe with all items that are worthy to import.
     """
 
-    start = time.time()  # This is to keep track of how long this function takes for improving speed purposes.
-
     total_tax = broker_fee + transaction_tax
 
-    # Check if the orders need to be pulled from station or from a station.
-    if sell_to_region == True:
-        orders_sell_region = market.request_all_orders_region(sell_region, esi_client, esi_app)
-    else:
-        orders_sell_region = market.request_all_orders_station(sell_station, esi_client, esi_app)
+    if shared is None:
+        shared = pipeline.SharedResults()
 
-    prices_sell = market.find_price(orders_sell_region, is_buy_order=sell_to_buy_orders)
+    # the buy orders for the provisional results, those get calculated as soon as these are there
+    buy_orders_done = Future()
+    pending_histories = list()
+    pending_lock = threading.Lock()
 
-    # checks how the items are going to be sold to apply the proper taxes
-    if sell_to_buy_orders == True:
-        prices_sell['price'] = prices_sell['price'] - prices_sell['price'] * transaction_tax
-    else:
-        prices_sell['price'] = prices_sell['price'] - prices_sell['price'] * total_tax
+    def get_region_orders(region_id, number_of_pages=None):
+        return shared.get(('region_orders', region_id), lambda: fetch_region_orders(region_id, number_of_pages))
 
-    # Sort based on the minimum sell price
-    prices_sell = prices_sell[prices_sell['price'] >= min_sell]
+    def fetch_region_orders(region_id, number_of_pages=None):
+        """
+        :param number_of_pages: optional amount of pages of the region, if it's known already
+        :return: the orders of the region and their order book summary
+        """
+        if order_snapshots is None:
+            orders = market.request_all_orders_region(region_id, esi_client, esi_app, archive=order_archive,
+                                                      number_of_pages=number_of_pages)
+            # One grouped pass over the orders, both the prices and the remaining volumes get looked up from this.
+            summary = market.summarize_orders(orders)
+        else:
+            # setdefault so two scans of the same region at the same time end up with the same snapshot
+            region_snapshot = order_snapshots.setdefault(region_id, snapshot.OrderSnapshot(region_id))
 
-    item_list = prices_sell.index.tolist()
-    histories = market.get_histories(item_list, sell_region, esi_client, esi_app)
+            orders = market.request_all_orders_region(region_id, esi_client, esi_app, snapshot=region_snapshot,
+                                                      archive=order_archive, number_of_pages=number_of_pages)
+            # the snapshot keeps its summary up to date for just the items that changed
+            summary = region_snapshot.summary
 
-    all_volumes = market.volume_filter(histories=histories, prices=prices_sell, days_back=history_size,
-                                       tolerance=days_not_sold_per_month)
+        if price_feed is not None:
+            price_feed.publish(region_id, summary)
 
-    volumes_df = pd.DataFrame.from_dict(all_volumes, orient='index',
-                                        columns=['price', 'volume_per_day', 'sold_ISK_volume'])
+        return orders, summary
 
-    # Filter based on amount sold per day and minimum amount ISK wise
-    sold_filtered = volumes_df[volumes_df['volume_per_day'] >= min_per_day_sold]
-    isk_filtered = sold_filtered[sold_filtered['sold_ISK_volume'] >= min_isk_volume]
+    def get_sell_orders():
+        # Check if the orders need to be pulled from station or from a station.
+        if sell_to_region == True:
+            return get_region_orders(sell_region)
 
-    items_to_check = isk_filtered.index.tolist()
+        return shared.get(('station_orders', sell_station), fetch_station_orders)
 
-    # all the items from the region you're buying everything from.
-    # There're some issues pulling them  from a specific station so only region specific for now.
+    def fetch_station_orders():
+        orders = market.request_all_orders_station(sell_station, esi_client, esi_app)
+        return orders, market.summarize_orders(orders)
 
-    buy_items = market.get_from_region(items_to_check, buy_region, client=esi_client, app_esi=esi_app)
+    def get_sell_prices(sell_orders):
+        orders_sell_region, summary_sell_region = sell_orders
+        prices_sell = market.find_price(orders_sell_region, is_buy_order=sell_to_buy_orders,
+                                        summary=summary_sell_region)
 
-    cheapest_buy = market.find_price(buy_items, is_buy_order=buy_from_buy_orders)
+        # checks how the items are going to be sold to apply the proper taxes
+        if sell_to_buy_orders == True:
+            prices_sell['price'] = prices_sell['price'] - prices_sell['price'] * transaction_tax
+        else:
+            prices_sell['price'] = prices_sell['price'] - prices_sell['price'] * total_tax
 
-    prices_buy_after_tax = pd.DataFrame()
-    prices_buy_after_tax['volume_per_day'] = isk_filtered['volume_per_day']
+        # Sort based on the minimum sell price
+        return prices_sell[prices_sell['price'] >= min_sell]
 
-    if buy_from_buy_orders == True:
-        prices_buy_after_tax['price'] = cheapest_buy['price'] - cheapest_buy['price'] * broker_fee
-    else:
-        prices_buy_after_tax['price'] = cheapest_buy['price']
+    def get_buy_orders(orders):
+        buy_orders_done.set_result(orders)
+        return orders
+
+    def get_buy_candidates(prices_sell):
+        items = prices_sell.index.tolist()
+
+        if pull_buy_region is None:
+            # every item is a request of its own, a big region is hundreds of pages
+            number_of_pages = market.region_order_pages(buy_region, esi_client, esi_app)
+            if len(items) >= number_of_pages:
+                return get_buy_orders(get_region_orders(buy_region, number_of_pages))
+
+        return get_buy_orders(shared.get(('item_orders', buy_region, tuple(items)), lambda: fetch_item_orders(items)))
+
+    def fetch_item_orders(items):
+        """
+        :return: the orders of the items in the buy region and their order book summary
+        """
+        orders = market.get_from_region(items, buy_region, client=esi_client, app_esi=esi_app)
+        summary = market.summarize_orders(orders)
+
+        if price_feed is not None:
+            price_feed.publish(buy_region, summary, items)
+
+        return orders, summary
+
+    def get_sell_histories(prices_sell, sell_orders):
+        item_list = prices_sell.index.tolist()
+
+        on_batch = None
+        if partial is not None:
+            def on_batch(histories):
+                with pending_lock:
+                    pending_histories.append(histories)
+                send_provisional(prices_sell, sell_orders)
+
+            # histories that came in before the buy orders get sent as soon as those are there
+            buy_orders_done.add_done_callback(lambda future: send_provisional(prices_sell, sell_orders))
+
+        return shared.get(('histories', sell_region, tuple(item_list)),
+                          lambda: market.get_histories(item_list, sell_region, esi_client, esi_app, store=history_store,
+                                                       on_batch=on_batch))
+
+    def send_provisional(prices_sell, sell_orders):
+        # histories that come in before the buy orders are there wait for them
+        if not buy_orders_done.done():
+            return
+
+        with pending_lock:
+            if len(pending_histories) == 0:
+                return
+
+            histories = pd.concat(pending_histories)
+            pending_histories.clear()
+
+        try:
+            provisional_items(histories, prices_sell, sell_orders)
+        except jobs.Cancelled:
+            raise
+        except Exception:
+            # the provisional results are only a preview, the scan itself can still finish
+            traceback.print_exc()
+
+    def provisional_items(histories, prices_sell, sell_orders):
+        sorted_items = calculate_profits(filter_volumes(histories, prices_sell, sell_orders), buy_orders_done.result(),
+                                         sell_orders)
+        if len(sorted_items) == 0:
+            return
+
+        items = sorted_items.index.tolist()
+        if type_catalog is not None:
+            item_data = market.get_item_data(items, client=esi_client, app_esi=esi_app, catalog=type_catalog,
+                                             fields=('name',))
+        else:
+            # the volumes only come per type, those can wait for the end
+            names = market.request_type_names(items, esi_client, esi_app)
+            item_data = pd.DataFrame({'name': pd.Series(names), 'packaged_volume': np.nan}).reindex(items)
+
+        partial(name_items(sorted_items, item_data))
+
+    def filter_volumes(histories, prices_sell, sell_orders):
+        volumes_df = market.volume_filter(histories=histories, prices=prices_sell, days_back=history_size,
+                                          tolerance=days_not_sold_per_month)
+
+        # Filter based on amount sold per day and minimum amount ISK wise
+        sold_filtered = volumes_df[volumes_df['volume_per_day'] >= min_per_day_sold]
+        isk_filtered = sold_filtered[sold_filtered['sold_ISK_volume'] >= min_isk_volume].copy()
+
+        # selling to buy orders eats into the buy orders the same way buying does into the sell orders
+        if fill_quantity is not None and sell_to_buy_orders == True:
+            sell_ladder = market.build_order_ladder(sell_orders[0], is_buy_order=True)
+            sell_fill = market.fill_price(sell_ladder, fill_quantities(fill_quantity, isk_filtered))
+            isk_filtered['price'] = sell_fill['price'] - sell_fill['price'] * transaction_tax
+
+        return isk_filtered
+
+    def get_item_names(isk_filtered):
+        # the names of every item that's left, so this can run while the profits still get calculated
+        items = isk_filtered.index.tolist()
+        return shared.get(('item_data', tuple(items)),
+                          lambda: market.get_item_data(items, client=esi_client, app_esi=esi_app,
+                                                       catalog=type_catalog))
+
+    def calculate_profits(isk_filtered, buy_orders, sell_orders):
+        orders_sell_region, summary_sell_region = sell_orders
+
+        # all the items from the region you're buying everything from.
+        # There're some issues pulling them  from a specific station so only region specific for now.
+        # The buy orders get pulled before the histories are there, so they don't have to wait on them.
+        orders_buy_region, summary_buy_region = buy_orders
 
-    # create the item profit dataframe
-    item_profits = pd.DataFrame(columns=['profit per day', 'margin', 'volume_per_day', 'remaining', 'days_remaining'])
+        if fill_quantity is None:
+            # the best prices come out of the summary, the orders don't have to be grouped again
+            cheapest_buy = market.find_price(orders_buy_region, is_buy_order=buy_from_buy_orders,
+                                             summary=summary_buy_region)
+        else:
+            buy_items = orders_buy_region[orders_buy_region['type_id'].isin(isk_filtered.index)]
+            buy_ladder = market.build_order_ladder(buy_items, is_buy_order=buy_from_buy_orders)
+            cheapest_buy = market.fill_price(buy_ladder, fill_quantities(fill_quantity, isk_filtered))
 
-    item_profits['volume_per_day'] = prices_buy_after_tax['volume_per_day'].astype(int)
-    item_profits['profit per day'] = (isk_filtered['price'] - prices_buy_after_tax['price']) * isk_filtered[
-        'volume_per_day']
-    item_profits['margin'] = (
-                ((isk_filtered['price'] - prices_buy_after_tax['price']) / prices_buy_after_tax['price']) * 100)
-    item_profits['remaining'] = market.get_left_on_market(orders=orders_sell_region, items=item_profits.index.tolist(),
-                                                          is_buy_order=sell_to_buy_orders)
+        prices_buy_after_tax = pd.DataFrame()
+        prices_buy_after_tax['volume_per_day'] = isk_filtered['volume_per_day']
 
-    item_profits['days_remaining'] = np.floor(item_profits['remaining'] / isk_filtered['volume_per_day'])
+        if buy_from_buy_orders == True:
+            prices_buy_after_tax['price'] = cheapest_buy['price'] - cheapest_buy['price'] * broker_fee
+        else:
+            prices_buy_after_tax['price'] = cheapest_buy['price']
 
-    items_left = item_profits[item_profits['profit per day'] >= min_daily_profit]
+        # create the item profit dataframe
+        item_profits = pd.DataFrame(columns=['profit per day', 'margin', 'volume_per_day', 'remaining',
+                                             'days_remaining'])
 
-    sorted_items = items_left.sort_values(by='profit per day', ascending=False)
+        item_profits['volume_per_day'] = prices_buy_after_tax['volume_per_day'].astype(int)
+        item_profits['profit per day'] = (isk_filtered['price'] - prices_buy_after_tax['price']) * isk_filtered[
+            'volume_per_day']
+        item_profits['margin'] = (
+                    ((isk_filtered['price'] - prices_buy_after_tax['price']) / prices_buy_after_tax['price']) * 100)
+        item_profits['remaining'] = market.get_left_on_market(orders=orders_sell_region,
+                                                              items=item_profits.index.tolist(),
+                                                              is_buy_order=sell_to_buy_orders,
+                                                              summary=summary_sell_region)
 
-    item_list_sorted = sorted_items.index.tolist()
+        item_profits['days_remaining'] = np.floor(item_profits['remaining'] / isk_filtered['volume_per_day'])
 
-    item_data = market.get_item_data(item_list_sorted, client= esi_client, app_esi=esi_app)
+        items_left = item_profits[item_profits['profit per day'] >= min_daily_profit]
 
-    items_named = sorted_items
-    items_named['size'] = item_data['packaged_volume']
-    items_named['margin'] = items_named['margin'].astype(int)
+        return items_left.sort_values(by='profit per day', ascending=False)
 
-    items_named = items_named.rename(dict(zip(item_list_sorted, item_data['name'])))
-    items_named['profit per day'] = items_named['profit per day'].astype(int)
+    def name_items(sorted_items, item_data):
+        item_list_sorted = sorted_items.index.tolist()
+        item_data = item_data.loc[item_list_sorted]
+
+        items_named = sorted_items
+        items_named['size'] = item_data['packaged_volume']
+        items_named['margin'] = items_named['margin'].astype(int)
+
+        items_named = items_named.rename(dict(zip(item_list_sorted, item_data['name'])))
+        items_named['profit per day'] = items_named['profit per day'].astype(int)
+
+        return items_named
+
+    stages = pipeline.Pipeline()
+    stages.add('sell_orders', get_sell_orders)
+    stages.add('prices_sell', get_sell_prices, depends=['sell_orders'])
+
+    if sell_to_region == True and buy_region == sell_region:
+        # same region, the orders only have to be pulled once
+        stages.add('buy_orders', get_buy_orders, depends=['sell_orders'])
+    elif pull_buy_region == True:
+        stages.add('buy_orders', lambda: get_buy_orders(get_region_orders(buy_region)))
+    else:
+        stages.add('buy_orders', get_buy_candidates, depends=['prices_sell'])
+
+    stages.add('histories', get_sell_histories, depends=['prices_sell', 'sell_orders'])
+    stages.add('isk_filtered', filter_volumes, depends=['histories', 'prices_sell', 'sell_orders'])
+    stages.add('item_data', get_item_names, depends=['isk_filtered'])
+    stages.add('sorted_items', calculate_profits, depends=['isk_filtered', 'buy_orders', 'sell_orders'])
+
+    # the timings and counters go in the report of whoever runs this, or in one of its own
+    report = metrics.current() or metrics.ScanReport('main_program')
+
+    # how long the whole scan took is the main_program span, every route of a batch adds to it
+    with metrics.recording(report, cache=getattr(esi_client, 'cache', None)), metrics.span('main_program'):
+        results = stages.run(on_done=progress)
+
+        with metrics.span('name_lookup'):
+            items_named = name_items(results['sorted_items'], results['item_data'])
+
+        metrics.count('items_found', len(items_named))
 
-    end = time.time()
-    print(end - start)
     return items_named
+
+
+def batch_scan(routes, min_sell, min_per_day_sold, min_isk_volume, min_daily_profit, broker_fee, transaction_tax,
+               buy_from_buy_orders, sell_to_buy_orders, sell_to_region, history_size, days_not_sold_per_month,
+               esi_client, esi_app, fill_quantity=None, order_snapshots=None, history_store=None, type_catalog=None,
+               order_archive=None, pull_buy_region=None, max_routes=4):
+    """
+    runs main_program for a lot of routes at once. The orders of every region, the histories and the item data only get
+    fetched once and are shared between all the routes, so 6 routes to the same station don't cost 6 full scans.
+
+    The rest of the parameters are the same as the ones of main_program.
+
+    :param routes: list of (sell_station, sell_region, buy_region)
+    :param max_routes: maximum amount of routes that get worked on at the same time
+    :return: one dataframe with the items of every route, with the route in the 'route' column, sorted on profit per day
+    """
+    shared = pipeline.SharedResults()
+
+    def scan_route(route):
+        sell_station, sell_region, buy_region = route
+        items = main_program(sell_station, sell_region, buy_region, min_sell, min_per_day_sold, min_isk_volume,
+                             min_daily_profit, broker_fee, transaction_tax, buy_from_buy_orders, sell_to_buy_orders,
+                             sell_to_region, history_size, days_not_sold_per_month, esi_client, esi_app,
+                             fill_quantity=fill_quantity, order_snapshots=order_snapshots,
+                             history_store=history_store, type_catalog=type_catalog, order_archive=order_archive,
+                             pull_buy_region=pull_buy_region, shared=shared)
+        items.insert(0, 'route', f'{buy_region} -> {sell_region}/{sell_station}')
+        return items
+
+    # all the routes go in one report
+    report = metrics.current() or metrics.ScanReport('batch_scan')
+
+    # threads and not processes, the routes share the fetched frames and the esi client can't be pickled
+    with metrics.recording(report, cache=getattr(esi_client, 'cache', None)):
+        with ThreadPoolExecutor(max_workers=max_routes) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, scan_route, route) for route in routes]
+            route_items = [future.result() for future in futures]
+
+    if len(route_items) == 0:
+        return pd.DataFrame()
+
+    return pd.concat(route_items).sort_values(by='profit per day', ascending=False, kind='mergesort')
+
+
+def fill_quantities(fill_quantity, volumes):
+    """
+    :param fill_quantity: 'volume_per_day' or a number
+    :param volumes: dataframe with the column 'volume_per_day', indexed by type ID
+    :return: series with the amount of every item that should get priced
+    """
+    if fill_quantity == 'volume_per_day':
+        return volumes['volume_per_day']
+
+    try:
+        quantity = float(fill_quantity)
+    except (TypeError, ValueError):
+        raise TypeError(f'{fill_quantity} is not a number or volume_per_day')
+
+    return pd.Series(quantity, index=volumes.index)
@@ -1,43 +1,273 @@
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
-from scipy.optimize import linprog
+from scipy.optimize import Bounds, LinearConstraint, milp
 import numpy as np
 
 
-def compress(minerals, refine_rate, coefficients, ore_list):
+# reprocessors of the ore lists that got used, so the files only get read once
+_reprocessors = dict()
+
+
+class Reprocessor(object):
+    """
+    works out the cheapest ore to reprocess for the minerals you want. The ore yields and the shopping list get read
+    and checked once, after that every solve is a mixed integer program for HiGHS. The amounts of ore come out as whole
+    units and as cheap as possible, instead of rounding up the continuous solution.
     """
-    this function calculates the ore you need to reprocess to get the minerals you want
 
-    :param minerals: dataframe with the minerals you need
-    :param refine_rate:  reprocessing rate
-    :param coefficients: coefficients for the linear optizimation
+    def __init__(self, ore_list, shopping_list='shopping list.csv'):
+        """
+        :param ore_list: file that has all the ore with what one unit of them reprocesses into
+        :param shopping_list: file with all the minerals and the amount you want of them by default
+        """
+        self.ore_list = ore_list
+
+        self.shopping_list = pd.read_csv(shopping_list, index_col='mineral').astype(int)
+        self.ore = pd.read_csv(ore_list)
+
+        minerals = [str(mineral).strip() for mineral in self.shopping_list.index]
+        ore_minerals = [str(mineral).strip() for mineral in self.ore.columns]
+
+        if ore_minerals != minerals:
+            raise ValueError(f'the minerals of {ore_list} {ore_minerals} are not the ones in {shopping_list} {minerals}')
+
+        if len(self.ore) == 0:
+            raise ValueError(f'there is no ore in {ore_list}')
+
+        yields = self.ore.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+
+        if np.isnan(yields).any():
+            raise ValueError(f'{ore_list} has yields that are missing or not a number')
+
+        if (yields < 0).any():
+            raise ValueError(f'{ore_list} has negative yields')
+
+        # minerals x ore, the way the constraints need it
+        self.yields = yields.transpose()
+
+    def solve(self, minerals, refine_rate, coefficients, time_limit=None, gap=0.0):
+        """
+        :param minerals: dataframe with the minerals you need, minerals that aren't in it come from the shopping list
+        :param refine_rate: reprocessing rate
+        :param coefficients: price of one unit of every ore, in the same order as the ore list
+        :param time_limit: optional seconds HiGHS gets, it gives the best solution it found by then
+        :param gap: relative optimality gap HiGHS can stop at, 0 keeps going until it's sure it's the cheapest mix
+        :return: Reprocessing
+        """
+        need = self.shopping_list.copy()
+        need.update(minerals)
+        need_amounts = need['amount'].to_numpy(dtype=float)
+
+        coefficients = np.asarray(coefficients, dtype=float)
+
+        if coefficients.shape != (len(self.ore),):
+            raise ValueError(f'there are {len(self.ore)} ore in {self.ore_list} but {coefficients.size} prices')
+
+        if np.isnan(coefficients).any() or (coefficients < 0).any():
+            raise ValueError('ore prices have to be numbers that are not negative')
+
+        yields = self.yields * refine_rate
+
+        options = {'mip_rel_gap': gap}
+        if time_limit is not None:
+            options['time_limit'] = time_limit
+
+        start = time.perf_counter()
+        optimization = milp(coefficients, integrality=np.ones(len(coefficients)), bounds=Bounds(0, np.inf),
+                            constraints=LinearConstraint(yields, lb=need_amounts, ub=np.inf), options=options)
+        seconds = time.perf_counter() - start
+
+        if optimization.x is None:
+            raise ValueError(f'no ore mix gives these minerals: {optimization.message}')
+
+        amounts = np.round(optimization.x)
+
+        # HiGHS works with a tolerance, a mineral it's a fraction short of gets topped up with the cheapest ore for it
+        short = need_amounts - yields @ amounts
+        for mineral in np.flatnonzero(short > 0):
+            if short[mineral] > 0:
+                useful = np.flatnonzero(yields[mineral] > 0)
+                ore = useful[np.argmin(coefficients[useful] / yields[mineral, useful])]
+                amounts[ore] += np.ceil(short[mineral] / yields[mineral, ore])
+                short = need_amounts - yields @ amounts
+
+        return Reprocessing(self, need, yields, amounts.astype(int), coefficients, seconds, optimization)
+
+
+class Reprocessing(object):
+    """
+    result of Reprocessor.solve
+    """
+
+    def __init__(self, reprocessor, need, yields, amounts, coefficients, seconds, optimization):
+        self.amounts = amounts
+        self.cost = float(coefficients @ amounts)
+        self.seconds = seconds
+        self.success = optimization.success
+        self.message = optimization.message
+        # relative gap between the solution and the best that's possible, 0 when it's the cheapest
+        self.gap = getattr(optimization, 'mip_gap', None)
+
+        ore_need_series = pd.Series(amounts, index=reprocessor.ore.index, name='amount')
+        self.ore_need_df = ore_need_series.to_frame()
+
+        minerals_get_series = pd.Series(yields @ amounts, index=need.index)
+        self.minerals_get_df = minerals_get_series.to_frame(name='amount')
+
+        extra_series = self.minerals_get_df['amount'] - need['amount']
+        self.extra_df = extra_series.to_frame(name='amount')
+
+    def frames(self):
+        """
+        :return: the ore you need, the minerals you end up with and the extra minerals, like compress
+        """
+        return self.ore_need_df, self.minerals_get_df, self.extra_df
+
+
+def get_reprocessor(ore_list, shopping_list='shopping list.csv'):
+    """
+    :return: the Reprocessor of the ore list, it only gets made the first time
+    """
+    key = (ore_list, shopping_list)
+
+    if key not in _reprocessors:
+        _reprocessors[key] = Reprocessor(ore_list, shopping_list)
+
+    return _reprocessors[key]
+
+
+def minerals_frame(minerals):
+    """
+    :param minerals: dataframe with an amount column, series or dictionary with the amount of every mineral
+    :return: dataframe with the amount of every mineral like compress takes it
+    """
+    if isinstance(minerals, pd.DataFrame):
+        return minerals
+
+    frame = pd.Series(minerals, dtype=float).to_frame(name='amount')
+    frame.index.rename('mineral', inplace=True)
+    return frame
+
+
+def parametric_cases(minerals, refine_rates, price_scenarios):
+    """
+    :param minerals: the minerals you need, everything minerals_frame takes
+    :param refine_rates: list of reprocessing rates
+    :param price_scenarios: dataframe with the prices of every ore as columns and a scenario per row
+    :return: list with a (minerals, refine rate, prices) case for every refine rate and scenario, for sweep
+    """
+    return [(minerals, refine_rate, prices.to_numpy(dtype=float))
+            for refine_rate, (_, prices) in itertools.product(refine_rates, price_scenarios.iterrows())]
+
+
+def _solve_cases(ore_list, shopping_list, cases, time_limit, gap):
+    """
+    solves cases in one process, the reprocessor of the ore list only gets made once in every process
+
+    :param cases: list of (number of the case, minerals, refine rate, prices)
+    :return: list with a dictionary of results for every case
+    """
+    reprocessor = get_reprocessor(ore_list, shopping_list)
+    rows = list()
+
+    for number, minerals, refine_rate, coefficients in cases:
+        row = {'case': number, 'refine_rate': refine_rate}
+
+        try:
+            reprocessing = reprocessor.solve(minerals_frame(minerals), refine_rate, coefficients,
+                                             time_limit=time_limit, gap=gap)
+        except ValueError as error:
+            row.update({'success': False, 'message': str(error)})
+            rows.append(row)
+            continue
+
+        row.update({'success': reprocessing.success, 'message': reprocessing.message, 'cost': reprocessing.cost,
+                    'gap': reprocessing.gap, 'seconds': reprocessing.seconds})
+        row.update(zip(reprocessor.ore.index, reprocessing.amounts))
+        rows.append(row)
+
+    return rows
+
+
+def sweep(cases, ore_list, shopping_list='shopping list.csv', processes=None, time_limit=None, gap=0.0):
+    """
+    solves a lot of compressions at once, like every refine rate with every price scenario. The cases get spread over a
+    pool of processes that each load the ore list once, cases that are exactly the same only get solved once.
+
+    :param cases: list of (minerals, refine rate, prices) like parametric_cases makes them, the minerals can be
+    anything minerals_frame takes
     :param ore_list: file that has all the ore
-    :return: 3 data frames, ore_need_df gives the ore, mineral_get_df are the minereals you end up with, extra_df are all the extra minerals
+    :param shopping_list: file with all the minerals and the amount you want of them by default
+    :param processes: amount of processes, the amount of CPUs by default. 1 solves everything in this process
+    :param time_limit: optional seconds every solve gets
+    :param gap: relative optimality gap a solve can stop at
+    :return: dataframe with a row for every case in the same order: the refine rate, if it worked, the cost, the gap,
+    the seconds the solve took and the amount of every ore
     """
+    unique = dict()
+    case_solves = list()
 
-    shopping_list = pd.read_csv('shopping list.csv', index_col='mineral').astype(int)
+    for minerals, refine_rate, coefficients in cases:
+        minerals = minerals_frame(minerals)
+        coefficients = np.asarray(coefficients, dtype=float)
 
-    shopping_list.update(minerals)
+        key = (tuple(minerals['amount'].items()), float(refine_rate), tuple(coefficients))
+        if key not in unique:
+            unique[key] = (len(unique), minerals, float(refine_rate), coefficients)
 
-    ore = (pd.read_csv(ore_list) * refine_rate)
+        case_solves.append(unique[key][0])
 
-    # matrices are transposed and negative because linear algebra maths
-    optimization = linprog(coefficients, -ore.transpose(), -shopping_list.transpose(), options={'maxiter': 1000, 'disp': False, 'tol': 1e-6})
+    solves = list(unique.values())
 
-    if optimization.success == True:
-        print('yaaaaay optimization successfull')
-    elif optimization.success == False:
-        print(':( optimization failed')
-        print(optimization)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = max(1, min(processes, len(solves)))
 
-    ore_need_series = pd.DataFrame(optimization.x, index=ore.index, columns=['amount'])['amount'].apply(np.ceil).astype(int)
-    ore_need_df = ore_need_series.to_frame()
+    if processes == 1:
+        rows = _solve_cases(ore_list, shopping_list, solves, time_limit, gap)
+    else:
+        # a few chunks per process so a process with slow solves doesn't hold everything up
+        chunk_size = max(1, -(-len(solves) // (processes * 4)))
+        chunks = [solves[start:start + chunk_size] for start in range(0, len(solves), chunk_size)]
 
-    minerals_get = np.dot(np.transpose(ore), ore_need_series)
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_solve_cases, ore_list, shopping_list, chunk, time_limit, gap)
+                       for chunk in chunks]
+            rows = [row for future in futures for row in future.result()]
+
+    results = pd.DataFrame(rows).set_index('case').loc[case_solves]
+    results.index = pd.RangeIndex(len(case_solves), name='case')
+    return results
+
+
+def compress(minerals, refine_rate, coefficients, ore_list, price_feed=None, region_id=None, is_buy_order=False):
+    """
+    this function calculates the ore you need to reprocess to get the minerals you want
+
+    :param minerals: dataframe with the minerals you need
+    :param refine_rate:  reprocessing rate
+    :param coefficients: coefficients for the linear optizimation, None to use the ore prices of price_feed
+    :param ore_list: file that has all the ore
+    :param price_feed: optional pricefeed.PriceFeed the ore prices come from when there are no coefficients
+    :param region_id: region the ore gets bought in, for price_feed
+    :param is_buy_order: boolean, price the ore at the highest buy order instead of the lowest sell order
+    :return: 3 data frames, ore_need_df gives the ore, mineral_get_df are the minereals you end up with, extra_df are all the extra minerals
+    """
+    if coefficients is None:
+        coefficients = price_feed.ore_prices(region_id, ore_list, is_buy_order)
+
+    reprocessing = get_reprocessor(ore_list).solve(minerals, refine_rate, coefficients)
+
+    if reprocessing.success == True:
+        print(f'yaaaaay optimization successfull in {reprocessing.seconds * 1000:.1f} ms, gap {reprocessing.gap}')
+    elif reprocessing.success == False:
+        print(':( optimization failed')
+        print(reprocessing.message)
 
-    minerals_get_series = pd.Series(minerals_get, index=shopping_list.index)
-    minerals_get_df = minerals_get_series.to_frame(name='amount')
-    extra_series = minerals_get_df['amount'] - shopping_list['amount']
-    extra_df = extra_series.to_frame(name='amount')
-    print(extra_df)
+    print(reprocessing.extra_df)
 
-    return ore_need_df, minerals_get_df, extra_df
+    return reprocessing.frames()
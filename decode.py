@@ -0,0 +1,54 @@
+import json
+import re
+
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.json
+except ImportError:
+    pyarrow = None
+
+
+# splits a json array of flat objects into one object per line, order and history records have no nested objects
+_RECORD_SEPARATOR = re.compile(rb'\}\s*,\s*\{')
+
+
+def loads(raw):
+    """
+    :param raw: json body as bytes
+    :return: the decoded json, with orjson if it's installed
+    """
+    if orjson is not None:
+        return orjson.loads(raw)
+
+    return json.loads(raw)
+
+
+def decode_records(raw):
+    """
+    decodes the raw body of an ESI response with a list of flat records (orders or history) straight into a dataframe.
+    With pyarrow installed the body gets read into columns without making a Python object for every record, otherwise
+    it falls back on a fast json decode. The types get fixed by schema.apply_schema afterwards.
+
+    :param raw: json body as bytes
+    :return: dataframe with a row for every record
+    """
+    body = bytes(raw).strip()
+
+    if body in (b'', b'[]'):
+        return pd.DataFrame()
+
+    if pyarrow is not None and body.startswith(b'[{'):
+        lines = _RECORD_SEPARATOR.sub(b'}\n{', body[1:-1])
+        table = pyarrow.json.read_json(pyarrow.py_buffer(lines))
+        frame = table.to_pandas()
+    else:
+        frame = pd.DataFrame.from_records(loads(body))
+
+    return frame
@@ -0,0 +1,188 @@
+import email.utils
+import hashlib
+import pickle
+import sqlite3
+import threading
+import time
+
+from esipy.cache import BaseCache
+from requests.structures import CaseInsensitiveDict
+
+
+def _make_key(key):
+    """
+    esipy cache keys are tuples with frozensets in them, those don't pickle the same between runs so everything gets
+    sorted first.
+
+    :param key: cache key from esipy
+    :return: string to store the key under
+    """
+
+    def normalize(value):
+        if isinstance(value, (frozenset, set)):
+            return tuple(sorted((normalize(item) for item in value), key=repr))
+        if isinstance(value, (tuple, list)):
+            return tuple(normalize(item) for item in value)
+        return value
+
+    return hashlib.sha1(repr(normalize(key)).encode('utf-8')).hexdigest()
+
+
+def _seconds_left(headers):
+    """
+    :param headers: response headers
+    :return: seconds until the response expires, None if it has no Expires header
+    """
+    expires = headers.get('expires', None)
+    if expires is None:
+        return None
+
+    try:
+        return email.utils.parsedate_to_datetime(expires).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+class _TrackedHeaders(CaseInsensitiveDict):
+    """
+    headers that tell the cache when esipy changes them. esipy updates the Expires header of a cached response when
+    ESI answers with a 304, this way that new expiry also ends up on disk.
+    """
+
+    def __init__(self, headers, on_change):
+        super(_TrackedHeaders, self).__init__(headers)
+        self._on_change = on_change
+
+    def __setitem__(self, key, value):
+        super(_TrackedHeaders, self).__setitem__(key, value)
+        if getattr(self, '_on_change', None) is not None:
+            self._on_change(key)
+
+
+class DiskCache(BaseCache):
+    """
+    esipy cache that keeps the ESI responses on disk in sqlite, so a scan within the ESI cache window doesn't have to
+    download everything again, even after restarting the program.
+
+    esipy itself does the Expires and ETag handling: it serves responses that haven't expired without a request and
+    sends If-None-Match for expired ones. That's why expired responses are kept around until they get pushed out by the
+    size cap, the least recently used ones go first.
+    """
+
+    def __init__(self, path='esi cache.sqlite', max_size=512 * 1024 ** 2):
+        """
+        :param path: file the cache gets saved in
+        :param max_size: maximum size of all cached responses together in bytes
+        """
+        self.max_size = max_size
+
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        # esipy's multi_request uses a thread pool, so the connection gets shared between threads behind the lock.
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS responses '
+                                 '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self._connection.commit()
+
+        self._size = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key, default=None):
+        stored_key = _make_key(key)
+
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM responses WHERE key = ?', (stored_key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return default
+
+            self._connection.execute('UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), stored_key))
+            self._connection.commit()
+
+        value = pickle.loads(row[0])
+
+        seconds_left = _seconds_left(value.headers)
+        if seconds_left is not None and seconds_left >= 0:
+            self.hits += 1
+        else:
+            self.stale += 1
+
+        if hasattr(value, '_replace'):
+            def header_changed(header):
+                if header.lower() == 'expires':
+                    self.revalidated += 1
+                self._store(stored_key, value)
+
+            value = value._replace(headers=_TrackedHeaders(value.headers, header_changed))
+
+        return value
+
+    def set(self, key, value, expire=300):
+        self._store(_make_key(key), value)
+
+    def invalidate(self, key):
+        stored_key = _make_key(key)
+
+        with self._lock:
+            row = self._connection.execute('SELECT size FROM responses WHERE key = ?', (stored_key,)).fetchone()
+            if row is not None:
+                self._connection.execute('DELETE FROM responses WHERE key = ?', (stored_key,))
+                self._connection.commit()
+                self._size -= row[0]
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM responses')
+            self._connection.commit()
+            self._size = 0
+
+    def stats(self):
+        """
+        :return: dictionary with the hit and miss counters and how full the cache is
+        """
+        with self._lock:
+            entries = self._connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+        return {'hits': self.hits, 'stale': self.stale, 'misses': self.misses, 'revalidated': self.revalidated,
+                'evictions': self.evictions, 'entries': entries, 'size': self._size, 'max_size': self.max_size}
+
+    def _store(self, stored_key, value):
+        if hasattr(value, '_replace'):
+            # the tracked headers are only for this session, save them as normal headers again
+            value = value._replace(headers=CaseInsensitiveDict(value.headers))
+
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+
+        with self._lock:
+            row = self._connection.execute('SELECT size FROM responses WHERE key = ?', (stored_key,)).fetchone()
+            if row is not None:
+                self._size -= row[0]
+
+            self._connection.execute('REPLACE INTO responses (key, value, size, last_used) VALUES (?, ?, ?, ?)',
+                                     (stored_key, sqlite3.Binary(data), len(data), time.time()))
+            self._size += len(data)
+
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        """
+        throws out the least recently used responses until everything fits in max_size again. Needs the lock.
+        """
+        while self._size > self.max_size:
+            oldest = self._connection.execute('SELECT key, size FROM responses ORDER BY last_used LIMIT 64').fetchall()
+            if len(oldest) == 0:
+                break
+
+            for stored_key, size in oldest:
+                if self._size <= self.max_size:
+                    break
+                self._connection.execute('DELETE FROM responses WHERE key = ?', (stored_key,))
+                self._size -= size
+                self.evictions += 1
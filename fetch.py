@@ -0,0 +1,310 @@
+import asyncio
+import json
+import queue
+import threading
+
+from requests.structures import CaseInsensitiveDict
+
+try:
+    import aiohttp
+except ImportError:  # only needed when the FetchEngine gets used
+    aiohttp = None
+
+
+ESI_URL = 'https://esi.evetech.net/latest'
+
+# the ESI operations market.py uses and their paths, everything that isn't in the path goes in the query
+OPERATIONS = {
+    'get_markets_region_id_orders': '/markets/{region_id}/orders/',
+    'get_markets_structures_structure_id': '/markets/structures/{structure_id}/',
+    'get_markets_region_id_history': '/markets/{region_id}/history/',
+    'get_universe_types_type_id': '/universe/types/{type_id}/',
+    'post_universe_names': '/universe/names/',
+}
+
+# operations that get posted, with the parameter that goes in the json body
+POST_BODIES = {
+    'post_universe_names': 'ids',
+}
+
+DEFAULT_PARAMS = {
+    'get_markets_region_id_orders': {'order_type': 'all'},
+}
+
+
+# seconds to wait for the ESI error window to reset when a 420 doesn't say how long that is
+ERROR_LIMIT_WAIT = 60
+
+
+class FetchError(Exception):
+    """
+    a request that still failed after all its retries, or that ESI answered with an error. The response is on the error
+    if there was one, so the scheduler can still see the status and the headers.
+    """
+
+    def __init__(self, message, response=None):
+        super(FetchError, self).__init__(message)
+        self.response = response
+        self.status = getattr(response, 'status', None)
+
+
+class Operation(object):
+    """
+    one ESI request, made by FetchEngine.op the same way esipy's app.op makes them.
+    """
+
+    def __init__(self, name, **kwargs):
+        if name not in OPERATIONS:
+            raise KeyError(f'{name} is not an operation the fetch engine knows')
+
+        self.name = name
+        self.params = dict(DEFAULT_PARAMS.get(name, dict()))
+        self.params.update(kwargs)
+
+        path_keys = [key for key in kwargs if '{' + key + '}' in OPERATIONS[name]]
+        self.path = OPERATIONS[name].format(**{key: kwargs[key] for key in path_keys})
+
+        self.method = 'GET'
+        self.body = None
+        if name in POST_BODIES:
+            self.method = 'POST'
+            self.body = self.params.get(POST_BODIES[name])
+            path_keys.append(POST_BODIES[name])
+
+        self.query = {key: value for key, value in self.params.items() if key not in path_keys}
+
+    def __repr__(self):
+        return f'Operation({self.name}, {self.params})'
+
+
+class Response(object):
+    """
+    response with the same attributes market.py uses on esipy responses: status, header (lists of values) and data.
+    """
+
+    def __init__(self, status, headers, raw, raw_body_only=False):
+        self.status = status
+        # esipy gives numbers like X-Pages back as ints
+        self.header = CaseInsensitiveDict({key: [int(value) if value.isdigit() else value]
+                                           for key, value in headers.items()})
+        self.raw = raw
+
+        # with raw_body_only the body gets decoded later by market.response_frame, straight into a dataframe
+        self.data = None
+        if raw and not raw_body_only:
+            try:
+                self.data = json.loads(raw)
+            except ValueError:  # error pages aren't always json
+                pass
+
+
+class _Operations(object):
+    def __getitem__(self, name):
+        def make_operation(**kwargs):
+            return Operation(name, **kwargs)
+
+        return make_operation
+
+
+class FetchEngine(object):
+    """
+    asyncio fetch engine that can be used as both the client and the app for the functions in market.py.
+    Requests run on an event loop in a background thread with a limit on how many run at the same time. stream_request
+    hands over every response as soon as it lands, so the pages can get parsed while the rest is still downloading.
+    Failed requests get retried on their own instead of redoing everything.
+    """
+
+    def __init__(self, base_url=ESI_URL, concurrency=20, retries=3, timeout=30, headers=None, raw_body_only=False):
+        """
+        :param base_url: url of ESI, or of a local server standing in for it
+        :param concurrency: maximum amount of requests at the same time
+        :param retries: how many times a failed request gets tried again
+        :param timeout: seconds before a request times out
+        :param headers: extra headers for every request, like the User-Agent or an Authorization token
+        :param raw_body_only: only keep the raw body of the responses instead of decoding the json, like esipy's option
+        """
+        if aiohttp is None:
+            raise ImportError('the fetch engine needs aiohttp, install it with pip install aiohttp')
+
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = timeout
+        self.headers = dict(headers or dict())
+        self.raw_body_only = raw_body_only
+
+        self.op = _Operations()
+
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._semaphore = None
+        self._start_lock = threading.Lock()
+
+    def head(self, operation):
+        """
+        :param operation: Operation from self.op
+        :return: Response without data
+        """
+        return self._run(self._fetch(operation, method='HEAD'))
+
+    def request(self, operation):
+        """
+        :param operation: Operation from self.op
+        :return: Response
+        """
+        return self._run(self._fetch(operation))
+
+    def multi_request(self, operations):
+        """
+        :param operations: list of Operations
+        :return: list of (operation, response) in the same order as the operations, like esipy's multi_request
+        """
+        responses = [None] * len(operations)
+
+        for position, response in self.stream_request(operations):
+            responses[position] = response
+
+        return list(zip(operations, responses))
+
+    def stream_request(self, operations):
+        """
+        :param operations: list of Operations
+        :return: generator that yields (position of the operation, response) in the order the responses come in
+        """
+        operations = list(operations)
+        results = queue.Queue()
+
+        future = asyncio.run_coroutine_threadsafe(self._stream(operations, results), self._get_loop())
+
+        try:
+            for _ in range(len(operations)):
+                position, response, error = results.get()
+
+                if error is not None:
+                    raise error
+
+                yield position, response
+
+            future.result()
+        finally:
+            # an error, or a consumer that stopped early (like a cancelled job), stops the requests that are left
+            if not future.done():
+                future.cancel()
+
+    def close(self):
+        """
+        closes the http session and stops the event loop thread
+        """
+        if self._loop is None:
+            return
+
+        if self._session is not None:
+            self._run(self._session.close())
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop = None
+        self._session = None
+
+    def _get_loop(self):
+        with self._start_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+                self._thread.start()
+
+        return self._loop
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop()).result()
+
+    async def _stream(self, operations, results):
+        async def fetch_one(position, operation):
+            try:
+                response = await self._fetch(operation)
+            except Exception as error:
+                results.put((position, None, error))
+            else:
+                results.put((position, response, None))
+
+        await asyncio.gather(*[fetch_one(position, operation) for position, operation in enumerate(operations)])
+
+    async def _fetch(self, operation, method=None):
+        method = method or operation.method
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(headers=self.headers,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        url = self.base_url + operation.path
+        last_error = None
+        last_response = None
+
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(0.5 * 2 ** (attempt - 1))
+
+            try:
+                async with self._semaphore:
+                    async with self._session.request(method, url, params=operation.query,
+                                                     json=operation.body) as response:
+                        raw = await response.read()
+                        status = response.status
+                        headers = response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                last_error = error
+                continue
+
+            response = Response(status, headers, raw if method != 'HEAD' else None, raw_body_only=self.raw_body_only)
+
+            if status == 420:
+                # ESI error limited us, nothing gets through before the error window resets
+                last_error, last_response = f'HTTP {status}', response
+                await asyncio.sleep(_error_limit_reset(response))
+                continue
+
+            # server side errors are worth another try
+            if status >= 500:
+                last_error, last_response = f'HTTP {status}', response
+                continue
+
+            # the body of anything else that isn't a success is an ESI error and not what was asked for
+            if not 200 <= status < 300:
+                raise FetchError(f'{operation} failed: HTTP {status} {_error_message(response)}', response)
+
+            return response
+
+        raise FetchError(f'{operation} failed after {self.retries + 1} tries: {last_error}', last_response)
+
+
+def _error_limit_reset(response):
+    """
+    :param response: Response of a request that got error limited
+    :return: seconds until the error window resets, from X-ESI-Error-Limit-Reset
+    """
+    reset = response.header.get('X-ESI-Error-Limit-Reset', [None])[0]
+
+    if isinstance(reset, int):
+        return reset + 1
+
+    return ERROR_LIMIT_WAIT
+
+
+def _error_message(response):
+    """
+    :param response: Response with an error
+    :return: the error ESI sent, empty if it didn't send one
+    """
+    data = response.data
+    if data is None and response.raw:
+        try:
+            data = json.loads(response.raw)
+        except ValueError:
+            return ''
+
+    if isinstance(data, dict):
+        return str(data.get('error', ''))
+
+    return ''
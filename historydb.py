@@ -0,0 +1,116 @@
+import datetime
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+import schema
+
+
+HISTORY_COLUMNS = [column for column in schema.HISTORY_SCHEMA if column not in ('type_id', 'date')]
+
+
+def last_downtime(now=None):
+    """
+    ESI market history gets its new day after the daily downtime at 11:00 UTC.
+
+    :param now: optional timezone aware datetime, defaults to the current time
+    :return: timestamp in seconds of the last downtime
+    """
+    if now is None:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+    downtime = now.replace(hour=11, minute=0, second=0, microsecond=0)
+    if downtime > now:
+        downtime -= datetime.timedelta(days=1)
+
+    return downtime.timestamp()
+
+
+class HistoryStore(object):
+    """
+    keeps the market histories of every region and item in sqlite, history only gets a new row once a day so there's no
+    point in downloading the whole thing again before the next downtime.
+    """
+
+    def __init__(self, path='history.sqlite'):
+        """
+        :param path: file the histories get saved in
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        self._connection.execute('CREATE TABLE IF NOT EXISTS history '
+                                 '(region_id INTEGER, type_id INTEGER, date TEXT, average REAL, highest REAL, '
+                                 'lowest REAL, order_count INTEGER, volume INTEGER, '
+                                 'PRIMARY KEY (region_id, type_id, date))')
+        # the last time an item was fetched, an item that didn't sell today still shouldn't get fetched again
+        self._connection.execute('CREATE TABLE IF NOT EXISTS fetched '
+                                 '(region_id INTEGER, type_id INTEGER, fetched_at REAL, '
+                                 'PRIMARY KEY (region_id, type_id))')
+        self._connection.commit()
+
+    def stale_types(self, region_id, items):
+        """
+        :param region_id: region ID
+        :param items: item IDs you want the history of
+        :return: list of the item IDs that weren't fetched since the last downtime
+        """
+        type_ids = [int(item) for item in items]
+
+        with self._lock:
+            fetched = dict(self._connection.execute('SELECT type_id, fetched_at FROM fetched WHERE region_id = ?',
+                                                    (int(region_id),)).fetchall())
+
+        downtime = last_downtime()
+        return [type_id for type_id in type_ids if fetched.get(type_id, 0) < downtime]
+
+    def save(self, region_id, histories, fetched):
+        """
+        :param region_id: region ID
+        :param histories: dataframe indexed by (type_id, date) like get_histories gives them
+        :param fetched: all the item IDs that were fetched, also the ones without any history
+        """
+        rows = histories.reset_index()
+        rows['date'] = rows['date'].dt.strftime('%Y-%m-%d')
+        rows.insert(0, 'region_id', int(region_id))
+
+        columns = ['region_id', 'type_id', 'date'] + HISTORY_COLUMNS
+        values = rows[columns].astype(object).itertuples(index=False, name=None)
+
+        now = time.time()
+
+        with self._lock:
+            self._connection.executemany('REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?, ?, ?)', values)
+            self._connection.executemany('REPLACE INTO fetched VALUES (?, ?, ?)',
+                                         [(int(region_id), int(type_id), now) for type_id in fetched])
+            self._connection.commit()
+
+    def load(self, region_id, items):
+        """
+        :param region_id: region ID
+        :param items: item IDs you want the history of
+        :return: dataframe with the histories of all items, indexed by (type_id, date) in the same order as items
+        """
+        type_ids = [int(item) for item in items]
+
+        with self._lock:
+            self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (type_id INTEGER PRIMARY KEY)')
+            self._connection.execute('DELETE FROM wanted')
+            self._connection.executemany('INSERT OR IGNORE INTO wanted VALUES (?)', [(type_id,) for type_id in type_ids])
+
+            histories = pd.read_sql_query('SELECT history.type_id, date, ' + ', '.join(HISTORY_COLUMNS) +
+                                          ' FROM history JOIN wanted ON history.type_id = wanted.type_id '
+                                          'WHERE region_id = ? ORDER BY history.type_id, date',
+                                          self._connection, params=(int(region_id),))
+
+        histories = schema.apply_schema(histories, schema.HISTORY_SCHEMA)
+
+        # same order as the items, volume_filter goes through them in that order
+        order = pd.Series(range(len(type_ids)), index=type_ids)
+        order = order[~order.index.duplicated()]
+        histories['item_order'] = histories['type_id'].map(order)
+        histories = histories.sort_values(['item_order', 'date'], kind='mergesort').drop(columns='item_order')
+
+        return histories.set_index(['type_id', 'date'])
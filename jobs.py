@@ -0,0 +1,70 @@
+import contextlib
+import contextvars
+import threading
+
+
+# the cancel token of the job that's running in this thread, pipeline stages get it passed on like the scan report
+_current = contextvars.ContextVar('cancel_token', default=None)
+
+
+class Cancelled(Exception):
+    """
+    raised at the next checkpoint of a job that got cancelled
+    """
+
+
+class CancelToken(object):
+    """
+    tells a job it should stop. Nothing gets interrupted, the job stops itself at the next checkpoint, like between two
+    responses of a fetch or before a pipeline stage starts.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        self._event.set()
+
+    def check(self):
+        """
+        raises Cancelled if the job got cancelled
+        """
+        if self._event.is_set():
+            raise Cancelled()
+
+
+def current():
+    """
+    :return: the CancelToken of the job that's running, None if there is none
+    """
+    return _current.get()
+
+
+@contextlib.contextmanager
+def running(token):
+    """
+    makes token the cancel token of everything that runs inside the with block
+
+    :param token: CancelToken
+    """
+    reset = _current.set(token)
+
+    try:
+        yield token
+    finally:
+        _current.reset(reset)
+
+
+def checkpoint():
+    """
+    raises Cancelled if the job this runs in got cancelled, does nothing outside a job. The market.py fetchers call this
+    between responses, so a scan that isn't wanted anymore stops sending requests.
+    """
+    token = _current.get()
+
+    if token is not None:
+        token.check()
@@ -9,6 +9,7 @@ import pandas as pd
 from PySide2 import QtWidgets
 
 import mainwindow
+import esicache
 
 
 if __name__ == "__main__":
@@ -32,8 +33,10 @@ if __name__ == "__main__":
         code_verifier=generate_code_verifier()
     )
 
+    # ESI responses get kept on disk so scans within the ESI cache window don't download everything again.
+    # Only the raw bodies are kept, market.py decodes them straight into dataframes.
     client = EsiClient(retry_requests=True, headers={'User-Agent': "Bisnesspirate's EVEMarket app"},
-                       raw_body_only=False, security=security_app)
+                       raw_body_only=True, security=security_app, cache=esicache.DiskCache())
 
     security_app.update_token({
         'access_token': '',
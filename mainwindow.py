@@ -9,12 +9,19 @@ from PySide2.QtUiTools import QUiLoader
 
 from PySide2.QtCore import QFile
 from PySide2 import QtCore
+from PySide2 import QtWidgets
 
 
 import pandastable
 import calculation
 import compression
+import historydb
+import jobs
+import pricefeed
+import typecatalog
+import scheduler
 
+import functools
 import sys
 import traceback
 
@@ -22,8 +29,6 @@ import pandas as pd
 import numpy as np
 import re
 
-import market
-
 
 class Worker(QtCore.QRunnable):
     '''
@@ -37,11 +42,26 @@ class Worker(QtCore.QRunnable):
         self.signals = WorkerSignals()
         self.function = function
 
+        self.token = jobs.CancelToken()
+        self.started = False
+
+    def cancel(self):
+        """
+        stops the function at its next checkpoint, or before it starts if it's still waiting for a thread
+        """
+        self.token.cancel()
+
     def run(self):
+        self.started = True
+        self.signals.started.emit()
         try:
-            result = self.function(
-                *self.args, **self.kwargs
-            )
+            with jobs.running(self.token):
+                jobs.checkpoint()
+                result = self.function(
+                    *self.args, **self.kwargs
+                )
+        except jobs.Cancelled:
+            pass
         except:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
@@ -58,9 +78,119 @@ class WorkerSignals(QtCore.QObject):
     signals for a worker
     '''
 
+    started = QtCore.Signal()
     finished = QtCore.Signal()
     error = QtCore.Signal(tuple)
     result = QtCore.Signal(object)
+    # name of the stage that's done, stages done, amount of stages
+    progress = QtCore.Signal(str, int, int)
+    # part of the result that's already there
+    partial = QtCore.Signal(object)
+
+
+class PriceSignals(QtCore.QObject):
+    '''
+    signals for the price feed, it calls its subscribers from its own thread
+    '''
+
+    prices = QtCore.Signal(object)
+
+
+class JobManager(QtCore.QObject):
+    '''
+    starts the workers of the buttons. Every job has a kind, like scan or ore_prices. A job with the same kind and key
+    as the one that's still running doesn't get started again, a new job of a kind cancels the one before it, and the
+    signals of a job that got replaced don't reach the slots anymore so an old scan can't overwrite a newer one.
+    '''
+
+    # jobs that are running, jobs that are waiting for a thread
+    depth_changed = QtCore.Signal(int, int)
+
+    def __init__(self, threadpool, parent=None):
+        super(JobManager, self).__init__(parent)
+        self.threadpool = threadpool
+
+        # kind: (key, worker) of the newest job of the kind that's still running
+        self._jobs = dict()
+        self._generations = dict()
+        self._workers = list()
+
+    def start(self, kind, function, *args, key=None, slots=None, callbacks=(), **kwargs):
+        """
+        :param kind: kind of job, a new job cancels the job of the same kind that's running
+        :param function: function that runs in the worker, gets called with args and kwargs
+        :param key: anything that can be compared that says what the job calculates, None if it can't be coalesced
+        :param slots: dictionary with the name of a WorkerSignals signal and the function it gets connected to
+        :param callbacks: names of WorkerSignals signals the function gets the emit of as keyword arguments, like
+        progress so main_program can send its progress
+        :return: the worker, the one that was already running if it's the same job
+        """
+        running = self._jobs.get(kind)
+        if self.is_running(kind, key):
+            return running[1]
+
+        if running is not None:
+            running[1].cancel()
+
+        generation = self._generations.get(kind, 0) + 1
+        self._generations[kind] = generation
+
+        worker = Worker(function, *args, **kwargs)
+        for name in callbacks:
+            worker.kwargs[name] = getattr(worker.signals, name).emit
+
+        for name, slot in (slots or dict()).items():
+            getattr(worker.signals, name).connect(functools.partial(self._deliver, kind, generation, slot))
+
+        worker.signals.started.connect(self._report_depth)
+        worker.signals.finished.connect(functools.partial(self._finished, kind, worker))
+
+        self._jobs[kind] = (key, worker)
+        self._workers.append(worker)
+        self.threadpool.start(worker)
+        self._report_depth()
+
+        return worker
+
+    def is_running(self, kind, key):
+        """
+        :return: if the job of a kind that's running has this key
+        """
+        running = self._jobs.get(kind)
+        return running is not None and key is not None and running[0] == key
+
+    def cancel(self, kind):
+        """
+        cancels the job of a kind that's running, nothing it sends gets delivered anymore
+        """
+        running = self._jobs.pop(kind, None)
+
+        if running is not None:
+            running[1].cancel()
+            self._generations[kind] = self._generations.get(kind, 0) + 1
+
+    def depth(self):
+        """
+        :return: amount of jobs running and amount of jobs waiting for a thread
+        """
+        running = sum(1 for worker in self._workers if worker.started)
+        return running, len(self._workers) - running
+
+    def _deliver(self, kind, generation, slot, *args):
+        # signals of jobs that got replaced get dropped
+        if self._generations.get(kind) == generation:
+            slot(*args)
+
+    def _finished(self, kind, worker):
+        self._workers.remove(worker)
+
+        if kind in self._jobs and self._jobs[kind][1] is worker:
+            del self._jobs[kind]
+
+        self._report_depth()
+
+    def _report_depth(self):
+        self.depth_changed.emit(*self.depth())
 
 
 class Form(QtCore.QObject):
@@ -69,9 +199,23 @@ class Form(QtCore.QObject):
         super(Form, self).__init__(parent)
 
         self.threadpool = QtCore.QThreadPool()
+        self.jobs = JobManager(self.threadpool)
+        self.jobs.depth_changed.connect(self.set_job_depth)
 
         self.esi_client = esi_client
         self.esi_app = esi_app
+
+        # every request goes through the scheduler so we stay under the ESI error limit, things the user is waiting on
+        # like the ore prices go before the pages of a scan
+        self.scheduler = scheduler.RequestScheduler(esi_client)
+        self.interactive_client = self.scheduler.view(scheduler.INTERACTIVE)
+        self.bulk_client = self.scheduler.view(scheduler.BULK)
+
+        # best prices shared by the ore prices and the scans, the ore prices update by themselves once they're asked for
+        self.price_feed = pricefeed.PriceFeed(self.interactive_client, esi_app)
+        self.price_signals = PriceSignals()
+        self.price_signals.prices.connect(self.update_ore_prices)
+        self.ore_subscription = None
         self.app_info = app_info
         self.security = security
         self.scopes = scopes
@@ -159,18 +303,40 @@ class Form(QtCore.QObject):
         self.calculateCompression.clicked.connect(self.multi_compress)
 
         self.first_calc = True
+        # the scan button shows how far the scan is while it runs
+        self.show_text = self.showText.text()
+        # the title shows how many jobs there are
+        self.window_title = self.window.windowTitle()
+
+        # region orders get kept between scans so only what changed has to be processed again
+        self.order_snapshots = dict()
+        # market histories only change once a day, they get kept on disk
+        self.history_store = historydb.HistoryStore()
+        # names and volumes of items only change with patches
+        self.type_catalog = typecatalog.TypeCatalog()
 
     def get_ore_prices(self):
         ore_table = pd.read_csv('ore id.csv', index_col='name')
         region_id = self.oreBuyID.text()
-        orders = market.get_from_region(items=ore_table['type id'], region_id=region_id,
-                                        client=self.esi_client, app_esi=self.esi_app)
-        items = market.find_price(orders, is_buy_order=self.oreBuyOrders.currentText() == "True")
+        is_buy_order = self.oreBuyOrders.currentText() == "True"
+
+        items = self.price_feed.prices(region_id, ore_table['type id'], is_buy_order=is_buy_order)
+
+        # the prices keep updating when the feed gets new ones
+        if self.ore_subscription is not None:
+            self.price_feed.unsubscribe(self.ore_subscription)
+        self.ore_subscription = self.price_feed.subscribe(region_id, ore_table['type id'], is_buy_order,
+                                                          self.price_signals.prices.emit)
 
         items['price'] = items['price'] * float(self.costMultiplier.text())
 
         return items
 
+    def update_ore_prices(self, prices):
+        prices = prices.copy()
+        prices['price'] = prices['price'] * float(self.costMultiplier.text())
+        self.set_ore_prices(prices)
+
     def set_ore_prices(self, prices):
 
         update_text = [self.veldsparPrice.setText,
@@ -195,9 +361,8 @@ class Form(QtCore.QObject):
             counter += 1
 
     def multi_ore_prices(self):
-        worker = Worker(self.get_ore_prices)
-        worker.signals.result.connect(self.set_ore_prices)
-        self.threadpool.start(worker)
+        key = (self.oreBuyID.text(), self.oreBuyOrders.currentText(), self.costMultiplier.text())
+        self.jobs.start('ore_prices', self.get_ore_prices, key=key, slots={'result': self.set_ore_prices})
 
     def compress_minerals(self):
         """
@@ -250,28 +415,20 @@ class Form(QtCore.QObject):
         self.extraTable.setModel(models[2])
 
     def multi_compress(self):
-        worker = Worker(self.compress_minerals)
-        worker.signals.result.connect(self.set_mineral_models)
-        self.threadpool.start(worker)
+        self.jobs.start('compress', self.compress_minerals, slots={'result': self.set_mineral_models})
 
     def multi_calculate(self):
-
-        worker = Worker(self.calculate)
-        self.threadpool.start(worker)
+        self.jobs.start('calculate', self.calculate)
 
     def multi_login(self):
-        worker = Worker(self.login)
-        worker.signals.result.connect(self.set_url)
-        self.threadpool.start(worker)
+        self.jobs.start('login', self.login, slots={'result': self.set_url})
 
     def multi_refresh_refresh(self):
-        worker = Worker(self.refresh_refresh)
-        worker.signals.result.connect(self.set_refresh)
-        self.threadpool.start(worker)
+        self.jobs.start('refresh', self.refresh_refresh, slots={'result': self.set_refresh})
 
     def multi_sort_model(self, column):
-        worker = Worker(self.sort_model, column)
-        self.threadpool.start(worker)
+        # the model already sorts big tables in the background, and it has to be told on the GUI thread
+        self.sort_model(column)
 
     def multi_calculate_2(self):
 
@@ -290,13 +447,23 @@ class Form(QtCore.QObject):
                      bool(self.sellToRegion.currentText() == "True"),
                      int(self.historySize.text()),
                      int(self.daysNotSold.text()),
-                     self.esi_client,
+                     self.bulk_client,
                      self.esi_app]
 
-        worker = Worker(calculation.main_program, *arguments)
-        worker.signals.result.connect(self.set_model)
+        # clicking again with the same settings while the scan runs doesn't start it again, other settings replace it
+        key = tuple(arguments[:-2])
+        if self.jobs.is_running('scan', key):
+            return
 
-        self.threadpool.start(worker)
+        # the rows show up as they come in, the table starts empty
+        self.items_model = pandastable.PandasModel()
+        self.tableTest.setModel(self.items_model)
+
+        self.jobs.start('scan', calculation.main_program, *arguments, key=key,
+                        slots={'progress': self.set_progress, 'partial': self.add_items, 'result': self.set_model,
+                               'finished': self.reset_progress},
+                        callbacks=('progress', 'partial'), order_snapshots=self.order_snapshots,
+                        history_store=self.history_store, type_catalog=self.type_catalog, price_feed=self.price_feed)
 
     def set_url(self, url):
         """
@@ -308,19 +475,38 @@ class Form(QtCore.QObject):
         self.loginURL.setText(url)
 
     def set_model(self, new_items):
-        self.items_model = pandastable.PandasModel(new_items.reset_index().rename(index=str, columns={"index": "item"}))
-        self.tableTest.setModel(self.items_model)
+        # the provisional rows are already in the table, they get replaced with the final ones
+        self.add_items(new_items)
+
+    def add_items(self, new_items):
+        items = new_items.reset_index().rename(index=str, columns={"index": "item"})
+        self.items_model.append_rows(items, key=items.columns[0])
+
+    def set_progress(self, stage, done, total):
+        self.showText.setText(f'{stage} {done}/{total}')
+
+    def reset_progress(self):
+        self.showText.setText(self.show_text)
+
+    def set_job_depth(self, running, waiting):
+        if running + waiting == 0:
+            self.window.setWindowTitle(self.window_title)
+        else:
+            self.window.setWindowTitle(f'{self.window_title} ({running} running, {waiting} waiting)')
 
     def sort_model(self, column):
         """
-        sorts the pandas table based on the column.
+        sorts the pandas table based on the column, shift-click sorts on the column after the ones it's sorted on.
+        Big tables get sorted in the background by the model itself.
         """
-        self.items_model.sort(column, True)
+        add = bool(QtWidgets.QApplication.keyboardModifiers() & QtCore.Qt.ShiftModifier)
+        self.items_model.sort_columns(column, add=add)
 
     def login(self):
 
         esi_app_create = EsiApp()
         self.esi_app = esi_app_create.get_latest_swagger
+        self.price_feed.app_esi = self.esi_app
 
         self.security = EsiSecurity(
             redirect_uri=self.app_info['key']['redirect_uri'],
@@ -328,8 +514,10 @@ class Form(QtCore.QObject):
             code_verifier=generate_code_verifier()
         )
 
+        # keeps using the same response cache as the old client
         self.esi_client = EsiClient(retry_requests=True, headers={'User-Agent': "Bisnesspirate's EVEMarket app"},
-                                    raw_body_only=False, security=self.security)
+                                    raw_body_only=True, security=self.security, cache=self.esi_client.cache)
+        self.scheduler.client = self.esi_client
 
         return self.security.get_auth_uri(state='SomeRandomGeneratedState', scopes=self.scopes)
 
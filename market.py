@@ -3,7 +3,91 @@ import pandas as pd
 
 import datetime
 
+import decode
+import jobs
+import metrics
+import schema
 
+
+# the most IDs the names endpoint takes in one request
+NAMES_PER_REQUEST = 1000
+
+# histories that get handed to on_batch of get_histories at once
+HISTORY_BATCH_SIZE = 100
+
+
+def _responses(client, operations):
+    """
+    goes through the responses as they come in. Clients with stream_request (like fetch.FetchEngine) hand every
+    response over as soon as it lands, so it can get parsed while the rest is still downloading. Otherwise this waits
+    for multi_request and goes through them in order.
+
+    :param client: esi client or fetch engine
+    :param operations: list with all the requests
+    :return: generator of (position of the request in operations, response)
+    """
+    jobs.checkpoint()
+
+    if hasattr(client, 'stream_request'):
+        responses = client.stream_request(operations)
+    else:
+        responses = ((position, request[1]) for position, request in enumerate(client.multi_request(operations)))
+
+    try:
+        for position, response in responses:
+            metrics.count('requests')
+            metrics.count('bytes_received', len(getattr(response, 'raw', None) or b''))
+            # a cancelled job stops here, the requests that weren't sent yet don't get sent anymore
+            jobs.checkpoint()
+            yield position, response
+    finally:
+        if hasattr(responses, 'close'):
+            responses.close()
+
+
+def _head(client, operation):
+    """
+    :param client: esi client or fetch engine
+    :param operation: request to get the headers of
+    :return: the response without a body
+    """
+    jobs.checkpoint()
+    metrics.count('requests')
+    return client.head(operation)
+
+
+def response_frame(response, frame_schema=None):
+    """
+    :param response: response with a list of records, like a page of orders or a history
+    :param frame_schema: optional schema.ORDER_SCHEMA or schema.HISTORY_SCHEMA to apply to the records
+    :return: dataframe with a row for every record. If the client only kept the raw body (raw_body_only=True) it gets
+    decoded straight into a dataframe without making pyswagger objects first.
+    """
+    with metrics.span('parse'):
+        if getattr(response, 'data', None) is None and getattr(response, 'raw', None):
+            frame = decode.decode_records(response.raw)
+        else:
+            frame = pd.DataFrame.from_records(list(response.data))
+
+        if frame_schema is not None:
+            frame = schema.apply_schema(frame, frame_schema)
+
+    metrics.count('rows_parsed', len(frame))
+    return frame
+
+
+def response_data(response):
+    """
+    :param response: response with a single json object
+    :return: the object as a dictionary
+    """
+    if getattr(response, 'data', None) is None and getattr(response, 'raw', None):
+        return decode.loads(response.raw)
+
+    return response.data
+
+
+@metrics.timed('fetch_orders')
 def request_all_orders_station(station_id, client, app_esi):
     """
 
@@ -21,7 +105,7 @@ def request_all_orders_station(station_id, client, app_esi):
     requests_data = list()
 
     get_orders_temp = app_esi.op['get_markets_structures_structure_id'](structure_id=station_id_temp, page=1)
-    res = client.head(get_orders_temp)
+    res = _head(client, get_orders_temp)
 
     operations = list()
 
@@ -33,23 +117,27 @@ def request_all_orders_station(station_id, client, app_esi):
                 app_esi.op['get_markets_structures_structure_id'](structure_id=station_id_temp, page=page))
 
     else:
-        raise Exception("could not find anything" + res)
+        # the scheduler remembers structures that refused us, so asking again doesn't cost more ESI errors
+        raise Exception(f"could not get the orders of structure {station_id_temp}, HTTP {res.status}")
 
-    results = client.multi_request(operations)
+    for position, response in _responses(client, operations):
+        requests_data.append((position, response_frame(response, schema.ORDER_SCHEMA)))
 
-    for request in results:
-        requests_data.extend(list(request[1].data))
-
-    all_orders = pd.DataFrame.from_records(requests_data)
+    all_orders = _concat_pages([page for position, page in sorted(requests_data, key=lambda page: page[0])])
 
     return all_orders
 
 
-def request_all_orders_region(region_id, client, app_esi):
+@metrics.timed('fetch_orders')
+def request_all_orders_region(region_id, client, app_esi, snapshot=None, archive=None, number_of_pages=None):
     """
     :param region_id: region ID
     :param client: an esi
     :param app_esi: an esi app
+    :param snapshot: optional snapshot.OrderSnapshot of the region from an earlier call, only the orders that changed
+    get updated in it
+    :param archive: optional orderarchive.OrderArchive the orders get added to
+    :param number_of_pages: optional amount of pages from region_order_pages, so the header doesn't get asked again
     :return:
     """
 
@@ -60,69 +148,257 @@ def request_all_orders_region(region_id, client, app_esi):
 
     requests_data = list()
 
-    get_orders_temp = app_esi.op['get_markets_region_id_orders'](region_id=region_id_temp, page=1)
-    res = client.head(get_orders_temp)
+    if number_of_pages is None:
+        get_orders_temp = app_esi.op['get_markets_region_id_orders'](region_id=region_id_temp, page=1)
+        res = _head(client, get_orders_temp)
 
-    operations = list()
+        if res.status != 200:  # Checks if we sucesfully got the header.
+            raise Exception("could not find anything")
 
-    if res.status == 200:  # Checks if we sucesfully got the header.
         number_of_pages = res.header['X-pages'][0]
 
-        for page in range(1, number_of_pages + 1):
-            operations.append(app_esi.op['get_markets_region_id_orders'](region_id=region_id_temp, page=page))
+    operations = list()
 
-    else:
-        raise Exception("could not find anything")
+    for page in range(1, number_of_pages + 1):
+        operations.append(app_esi.op['get_markets_region_id_orders'](region_id=region_id_temp, page=page))
+
+    if snapshot is not None:
+        pages = dict()
+        for position, response in _responses(client, operations):
+            pages[position + 1] = response
+
+        snapshot.update(pages)
+        all_orders = snapshot.frame()
+        _frame_memory(all_orders, schema.ORDER_SCHEMA)
+
+        if archive is not None:
+            archive.append(region_id_temp, all_orders)
+
+        return all_orders
 
-    results = client.multi_request(operations)
+    # every page gets parsed as soon as it comes in, in the order of the pages in the end
+    for position, response in _responses(client, operations):
+        requests_data.append((position, response_frame(response, schema.ORDER_SCHEMA)))
 
-    for request in results:
-        requests_data.extend(list(request[1].data))
+    all_orders = _concat_pages([page for position, page in sorted(requests_data, key=lambda page: page[0])])
 
-    all_orders = pd.DataFrame.from_records(requests_data)
+    if archive is not None:
+        archive.append(region_id_temp, all_orders)
 
     return all_orders
 
 
-def find_price(orders, is_buy_order=False):
+def region_order_pages(region_id, client, app_esi):
+    """
+    :param region_id: region ID
+    :param client: esi client
+    :param app_esi: esi app
+    :return: amount of pages of orders the region has, the amount of requests request_all_orders_region sends
+    """
+    res = _head(client, app_esi.op['get_markets_region_id_orders'](region_id=int(region_id), page=1))
+
+    if res.status != 200:
+        raise Exception(f"could not get the orders of region {region_id}, HTTP {res.status}")
+
+    return res.header['X-pages'][0]
+
+
+def _concat_pages(pages):
+    """
+    :param pages: list of dataframes with the orders of every page
+    :return: one dataframe with all the orders
+    """
+    pages = [page for page in pages if len(page) > 0]
+
+    if len(pages) == 0:
+        return schema.apply_schema(pd.DataFrame(columns=list(schema.ORDER_SCHEMA)), schema.ORDER_SCHEMA)
+
+    return _frame_memory(pd.concat(pages, ignore_index=True), schema.ORDER_SCHEMA)
+
+
+def _frame_memory(frame, frame_schema):
+    """
+    adds what a frame that got fetched takes up to the scan report, once for all its pages so a dtype that got bigger
+    shows up without slowing down the parsing.
+
+    :param frame: dataframe with all the orders or histories of a fetch
+    :param frame_schema: schema.ORDER_SCHEMA or schema.HISTORY_SCHEMA
+    :return: the frame
+    """
+    metrics.frame_memory(schema.schema_name(frame_schema), frame, schema.memory_report)
+    return frame
+
+
+@metrics.timed('aggregate')
+def summarize_orders(orders):
+    """
+    builds an order book summary in one grouped pass over the orders, so prices and remaining volumes can be looked up
+    per item instead of filtering the whole order frame for every item.
+
+    :param orders: pandas dataframe with columns: 'type_id', 'is_buy_order', 'price' and optionally 'volume_remain'
+    :return: dataframe indexed by (type_id, is_buy_order) with the columns 'best_price', 'order_count' and
+    'volume_remain'. best_price is the highest price for buy orders and the lowest price for sell orders.
+    """
+    if 'volume_remain' in orders.columns:
+        volumes = orders['volume_remain']
+    else:
+        volumes = pd.Series(0, index=orders.index)
+
+    grouped = orders.assign(volume_remain=volumes).groupby(['type_id', 'is_buy_order'], sort=False)
+
+    summary = grouped.agg(lowest_price=('price', 'min'), highest_price=('price', 'max'),
+                          order_count=('price', 'size'), volume_remain=('volume_remain', 'sum'))
+
+    is_buy_side = summary.index.get_level_values('is_buy_order').to_numpy(dtype=bool)
+    summary['best_price'] = np.where(is_buy_side, summary['highest_price'], summary['lowest_price'])
+
+    return summary[['best_price', 'order_count', 'volume_remain']]
+
+
+def _summary_side(summary, is_buy_order):
+    """
+    :param summary: order book summary from summarize_orders
+    :param is_buy_order: boolean
+    :return: the part of the summary for one side of the market, indexed by type_id
+    """
+    side = summary.index.get_level_values('is_buy_order') == is_buy_order
+    return summary[side].droplevel('is_buy_order')
+
+
+@metrics.timed('aggregate')
+def find_price(orders, is_buy_order=False, summary=None):
     """
     :param orders:  pandas dataframe with columns: 'type_id', 'is_buy_order', 'price'
     :param is_buy_order: boolean
+    :param summary: optional order book summary of the orders from summarize_orders, so it doesn't get built again
     :return: dataframe with all the prices
     """
     if type(is_buy_order) is not bool:
         raise TypeError('is_buy_order has to be a boolean')
 
-    unique_orders = orders['type_id'].unique()
+    if summary is None:
+        summary = summarize_orders(orders)
 
-    price_dict = dict()
+    # every item in the orders gets a price, items without orders on this side end up as NaN like they used to.
+    unique_orders = summary.index.get_level_values('type_id').unique()
+    prices = _summary_side(summary, is_buy_order)['best_price'].reindex(unique_orders)
 
-    for type_id in unique_orders:
-        current_items = orders
-        current_items = current_items[current_items['is_buy_order'] == is_buy_order]
-        current_items = current_items[current_items['type_id'] == type_id]
+    return pd.DataFrame({'price': prices.to_numpy(dtype=float)}, index=schema.type_id_index(unique_orders))
 
-        if is_buy_order == True:
-            price = current_items['price'].max()
-        else:
-            price = current_items['price'].min()
 
-        price_dict[str(type_id)] = [price]
+@metrics.timed('aggregate')
+def build_order_ladder(orders, is_buy_order):
+    """
+    sorts one side of the orders into a ladder per item in the order they would get filled, buy orders from the
+    highest price down and sell orders from the lowest price up. The running volume and cost are over the whole ladder,
+    fill_price uses the start of every item to get the running values for just that item.
+
+    :param orders: pandas dataframe with columns: 'type_id', 'is_buy_order', 'price', 'volume_remain'
+    :param is_buy_order: boolean
+    :return: dataframe with columns: 'type_id', 'price', 'volume_remain', 'cumulative_volume', 'cumulative_cost'
+    """
+    if type(is_buy_order) is not bool:
+        raise TypeError('is_buy_order has to be a boolean')
+
+    side = orders[orders['is_buy_order'] == is_buy_order]
+    ladder = side.sort_values(['type_id', 'price'], ascending=[True, not is_buy_order], kind='mergesort')
+    ladder = ladder[['type_id', 'price', 'volume_remain']].reset_index(drop=True)
+
+    ladder['cumulative_volume'] = ladder['volume_remain'].astype(float).cumsum()
+    ladder['cumulative_cost'] = (ladder['price'] * ladder['volume_remain']).cumsum()
+
+    return ladder
+
+
+@metrics.timed('aggregate')
+def fill_price(ladder, quantities):
+    """
+    calculates the average price you pay (or get) when you fill a given amount of every item from the ladder, instead
+    of just taking the best order. If there isn't enough on the market it fills what there is.
+
+    :param ladder: order ladder from build_order_ladder
+    :param quantities: pandas series with the amount you want to fill, indexed by type ID
+    :return: dataframe with the average 'price' and the amount that could be 'filled', indexed by type ID
+    """
+    type_ids = ladder['type_id'].to_numpy()
+    prices = ladder['price'].to_numpy(dtype=float)
+    cumulative_volume = ladder['cumulative_volume'].to_numpy(dtype=float)
+    cumulative_cost = ladder['cumulative_cost'].to_numpy(dtype=float)
+
+    # the ladder is sorted on type_id so every item is one block of rows
+    ladder_types, starts = np.unique(type_ids, return_index=True)
+    ends = np.append(starts[1:], len(type_ids))
+
+    wanted = np.array([int(type_id) for type_id in quantities.index], dtype=np.int64)
+    amounts = np.clip(quantities.to_numpy(dtype=float), 0, None)
+
+    position = np.zeros(len(wanted), dtype=np.int64)
+    found = np.zeros(len(wanted), dtype=bool)
 
-    return pd.DataFrame.from_dict(price_dict, orient='index', columns=['price'])
+    if len(ladder_types) > 0:
+        position = np.clip(np.searchsorted(ladder_types, wanted), 0, len(ladder_types) - 1)
+        found = ladder_types[position] == wanted
 
+    average = np.full(len(wanted), np.nan)
+    filled = np.zeros(len(wanted))
 
-def get_histories(items, region_id, client, app_esi):
+    if found.any():
+        start = starts[position[found]]
+        end = ends[position[found]]
+
+        base_volume = np.where(start > 0, cumulative_volume[start - 1], 0)
+        base_cost = np.where(start > 0, cumulative_cost[start - 1], 0)
+
+        depth = cumulative_volume[end - 1] - base_volume
+        filled_found = np.minimum(amounts[found], depth)
+        target = base_volume + filled_found
+
+        # the last order you need to (partially) fill for every item
+        last = np.clip(np.searchsorted(cumulative_volume, target, side='left'), start, end - 1)
+        previous_volume = np.where(last > 0, cumulative_volume[last - 1], 0)
+        previous_cost = np.where(last > 0, cumulative_cost[last - 1], 0)
+
+        cost = previous_cost - base_cost + (target - previous_volume) * prices[last]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # filling nothing is the same as the best order
+            average[found] = np.where(filled_found > 0, cost / filled_found, prices[start])
+        filled[found] = filled_found
+
+    return pd.DataFrame({'price': average, 'filled': filled}, index=schema.type_id_index(wanted))
+
+
+@metrics.timed('fetch_histories')
+def get_histories(items, region_id, client, app_esi, store=None, on_batch=None, batch_size=HISTORY_BATCH_SIZE):
     """
 
     :param items: item IDs you want to cehck
     :param region_id: region ID
     :param client: esi client
     :param app_esi: esi app
-    :return: dictionary with the histories
+    :param store: optional historydb.HistoryStore, only the items that weren't fetched since the last downtime get
+    downloaded and the rest comes out of the store
+    :param on_batch: optional function that gets called with the histories of batch_size items at a time as soon as
+    they're there, like the complete dataframe. The histories from the store come first in one go.
+    :param batch_size: amount of items per on_batch call
+    :return: dataframe with the histories of all items, indexed by (type_id, date)
     """
+    items = list(items)
+
+    if store is not None:
+        stale_items = store.stale_types(region_id, items)
 
-    histories = list()
+        if on_batch is not None:
+            stale = set(stale_items)
+            stored_items = [item for item in items if int(item) not in stale]
+            if len(stored_items) > 0:
+                on_batch(store.load(region_id, stored_items))
+
+        if len(stale_items) > 0:
+            store.save(region_id, get_histories(stale_items, region_id, client, app_esi, on_batch=on_batch,
+                                                batch_size=batch_size), fetched=stale_items)
+
+        return store.load(region_id, items)
 
     operations = list()
 
@@ -138,16 +414,51 @@ def get_histories(items, region_id, client, app_esi):
 
         counter += 1
 
-    results = client.multi_request(operations)
+    histories = [None] * len(operations)
+    batch = list()
 
-    for request in results:
-        history_frame_temp = pd.DataFrame.from_records(list(request[1].data))
+    for position, response in _responses(client, operations):
+        history_frame_temp = response_frame(response, schema.HISTORY_SCHEMA)
         # print(history_frame_temp)
-        histories.append(history_frame_temp)
+        histories[position] = history_frame_temp
+
+        if on_batch is not None:
+            batch.append(position)
+
+            if len(batch) >= batch_size:
+                on_batch(history_frame({items[position]: histories[position] for position in batch}))
+                batch = list()
+
+    if on_batch is not None and len(batch) > 0:
+        on_batch(history_frame({items[position]: histories[position] for position in batch}))
 
-    return dict(zip(items, histories))
+    return _frame_memory(history_frame(dict(zip(items, histories))), schema.HISTORY_SCHEMA)
 
 
+@metrics.timed('aggregate')
+def history_frame(histories):
+    """
+    puts the histories of all items in one long dataframe, so they can be filtered with grouped operations instead of
+    going through them one by one.
+
+    :param histories: dictionary with the type IDs as keys and their history dataframes as values
+    :return: dataframe with all the histories, indexed by (type_id, date) with the dates as datetime64
+    """
+    frames = list()
+
+    for key in histories:
+        if len(histories[key]) > 0:
+            frames.append(histories[key].assign(type_id=int(key)))
+
+    if len(frames) == 0:
+        frame = pd.DataFrame(columns=list(schema.HISTORY_SCHEMA))
+    else:
+        frame = pd.concat(frames, ignore_index=True)
+
+    return schema.apply_schema(frame, schema.HISTORY_SCHEMA).set_index(['type_id', 'date'])
+
+
+@metrics.timed('fetch_orders')
 def get_from_region(items, region_id, client, app_esi):
     """
 
@@ -174,23 +485,47 @@ def get_from_region(items, region_id, client, app_esi):
         operations.append(app_esi.op['get_markets_region_id_orders'](region_id=region_id, type_id=item_id))
         count += 1
 
-    results = client.multi_request(operations)
-
-    for request in results:
-        item_list.extend(list(request[1].data))
+    for position, response in _responses(client, operations):
+        item_list.append((position, response_frame(response, schema.ORDER_SCHEMA)))
 
-    return pd.DataFrame.from_records(item_list)
+    return _concat_pages([orders for position, orders in sorted(item_list, key=lambda orders: orders[0])])
 
 
-def get_item_data(items, client, app_esi):
+@metrics.timed('name_lookup')
+def get_item_data(items, client, app_esi, catalog=None, fields=('name', 'packaged_volume')):
     """
     :param items: all the item IDs you want to check
     :param client: esi CLIENT
     :param app_esi:
+    :param catalog: optional typecatalog.TypeCatalog, only types that aren't in it yet get downloaded. Names get
+    resolved in bulk, only the fields the names endpoint doesn't have get fetched per type.
+    :param fields: the fields that are needed, only used with a catalog. Without packaged_volume only names get fetched.
     :return: returns a data frame with all the item names
     """
+    if catalog is None:
+        return request_types(items, client, app_esi)
+
+    if 'packaged_volume' in fields:
+        # the names come with the type data, so these don't need the names endpoint
+        missing_details = catalog.missing_details(items)
+        if len(missing_details) > 0:
+            catalog.save_types(request_types(missing_details, client, app_esi))
+
+    missing_names = catalog.missing_names(items)
+    if len(missing_names) > 0:
+        catalog.save_names(request_type_names(missing_names, client, app_esi))
+
+    return catalog.frame(items)
+
+
+def request_types(items, client, app_esi):
+    """
+    :param items: all the item IDs you want to check
+    :param client: esi CLIENT
+    :param app_esi:
+    :return: returns a data frame with everything ESI knows about the items, indexed by type_id
+    """
     count = 0
-    list_item_data = list()
 
     operations = list()
 
@@ -203,71 +538,109 @@ def get_item_data(items, client, app_esi):
         operations.append(app_esi.op['get_universe_types_type_id'](type_id=item_id))
         count += 1
 
-    results = client.multi_request(operations)
+    list_item_data = [None] * len(operations)
 
-    for request in results:
-        list_item_data.append(request[1].data)
+    for position, response in _responses(client, operations):
+        list_item_data[position] = response_data(response)
 
     frame = pd.DataFrame.from_records(list_item_data)  # .set_index('type_id')
-    frame['type_id'] = frame['type_id'].astype(str)
-    return frame.set_index('type_id')
+    frame.index = pd.Index(frame.pop('type_id').to_numpy(), dtype=schema.TYPE_ID, name='type_id')
+    return frame
 
 
+def request_type_names(items, client, app_esi):
+    """
+    :param items: item IDs
+    :param client: esi client
+    :param app_esi: esi app
+    :return: dictionary with type_id: name, 1000 types per request instead of a request for every type
+    """
+    type_ids = [int(item) for item in items]
+
+    operations = [app_esi.op['post_universe_names'](ids=type_ids[start:start + NAMES_PER_REQUEST])
+                  for start in range(0, len(type_ids), NAMES_PER_REQUEST)]
+
+    names = dict()
+
+    for position, response in _responses(client, operations):
+        if response.status != 200:
+            raise ValueError(f'ESI could not resolve the names, HTTP {response.status}')
+
+        for record in response_data(response):
+            names[int(record['id'])] = record['name']
+
+    return names
+
+
+@metrics.timed('filter')
 def volume_filter(histories, prices, days_back, tolerance):
     """
     filters the histories of the items given based on how much of them gets sold in a given period.
-    :param histories: histories of all the items you're checking
+    :param histories: histories of all the items you're checking, either from get_histories or a dictionary with a
+    history dataframe per item
     :param prices: dataframe with all the items and their price
     :param days_back: amount of days you look into the past
     :param tolerance: how many days in the period you look into are allowed to have no data.
-    :return: returns a new dataframe that's filtered
+    :return: returns a new dataframe that's filtered with the columns 'price', 'volume_per_day', 'sold_ISK_volume'
     """
 
-    # Can probably do this more efficiently by using pandas shit
+    if isinstance(histories, dict):
+        histories = history_frame(histories)
 
-    seconds_day = datetime.timedelta(days=1).total_seconds()
-    all_volumes = dict()
+    today = pd.Timestamp(datetime.date.today())
 
-    today = datetime.date.today()
-    time_delta_history = datetime.timedelta(days=days_back + tolerance).total_seconds()
+    grouped = histories.groupby(level='type_id', sort=False)
+    history_sizes = grouped.size()
 
-    for key in histories:
-        if len(histories[key]) > days_back:
-            date_delta = np.abs(histories[key].loc[len(histories[key]) - days_back]['date'].v - today)
-            date_seconds_delta = date_delta.total_seconds()
+    # counts the rows from the end of every history, so the last days_back rows of every item can be picked at once
+    rows_from_end = grouped.cumcount(ascending=False).to_numpy()
+    dates = histories.index.get_level_values('date')
+    type_ids = histories.index.get_level_values('type_id')
+
+    last_rows = rows_from_end < days_back
+    volume_sold = histories['volume'][last_rows].groupby(level='type_id', sort=False).sum()
+
+    # the first day of the period for every item
+    first_rows = rows_from_end == days_back - 1
+    first_dates = pd.Series(dates[first_rows], index=type_ids[first_rows])
+    days_delta = (today - first_dates).abs() / datetime.timedelta(days=1)
 
-            if time_delta_history >= date_seconds_delta:
-                item_price_temp = prices.loc[key]['price']
-                # work on picking the correct number for this
-                sold_mean_temp = histories[key].tail(days_back)['volume'].sum() / (date_seconds_delta / seconds_day)
-                all_volumes[key] = [item_price_temp, sold_mean_temp, item_price_temp * sold_mean_temp]
+    long_enough = history_sizes.index[history_sizes > days_back]
+    days_delta = days_delta.reindex(long_enough)
+    days_delta = days_delta[days_delta <= days_back + tolerance]
 
-    return all_volumes
+    item_keys = schema.type_id_index(days_delta.index)
+    item_prices = prices.loc[item_keys, 'price'].to_numpy()
+    # work on picking the correct number for this
+    sold_mean = volume_sold.reindex(days_delta.index).to_numpy() / days_delta.to_numpy()
 
+    return pd.DataFrame({'price': item_prices, 'volume_per_day': sold_mean, 'sold_ISK_volume': item_prices * sold_mean},
+                        index=item_keys)
 
-def get_left_on_market(orders, items, is_buy_order):
+
+@metrics.timed('filter')
+def get_left_on_market(orders, items, is_buy_order, summary=None):
     """
     find out how many of an item is left on the market, either for buy orders or for sell orders.
 
     :param orders:  dataframe with all the orders you're sifting through
     :param items: item IDs of all the items you want to check
     :param is_buy_order:  boolean
+    :param summary: optional order book summary of the orders from summarize_orders, so it doesn't get built again
     :return: dataframe with what is left on the market
     """
-    left_on_market = dict()
+    item_ids = list()
 
-    for item in items:
+    for count, item in enumerate(items):
         try:
-            item_id = int(item)
+            item_ids.append(int(item))
         except:
             raise TypeError(f'item {count} could not be interpreted as an int of a type ID')
 
-        new_orders = orders[orders['type_id'] == item_id]
-        new_orders = new_orders[new_orders['is_buy_order'] == is_buy_order]
-
-        volume_left = new_orders['volume_remain'].sum()
+    if summary is None:
+        summary = summarize_orders(orders)
 
-        left_on_market[str(item_id)] = volume_left
+    volume_left = _summary_side(summary, is_buy_order)['volume_remain'].reindex(item_ids, fill_value=0)
 
-    left_on_market = pd.Series(left_on_market)
+    left_on_market = pd.Series(volume_left.to_numpy(), index=schema.type_id_index(item_ids))
     return left_on_market
@@ -0,0 +1,397 @@
+import contextlib
+import contextvars
+import cProfile
+import functools
+import http.server
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import warnings
+
+try:
+    import resource
+except ImportError:  # not on windows, peak memory then only comes from tracemalloc
+    resource = None
+
+
+# since Python 3.12 a cProfile profiler sees every thread, and only one can be enabled at a time
+PROFILE_ALL_THREADS = sys.version_info >= (3, 12)
+
+# the report of the scan that's running in this thread, pipeline stages and batch routes get it passed on
+_current = contextvars.ContextVar('scan_report', default=None)
+# the spans that are running in this thread, a span inside a span with the same name doesn't get counted twice
+_active_spans = contextvars.ContextVar('active_spans', default=frozenset())
+
+
+class ScanReport(object):
+    """
+    timings and counters of a scan. The market.py and calculation.py functions add to the report of the scan they're
+    running in through span and count, so a slow scan can be pinned down on the network, the parsing or pandas.
+
+    Spans of the same name get added up, also when they run at the same time in different threads, so the total of
+    the fetch spans can be more than the time the scan took.
+    """
+
+    def __init__(self, name='scan', profile=False, trace_memory=False):
+        """
+        :param name: name of the report
+        :param profile: profile the scan with cProfile, the stats end up in self.profile_stats. Since Python 3.12 one
+        profiler covers the whole scan, before that every pipeline stage gets its own because a profiler only sees its
+        own thread. The time of every stage is in the stage spans.
+        :param trace_memory: trace the memory of the scan with tracemalloc, slows the scan down
+        """
+        self.name = name
+        self.profile = profile
+        self.trace_memory = trace_memory
+
+        self.started = None
+        self.finished = None
+        # name: [times it ran, total seconds]
+        self.spans = dict()
+        self.counters = dict()
+        # kind of frame: {column: bytes of all the frames of that kind that got parsed}
+        self.frame_memory = dict()
+        self.peak_memory = None
+        self.profile_stats = None
+
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._cache = None
+        self._cache_start = None
+        self._traced = False
+        self._profiler = None
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            span = self.spans.setdefault(name, [0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_memory(self, name, sizes):
+        """
+        :param name: kind of frame, like orders or history
+        :param sizes: dictionary or series with the bytes per column of a frame, gets added to the other frames of the
+        same kind
+        """
+        with self._lock:
+            columns = self.frame_memory.setdefault(name, dict())
+            for column, size in sizes.items():
+                columns[str(column)] = columns.get(str(column), 0) + int(size)
+
+    def add_profile(self, profiler):
+        """
+        :param profiler: cProfile.Profile of a stage, gets added to the stats of the whole scan
+        """
+        with self._lock:
+            if self.profile_stats is None:
+                self.profile_stats = pstats.Stats(profiler)
+            else:
+                self.profile_stats.add(profiler)
+
+    def elapsed(self):
+        """
+        :return: seconds the scan took, or is taking so far
+        """
+        if self.started is None:
+            return 0.0
+
+        return (self.finished or time.time()) - self.started
+
+    def profile_text(self, lines=30):
+        """
+        :param lines: amount of functions
+        :return: the functions that took the most time, as text
+        """
+        if self.profile_stats is None:
+            return ''
+
+        text = io.StringIO()
+        self.profile_stats.stream = text
+        self.profile_stats.sort_stats('cumulative').print_stats(lines)
+        return text.getvalue()
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'started': self.started,
+                'seconds': self.elapsed(),
+                'spans': {name: {'count': count, 'seconds': seconds} for name, (count, seconds) in self.spans.items()},
+                'counters': dict(self.counters),
+                'frame_memory': {name: dict(columns) for name, columns in self.frame_memory.items()},
+                'peak_memory': self.peak_memory,
+            }
+
+    def to_json(self, path=None):
+        """
+        :param path: optional file to write the report to
+        :return: the report as json
+        """
+        text = json.dumps(self.to_dict(), indent=2)
+
+        if path is not None:
+            with open(path, 'w') as report_file:
+                report_file.write(text)
+
+        return text
+
+    def prometheus(self, prefix='evemarket'):
+        """
+        :param prefix: prefix of all the metric names
+        :return: the report in the Prometheus text format
+        """
+        report = self.to_dict()
+        lines = [f'# TYPE {prefix}_scan_seconds gauge', f'{prefix}_scan_seconds {report["seconds"]}']
+
+        if report['started'] is not None:
+            lines += [f'# TYPE {prefix}_scan_started gauge', f'{prefix}_scan_started {report["started"]}']
+
+        # spans and counters only go up during a scan, they start over with the report of the next scan
+        if report['spans']:
+            lines.append(f'# TYPE {prefix}_span_seconds_total counter')
+            lines += [f'{prefix}_span_seconds_total{{span="{name}"}} {span["seconds"]}'
+                      for name, span in report['spans'].items()]
+            lines.append(f'# TYPE {prefix}_span_count_total counter')
+            lines += [f'{prefix}_span_count_total{{span="{name}"}} {span["count"]}'
+                      for name, span in report['spans'].items()]
+
+        for name, value in report['counters'].items():
+            lines += [f'# TYPE {prefix}_{name}_total counter', f'{prefix}_{name}_total {value}']
+
+        if report['frame_memory']:
+            lines.append(f'# TYPE {prefix}_frame_bytes gauge')
+            lines += [f'{prefix}_frame_bytes{{frame="{name}",column="{column}"}} {size}'
+                      for name, columns in report['frame_memory'].items() for column, size in columns.items()]
+
+        if report['peak_memory'] is not None:
+            lines += [f'# TYPE {prefix}_peak_memory_bytes gauge', f'{prefix}_peak_memory_bytes {report["peak_memory"]}']
+
+        return '\n'.join(lines) + '\n'
+
+    def _start(self, cache):
+        with self._lock:
+            self._depth += 1
+            if self._depth > 1:
+                return
+
+        self.started = time.time()
+        self.finished = None
+
+        if cache is not None and hasattr(cache, 'stats'):
+            self._cache = cache
+            self._cache_start = cache.stats()
+
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._traced = True
+
+        if self._traced:
+            tracemalloc.reset_peak()
+
+        if self.profile and PROFILE_ALL_THREADS:
+            self._profiler = _enable_profiler()
+
+    def _finish(self):
+        with self._lock:
+            self._depth -= 1
+            if self._depth > 0:
+                return
+
+        self.finished = time.time()
+
+        if self._profiler is not None:
+            self._profiler.disable()
+            self.add_profile(self._profiler)
+            self._profiler = None
+
+        if self._cache is not None:
+            cache_end = self._cache.stats()
+            for name in ('hits', 'stale', 'misses', 'revalidated', 'evictions'):
+                if name in cache_end:
+                    self.count('cache_' + name, cache_end[name] - self._cache_start.get(name, 0))
+            self._cache = None
+
+        if self._traced:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self._traced = False
+        elif resource is not None:
+            # peak of the whole process, in kilobytes on linux
+            self.peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current():
+    """
+    :return: the ScanReport of the scan that's running, None if there is none
+    """
+    return _current.get()
+
+
+@contextlib.contextmanager
+def recording(report, cache=None):
+    """
+    makes report the report of everything that runs inside the with block. Recording a report that's already
+    recording (like main_program inside batch_scan) just adds to it.
+
+    :param report: ScanReport
+    :param cache: optional esicache.DiskCache, the hits and misses during the scan get counted
+    """
+    token = _current.set(report)
+    report._start(cache)
+
+    try:
+        yield report
+    finally:
+        report._finish()
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def span(name):
+    """
+    times the with block as a span of the current report, does nothing if there isn't one.
+
+    :param name: name of the span, like fetch_orders or parse
+    """
+    report = _current.get()
+    active = _active_spans.get()
+
+    if report is None or name in active:
+        yield
+        return
+
+    token = _active_spans.set(active | {name})
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add_span(name, time.perf_counter() - start)
+        _active_spans.reset(token)
+
+
+def timed(name):
+    """
+    decorator that times every call of a function as a span of the current report.
+
+    :param name: name of the span
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, amount=1):
+    """
+    adds to a counter of the current report, does nothing if there isn't one.
+
+    :param name: name of the counter, like requests or rows_parsed
+    :param amount: amount to add
+    """
+    report = _current.get()
+
+    if report is not None:
+        report.count(name, amount)
+
+
+def frame_memory(name, frame, memory_report):
+    """
+    adds the memory of a frame to the current report, does nothing if there isn't one. Only reports that profile or
+    trace memory get it per column, the others only get the total.
+
+    :param name: kind of frame, like orders or history
+    :param frame: the dataframe
+    :param memory_report: function that breaks the memory of the frame down per column, like schema.memory_report
+    """
+    report = _current.get()
+
+    if report is None:
+        return
+
+    if report.profile or report.trace_memory:
+        report.add_memory(name, memory_report(frame)['bytes'])
+    else:
+        report.add_memory(name, {'total': frame.memory_usage(deep=False).sum()})
+
+
+def _enable_profiler():
+    """
+    :return: a cProfile profiler that's enabled, None if another profiler is already running
+    """
+    profiler = cProfile.Profile()
+
+    try:
+        profiler.enable()
+    except ValueError as error:  # Python 3.12 and later only allow one at a time
+        warnings.warn(f'not profiling the scan: {error}')
+        return None
+
+    return profiler
+
+
+@contextlib.contextmanager
+def profiled():
+    """
+    profiles the with block with cProfile if the current report wants that. Before Python 3.12 cProfile only sees the
+    thread it runs in, so every pipeline stage gets its own profiler and the stats get added together. After that the
+    profiler of the report already sees the stages.
+    """
+    report = _current.get()
+
+    if report is None or not report.profile or PROFILE_ALL_THREADS:
+        yield
+        return
+
+    profiler = _enable_profiler()
+    if profiler is None:
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        report.add_profile(profiler)
+
+
+def serve_prometheus(port, get_text, host=''):
+    """
+    serves metrics for Prometheus on /metrics in a background thread, for the daemon mode of scanner.py.
+
+    :param port: port to listen on
+    :param get_text: function without arguments that gives the metrics in the Prometheus text format
+    :param host: address to listen on, all of them by default
+    :return: the server, call shutdown on it to stop
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = get_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,306 @@
+import bisect
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+except ImportError:  # only needed when an archive gets used
+    pyarrow = None
+
+
+# rows per record batch, a query for a few items only reads the batches their type IDs are in
+BATCH_ROWS = 16384
+
+
+def _seconds(value):
+    """
+    :param value: None, seconds since the epoch, or a datetime or string pandas can read, UTC if there's no timezone
+    :return: seconds since the epoch, None for None
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+
+    return timestamp.timestamp()
+
+
+class OrderArchive(object):
+    """
+    keeps every order snapshot of a region that gets added, for trends over time. Every snapshot is an Arrow IPC
+    (Feather) file sorted on type_id and cut into record batches, a sqlite manifest has the region, the time, the size
+    and the range of type IDs in every batch. Files never change once they're written, retention only deletes the
+    oldest ones.
+
+    Reads memory map the files and only read the columns and batches that are needed, with compression only the
+    buffers that get read get decompressed. What gets read is copied into a dataframe before the file gets closed.
+    """
+
+    def __init__(self, path='order archive', max_bytes=None, max_age=None, compression='zstd'):
+        """
+        :param path: directory the snapshots and the manifest go in
+        :param max_bytes: optional most bytes all the snapshots together can use, the oldest go first
+        :param max_age: optional seconds a snapshot gets kept
+        :param compression: 'zstd', 'lz4' or None
+        """
+        if pyarrow is None:
+            raise ImportError('the order archive needs pyarrow')
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.compression = compression
+
+        os.makedirs(path, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(path, 'manifest.sqlite'), check_same_thread=False)
+
+        self._connection.execute('CREATE TABLE IF NOT EXISTS snapshots '
+                                 '(id INTEGER PRIMARY KEY, region_id INTEGER, taken REAL, file TEXT, rows INTEGER, '
+                                 'bytes INTEGER, batches TEXT)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS snapshots_region_taken ON snapshots (region_id, taken)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS snapshots_taken ON snapshots (taken)')
+        self._connection.commit()
+
+    def append(self, region_id, orders, taken=None):
+        """
+        :param region_id: region ID
+        :param orders: dataframe with the orders of the whole region, like market.request_all_orders_region gives them
+        :param taken: optional time of the snapshot, now by default
+        :return: id of the snapshot
+        """
+        region_id = int(region_id)
+        taken = _seconds(taken) if taken is not None else time.time()
+
+        orders = orders.sort_values('type_id', kind='mergesort')
+        table = pyarrow.Table.from_pandas(orders, preserve_index=False)
+        batches = table.to_batches(max_chunksize=BATCH_ROWS)
+
+        # the type IDs are sorted, so every batch covers a range of them
+        ranges = list()
+        for batch in batches:
+            type_ids = batch.column(batch.schema.get_field_index('type_id'))
+            ranges.append([type_ids[0].as_py(), type_ids[len(type_ids) - 1].as_py()])
+
+        file = self._reserve(region_id, taken)
+        path = os.path.join(self.path, file)
+        temporary_path = path + '.tmp'
+
+        try:
+            options = pyarrow.ipc.IpcWriteOptions(compression=self.compression)
+            with pyarrow.OSFile(temporary_path, 'wb') as sink:
+                with pyarrow.ipc.new_file(sink, table.schema, options=options) as writer:
+                    for batch in batches:
+                        writer.write_batch(batch)
+
+            # a snapshot that isn't complete never shows up in the manifest
+            os.replace(temporary_path, path)
+        except BaseException:
+            for leftover in (temporary_path, path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+            raise
+
+        with self._lock:
+            cursor = self._connection.execute('INSERT INTO snapshots (region_id, taken, file, rows, bytes, batches) '
+                                              'VALUES (?, ?, ?, ?, ?, ?)',
+                                              (region_id, taken, file, len(orders), os.path.getsize(path),
+                                               json.dumps(ranges)))
+            self._connection.commit()
+            snapshot_id = cursor.lastrowid
+
+        self.apply_retention()
+        return snapshot_id
+
+    def snapshots(self, region_id=None, start=None, end=None):
+        """
+        :param region_id: optional region ID, all regions by default
+        :param start: optional earliest time
+        :param end: optional latest time
+        :return: dataframe with the id, region_id, taken (as UTC datetime), rows and bytes of every snapshot, oldest
+        first
+        """
+        query, parameters = self._where(region_id, start, end)
+
+        with self._lock:
+            snapshots = pd.read_sql_query('SELECT id, region_id, taken, rows, bytes FROM snapshots' + query +
+                                          ' ORDER BY taken, id', self._connection, params=parameters)
+
+        snapshots['taken'] = pd.to_datetime(snapshots['taken'], unit='s', utc=True)
+        return snapshots
+
+    def read(self, region_id, start=None, end=None, type_ids=None, columns=None):
+        """
+        :param region_id: region ID
+        :param start: optional earliest time
+        :param end: optional latest time
+        :param type_ids: optional item IDs, only the batches with these items get read
+        :param columns: optional order columns, all of them by default. type_id is always in the result.
+        :return: dataframe with the orders of every snapshot in the range and a taken column with the time of the
+        snapshot, oldest first
+        """
+        query, parameters = self._where(region_id, start, end)
+
+        with self._lock:
+            rows = self._connection.execute('SELECT taken, file, batches FROM snapshots' + query +
+                                            ' ORDER BY taken, id', parameters).fetchall()
+
+        wanted = None if type_ids is None else sorted({int(type_id) for type_id in type_ids})
+        if columns is not None:
+            # the rows of different items can't be told apart without it
+            columns = list(dict.fromkeys(['type_id'] + list(columns)))
+
+        frames = list()
+
+        for taken, file, batches in rows:
+            orders = self._read_file(os.path.join(self.path, file), json.loads(batches), wanted, columns)
+
+            if orders is not None and len(orders) > 0:
+                frames.append(orders.assign(taken=pd.Timestamp(taken, unit='s', tz='UTC')))
+
+        if len(frames) == 0:
+            return pd.DataFrame(columns=(columns if columns is not None else list()) + ['taken'])
+
+        return pd.concat(frames, ignore_index=True)
+
+    def size(self):
+        """
+        :return: bytes all the snapshots use together
+        """
+        with self._lock:
+            return self._connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM snapshots').fetchone()[0]
+
+    def apply_retention(self):
+        """
+        deletes the snapshots that are older than max_age, then the oldest ones until they fit in max_bytes
+        """
+        with self._lock:
+            if self.max_age is not None:
+                expired = self._connection.execute('SELECT id, file FROM snapshots WHERE taken < ?',
+                                                   (time.time() - self.max_age,)).fetchall()
+                self._delete(expired)
+
+            if self.max_bytes is not None:
+                total = self._connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM snapshots').fetchone()[0]
+                oldest = list()
+
+                for snapshot_id, file, size in self._connection.execute('SELECT id, file, bytes FROM snapshots '
+                                                                        'ORDER BY taken, id'):
+                    if total <= self.max_bytes:
+                        break
+
+                    oldest.append((snapshot_id, file))
+                    total -= size
+
+                self._delete(oldest)
+
+    def _delete(self, snapshots):
+        """
+        :param snapshots: list of (id, file), has to be called with the lock
+        """
+        if len(snapshots) == 0:
+            return
+
+        self._connection.executemany('DELETE FROM snapshots WHERE id = ?',
+                                     [(snapshot_id,) for snapshot_id, _ in snapshots])
+        self._connection.commit()
+
+        for _, file in snapshots:
+            try:
+                os.remove(os.path.join(self.path, file))
+            except FileNotFoundError:
+                pass
+
+    def _reserve(self, region_id, taken):
+        """
+        :return: name for the file of a snapshot that no other snapshot has, also when two snapshots of a region are
+        taken in the same millisecond. The name is held by an empty file until the snapshot replaces it.
+        """
+        stem = f'{region_id}_{int(taken * 1000)}'
+
+        for number in itertools.count():
+            file = f'{stem}.arrow' if number == 0 else f'{stem}_{number}.arrow'
+
+            try:
+                os.close(os.open(os.path.join(self.path, file), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+
+            return file
+
+    def _where(self, region_id, start, end):
+        conditions = list()
+        parameters = list()
+
+        if region_id is not None:
+            conditions.append('region_id = ?')
+            parameters.append(int(region_id))
+        if start is not None:
+            conditions.append('taken >= ?')
+            parameters.append(_seconds(start))
+        if end is not None:
+            conditions.append('taken <= ?')
+            parameters.append(_seconds(end))
+
+        if len(conditions) == 0:
+            return '', parameters
+
+        return ' WHERE ' + ' AND '.join(conditions), parameters
+
+    def _read_file(self, path, batches, type_ids, columns):
+        """
+        :param batches: [first type ID, last type ID] of every batch in the file
+        :param type_ids: sorted item IDs or None for all of them
+        :param columns: column names with type_id in them or None for all of them
+        :return: dataframe with the rows of the items, None if no batch has them
+        """
+        with pyarrow.memory_map(path) as source:
+            schema = pyarrow.ipc.open_file(source).schema
+
+            options = None
+            if columns is not None:
+                # only the buffers of these columns get read, and decompressed
+                options = pyarrow.ipc.IpcReadOptions(included_fields=[schema.get_field_index(column)
+                                                                      for column in columns])
+
+            reader = pyarrow.ipc.open_file(source, options=options)
+
+            read = list()
+            for number, (first, last) in enumerate(batches):
+                if type_ids is None or self._overlaps(type_ids, first, last):
+                    read.append(reader.get_batch(number))
+
+            if len(read) == 0:
+                return None
+
+            table = pyarrow.Table.from_batches(read)
+
+            if type_ids is not None:
+                value_set = pyarrow.array(type_ids, type=table.schema.field('type_id').type)
+                table = table.filter(pyarrow.compute.is_in(table.column('type_id'), value_set=value_set))
+
+            if columns is not None:
+                table = table.select(columns)
+
+            # the columns still point into the memory map, they have to be turned into a dataframe before it closes
+            return table.to_pandas()
+
+    @staticmethod
+    def _overlaps(type_ids, first, last):
+        """
+        :param type_ids: sorted item IDs
+        :return: if one of the type IDs is between first and last
+        """
+        position = bisect.bisect_left(type_ids, first)
+        return position < len(type_ids) and type_ids[position] <= last
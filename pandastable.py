@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 from PySide2 import QtCore
 
@@ -10,76 +11,407 @@ Also made it compatible with Pyside2
 """
 
 
+# rows that get formatted at once when a cell that isn't formatted yet gets shown, and rows fetchMore adds
+BLOCK_SIZE = 256
+FETCH_SIZE = 2000
+
+# tables with at least this many rows get sorted in a background thread so the window doesn't freeze
+BACKGROUND_SORT_ROWS = 100000
+
+
+def _formatter(dtype):
+    """
+    :param dtype: dtype of a column
+    :return: function that turns a value of the column into the text that gets shown, picked once per column
+    """
+    if pd.api.types.is_bool_dtype(dtype):
+        return str
+
+    if pd.api.types.is_integer_dtype(dtype):
+        def format_integer(value):
+            return '' if value is pd.NA else f'{value:,}'
+
+        return format_integer
+
+    if pd.api.types.is_float_dtype(dtype):
+        def format_float(value):
+            return '' if value != value else f'{value:,.2f}'
+
+        return format_float
+
+    def format_other(value):
+        return '' if value is None or value is pd.NaT else str(value)
+
+    return format_other
+
+
+def _rank(values):
+    """
+    :param values: numpy array of a column
+    :return: int array with the rank of every value (equal values get the same rank) and a mask of the missing values
+    """
+    try:
+        codes, _ = pd.factorize(values, sort=True)
+    except TypeError:  # columns with values that can't be compared to each other get sorted on their text
+        codes, _ = pd.factorize(values.astype(str), sort=True)
+
+    missing = codes < 0
+    return codes, missing
+
+
+def _column_rank(columns, ranks, column):
+    """
+    :param columns: dictionary or list with the numpy array of every column
+    :param ranks: dictionary with the _rank of columns that were ranked before, gets the rank of this column added
+    :return: the _rank of the column
+    """
+    if column not in ranks or len(ranks[column][0]) != len(columns[column]):
+        ranks[column] = _rank(columns[column])
+
+    return ranks[column]
+
+
+def _argsort(columns, ranks, argsorts, column, ascending):
+    """
+    :param argsorts: dictionary with the argsorts of columns that were sorted before, gets this column added
+    :return: positions of the rows sorted on the column, missing values always go last
+    """
+    if column not in argsorts or len(argsorts[column][0]) != len(columns[column]):
+        codes, missing = _column_rank(columns, ranks, column)
+        argsorts[column] = (np.argsort(np.where(missing, len(codes), codes), kind='stable'),
+                            len(codes) - int(missing.sum()))
+
+    order, present = argsorts[column]
+
+    if ascending:
+        return order
+
+    return np.concatenate([order[:present][::-1], order[present:]])
+
+
+def _permutation(columns, ranks, argsorts, keys, rows):
+    """
+    :param keys: list of (column, ascending)
+    :param rows: amount of rows
+    :return: positions of the rows in the order of the keys
+    """
+    if len(keys) == 0:
+        return np.arange(rows)
+
+    if len(keys) == 1:
+        return _argsort(columns, ranks, argsorts, *keys[0])
+
+    # lexsort sorts on the last key first, it's stable so equal rows keep their order
+    sort_keys = list()
+    for column, ascending in reversed(keys):
+        codes, missing = _column_rank(columns, ranks, column)
+        high = len(codes)
+        sort_keys.append(np.where(missing, high, codes if ascending else high - 1 - codes))
+
+    return np.lexsort(sort_keys)
+
+
+class _SortSignals(QtCore.QObject):
+    # generation of the sort, generation of the columns it sorted, the new order of the rows and the ranks and
+    # argsorts it made
+    finished = QtCore.Signal(int, int, object, object, object)
+
+
+class _SortTask(QtCore.QRunnable):
+    """
+    sorts in a background thread. It only gets copies of the columns it sorts on and of their caches, the model can
+    change while it runs.
+    """
+
+    def __init__(self, columns, ranks, argsorts, keys, rows, generation, column_generation, signals):
+        super(_SortTask, self).__init__()
+        self.columns = columns
+        self.ranks = ranks
+        self.argsorts = argsorts
+        self.keys = keys
+        self.rows = rows
+        self.generation = generation
+        self.column_generation = column_generation
+        self.signals = signals
+
+    def run(self):
+        order = _permutation(self.columns, self.ranks, self.argsorts, self.keys, self.rows)
+        self.signals.finished.emit(self.generation, self.column_generation, order, self.ranks, self.argsorts)
+
+
 class PandasModel(QtCore.QAbstractTableModel):
-    def __init__(self, df=pd.DataFrame(), parent=None):
+    """
+    table model for a dataframe. The columns get taken out of the dataframe once as numpy arrays and the text of a cell
+    only gets made the first time it's shown, a block of rows at a time, after that it comes out of a cache. Headers
+    are lists so looking one up doesn't go through the whole index. Rows get added to the view in batches with
+    canFetchMore/fetchMore so big results show up right away.
+
+    Sorting never touches the dataframe, the model keeps the order of the rows as an array of positions. Every column
+    gets argsorted once and that gets reused for both directions and for sorting on more than one column.
+
+    Results that come in a part at a time get added with append_rows, the rows that are already there stay.
+    """
+
+    def __init__(self, df=None, parent=None):
         QtCore.QAbstractTableModel.__init__(self, parent=parent)
-        self._df = df
+        self._df = pd.DataFrame() if df is None else df
+
+        # list of (column, ascending), the first column is sorted on first
+        self._sort_keys = list()
+        self._sort_generation = 0
+        # goes up every time the columns change, ranks and argsorts of a background sort of older columns get dropped
+        self._column_generation = 0
+        self._sort_signals = _SortSignals()
+        self._sort_signals.finished.connect(self._sorted)
+
+        self._load()
+
+    def _load(self):
+        """
+        takes the columns, headers and formatters out of the dataframe and empties the text cache
+        """
+        df = self._df
+
+        self._columns = [df.iloc[:, column].to_numpy() for column in range(len(df.columns))]
+        self._formatters = [_formatter(dtype) for dtype in df.dtypes]
+        self._numeric = [pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+                         for dtype in df.dtypes]
+
+        self._column_headers = [str(column) for column in df.columns]
+        self._row_headers = [str(row) for row in df.index]
+
+        # text of every cell that was shown by position in the dataframe, None if it wasn't yet
+        self._text = [np.full(len(df), None, dtype=object) for _ in self._columns]
+
+        # row of the view: position in the dataframe
+        self._order = np.arange(len(df))
+        self._ranks = dict()
+        self._argsorts = dict()
+        self._column_generation += 1
+
+        self._rows = min(len(df), FETCH_SIZE)
+
+    def append_rows(self, df, key=None):
+        """
+        adds rows to the end of the table, the table stays sorted on what it was sorted on.
+
+        :param df: dataframe with the same columns as the table, an empty table takes the columns of df
+        :param key: optional column that says which rows are the same, rows of df with a key that's already in the table
+        replace that row instead of getting added
+        """
+        if len(self._df.columns) == 0:
+            self.beginResetModel()
+            self._df = df.copy()
+            self._load()
+            self.endResetModel()
+            return
+
+        df = df[self._df.columns]
+        replaced = np.zeros(len(df), dtype=bool)
+
+        if key is not None:
+            positions = pd.Index(self._df[key]).get_indexer(df[key])
+            replaced = positions >= 0
+
+            for column in range(len(self._columns)):
+                self._df.iloc[positions[replaced], column] = df.iloc[:, column].to_numpy()[replaced]
+                self._text[column][positions[replaced]] = None
+
+        new_rows = df[~replaced]
+        old_rows = len(self._df)
+        old_dtypes = list(self._df.dtypes)
+
+        # a table with row numbers keeps counting
+        self._df = pd.concat([self._df, new_rows], ignore_index=isinstance(self._df.index, pd.RangeIndex))
+
+        self._columns = [self._df.iloc[:, column].to_numpy() for column in range(len(self._df.columns))]
+        self._row_headers += [str(row) for row in self._df.index[old_rows:]]
+        self._order = np.concatenate([self._order, np.arange(old_rows, len(self._df))])
+        self._ranks = dict()
+        self._argsorts = dict()
+        self._column_generation += 1
+
+        reformatted = list(self._df.dtypes) != old_dtypes
+
+        if reformatted:
+            # an int column with missing values becomes a float column, everything has to be formatted again
+            self._formatters = [_formatter(dtype) for dtype in self._df.dtypes]
+            self._numeric = [pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+                             for dtype in self._df.dtypes]
+            self._text = [np.full(len(self._df), None, dtype=object) for _ in self._columns]
+        else:
+            self._text = [np.concatenate([text, np.full(len(new_rows), None, dtype=object)]) for text in self._text]
+
+        # new rows only show up right away if everything before them was shown already, otherwise fetchMore adds them
+        if self._rows == old_rows and len(new_rows) > 0:
+            rows = min(FETCH_SIZE, len(new_rows))
+            self.beginInsertRows(QtCore.QModelIndex(), old_rows, old_rows + rows - 1)
+            self._rows += rows
+            self.endInsertRows()
+
+        if (replaced.any() or reformatted) and self._rows > 0:
+            self.dataChanged.emit(self.index(0, 0), self.index(self._rows - 1, len(self._columns) - 1))
+
+        if len(self._sort_keys) > 0:
+            self._start_sort()
+
+    def _cell_text(self, row, column):
+        row = self._order[row]
+        text = self._text[column]
+
+        if text[row] is None:
+            start = row - row % BLOCK_SIZE
+            end = min(start + BLOCK_SIZE, len(text))
+            formatter = self._formatters[column]
+            text[start:end] = [formatter(value) for value in self._columns[column][start:end]]
+
+        return text[row]
 
     def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
         if role != QtCore.Qt.DisplayRole:
             return None
 
         if orientation == QtCore.Qt.Horizontal:
-            try:
-                return self._df.columns.tolist()[section]
-            except (IndexError,):
-                return None
-        elif orientation == QtCore.Qt.Vertical:
-            try:
-                # return self.df.index.tolist()
-                return self._df.index.tolist()[section]
-            except (IndexError,):
-                return None
+            if 0 <= section < len(self._column_headers):
+                return self._column_headers[section]
+        elif 0 <= section < len(self._row_headers):
+            return self._row_headers[self._order[section]]
 
-    def data(self, index, role=QtCore.Qt.DisplayRole):
-        if role != QtCore.Qt.DisplayRole:
-            return None
+        return None
 
+    def data(self, index, role=QtCore.Qt.DisplayRole):
         if not index.isValid():
             return None
 
-        return str(self._df.iloc[index.row(), index.column()])
+        if role == QtCore.Qt.DisplayRole:
+            return self._cell_text(index.row(), index.column())
+
+        if role == QtCore.Qt.TextAlignmentRole and self._numeric[index.column()]:
+            return int(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        row = self._order[index.row()]
+        column = index.column()
 
-    def setData(self, index, value, role):
-        row = self._df.index[index.row()]
-        col = self._df.columns[index.column()]
         if hasattr(value, 'toPyObject'):
             # PyQt4 gets a QVariant
             value = value
         else:
             # PySide gets an unicode
-            dtype = self._df[col].dtype
+            dtype = self._df.dtypes.iloc[column]
             if dtype != object:
                 value = None if value == '' else dtype.type(value)
-        self._df.set_value(row, col, value)
+
+        # set_value doesn't exist anymore in pandas
+        self._df.iat[row, column] = value
+        self._columns[column] = self._df.iloc[:, column].to_numpy()
+        self._text[column][row] = None
+        self._ranks.pop(column, None)
+        self._argsorts.pop(column, None)
+        self._column_generation += 1
+
+        self.dataChanged.emit(index, index)
         return True
 
     def rowCount(self, parent=QtCore.QModelIndex()):
-        return len(self._df.index)
+        if parent.isValid():
+            return 0
+
+        return self._rows
 
     def columnCount(self, parent=QtCore.QModelIndex()):
-        return len(self._df.columns)
+        if parent.isValid():
+            return 0
 
-    def sort(self, column, order):
-        colname = self._df.columns.tolist()[column]
+        return len(self._columns)
 
-        temp_df = self._df[colname]
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return False
 
-        # These are there so that if you sort a sorted column that the sorting gets inversed.
+        return self._rows < len(self._df)
 
-        if temp_df.is_monotonic_decreasing == True:
-            self.layoutAboutToBeChanged.emit()
-            self._df.sort_values(colname, ascending=False == QtCore.Qt.AscendingOrder, inplace=True)
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return
 
-            self.layoutChanged.emit()
+        rows = min(FETCH_SIZE, len(self._df) - self._rows)
+        if rows <= 0:
+            return
 
-        elif temp_df.is_monotonic_increasing == True:
-            self.layoutAboutToBeChanged.emit()
-            self._df.sort_values(colname, ascending=True == QtCore.Qt.AscendingOrder, inplace=True)
+        self.beginInsertRows(QtCore.QModelIndex(), self._rows, self._rows + rows - 1)
+        self._rows += rows
+        self.endInsertRows()
 
-            self.layoutChanged.emit()
+    def sort(self, column, order):
+        """
+        sorts on only this column, what a QTableView with sorting enabled calls
+        """
+        self._sort_keys = [(column, order == QtCore.Qt.AscendingOrder)]
+        self._start_sort()
+
+    def sort_columns(self, column, add=False):
+        """
+        sorts on a column when its header gets clicked. Clicking the column that's sorted on again turns the order
+        around, a new column gets sorted from high to low first.
+
+        :param column: position of the column
+        :param add: sort on this column after the columns it's already sorted on (shift-click)
+        """
+        keys = dict(self._sort_keys)
+
+        if column in keys:
+            ascending = not keys[column]
         else:
-            self.layoutAboutToBeChanged.emit()
-            self._df.sort_values(colname, ascending=order == QtCore.Qt.AscendingOrder, inplace=True)
+            ascending = False
+
+        if add:
+            self._sort_keys = [(key, direction) for key, direction in self._sort_keys if key != column]
+            self._sort_keys.append((column, ascending))
+        else:
+            self._sort_keys = [(column, ascending)]
+
+        self._start_sort()
+
+    def sort_keys(self):
+        """
+        :return: list of (column name, ascending) the table is sorted on
+        """
+        return [(self._df.columns[column], ascending) for column, ascending in self._sort_keys]
+
+    def _start_sort(self):
+        self._sort_generation += 1
+        keys = list(self._sort_keys)
+
+        if len(self._df) < BACKGROUND_SORT_ROWS:
+            self._set_order(self._sort_generation, _permutation(self._columns, self._ranks, self._argsorts, keys,
+                                                                len(self._df)))
+            return
+
+        # the task works on copies, cells that get edited or rows that get added while it runs don't change them
+        columns = {column: self._columns[column].copy() for column, _ in keys}
+        ranks = {column: self._ranks[column] for column, _ in keys if column in self._ranks}
+        argsorts = {column: self._argsorts[column] for column, _ in keys if column in self._argsorts}
+
+        # the order gets swapped in on the GUI thread when it's done, if nobody clicked another header by then
+        task = _SortTask(columns, ranks, argsorts, keys, len(self._df), self._sort_generation,
+                         self._column_generation, self._sort_signals)
+        QtCore.QThreadPool.globalInstance().start(task)
+
+    def _sorted(self, generation, column_generation, order, ranks, argsorts):
+        # the ranks and argsorts can be used again if the columns didn't change since the sort started
+        if column_generation == self._column_generation:
+            self._ranks.update(ranks)
+            self._argsorts.update(argsorts)
+
+        self._set_order(generation, order)
+
+    def _set_order(self, generation, order):
+        if generation != self._sort_generation:
+            return
 
-            self.layoutChanged.emit()
\ No newline at end of file
+        self.layoutAboutToBeChanged.emit()
+        self._order = order
+        self.layoutChanged.emit()
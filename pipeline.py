@@ -0,0 +1,126 @@
+import contextvars
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import jobs
+import metrics
+
+
+class Pipeline(object):
+    """
+    small dependency graph of stages. Every stage runs as soon as the stages it depends on are done, so stages that
+    don't depend on each other (like downloading two regions) run at the same time. The outputs of the stages it
+    depends on get passed to a stage as they are, nothing gets copied or calculated again.
+    """
+
+    def __init__(self, max_workers=4):
+        """
+        :param max_workers: maximum amount of stages running at the same time
+        """
+        self.max_workers = max_workers
+
+        self.stages = dict()
+        self.results = dict()
+        self.timings = dict()
+
+    def add(self, name, function, depends=()):
+        """
+        :param name: name of the stage
+        :param function: function that gets called with the results of the stages it depends on, in the same order
+        :param depends: names of the stages this stage needs the results of
+        """
+        if name in self.stages:
+            raise ValueError(f'there already is a stage called {name}')
+
+        for dependency in depends:
+            if dependency not in self.stages:
+                raise ValueError(f'stage {name} depends on {dependency} which has to be added first')
+
+        self.stages[name] = (function, tuple(depends))
+
+    def run(self, on_done=None):
+        """
+        runs all the stages, if a stage fails the stages that didn't start yet don't get started anymore and the error
+        gets raised.
+
+        :param on_done: optional function that gets called with the name of a stage, the amount of stages that are
+        done and the amount of stages every time a stage is done, in the thread that runs the pipeline
+        :return: dictionary with the result of every stage
+        """
+        running = dict()
+        started = set()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(self.results) < len(self.stages):
+                for name in self.stages:
+                    function, depends = self.stages[name]
+
+                    if name not in started and all(dependency in self.results for dependency in depends):
+                        arguments = [self.results[dependency] for dependency in depends]
+                        # the stage runs with the scan report and the cancel token of whoever runs the pipeline
+                        context = contextvars.copy_context()
+                        running[executor.submit(context.run, self._run_stage, name, function, arguments)] = name
+                        started.add(name)
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+                    # raises the error of the stage if it failed
+                    self.results[name] = future.result()
+
+                    if on_done is not None:
+                        on_done(name, len(self.results), len(self.stages))
+
+        return self.results
+
+    def _run_stage(self, name, function, arguments):
+        # a cancelled job doesn't start any more stages
+        jobs.checkpoint()
+
+        start = time.time()
+        try:
+            with metrics.profiled():
+                return function(*arguments)
+        finally:
+            self.timings[name] = time.time() - start
+
+            report = metrics.current()
+            if report is not None:
+                report.add_span('stage.' + name, self.timings[name])
+
+
+class SharedResults(object):
+    """
+    results that only get calculated once and then get shared between scans, also when the scans run at the same time.
+    A scan that asks for something another scan is still working on waits for that instead of doing it again.
+    """
+
+    def __init__(self):
+        self._futures = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key, function):
+        """
+        :param key: anything hashable that says what the result is, like ('region_orders', region_id)
+        :param function: function without arguments that calculates the result if nobody did yet
+        :return: the result
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            calculate = future is None
+
+            if calculate:
+                future = Future()
+                self._futures[key] = future
+
+        if calculate:
+            try:
+                future.set_result(function())
+            except BaseException as error:
+                future.set_exception(error)
+                raise
+
+        return future.result()
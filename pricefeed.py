@@ -0,0 +1,250 @@
+import itertools
+import threading
+import time
+import traceback
+
+import numpy as np
+import pandas as pd
+
+import market
+
+
+# ESI caches the orders of a region for 5 minutes, a price stays good as long as that
+ORDER_CACHE_TIME = 300
+
+
+class PriceFeed(object):
+    """
+    best prices of items per (region, type_id, side), shared by everything in the process. Prices that are younger than
+    the ESI order cache come out of the feed, the rest gets fetched for all the items of a region that are asked for at
+    once. A scan that pulled a whole region anyway can publish its order book summary so nobody has to fetch those.
+
+    Prices that are in use get refreshed in a background thread just before they expire, subscribers get the prices of
+    their items every time one of them changed.
+    """
+
+    def __init__(self, client, app_esi, ttl=ORDER_CACHE_TIME, refresh_margin=15):
+        """
+        :param client: esi client, a scheduler view or a fetch engine
+        :param app_esi: esi app
+        :param ttl: seconds a price stays good
+        :param refresh_margin: seconds before a price expires it gets refreshed if it's in use
+        """
+        self.client = client
+        self.app_esi = app_esi
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+
+        # (region_id, type_id, is_buy_order): (price, time it expires)
+        self._prices = dict()
+        # (region_id, type_id, is_buy_order): last time somebody asked for it
+        self._used = dict()
+        # subscription id: (region_id, type IDs, is_buy_order, callback)
+        self._subscriptions = dict()
+        self._last_sent = dict()
+        self._ids = itertools.count()
+
+        self._lock = threading.Lock()
+        # one fetch at a time, so two callers that want the same prices don't both fetch them
+        self._fetch_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._stopped = False
+
+    def prices(self, region_id, items, is_buy_order=False):
+        """
+        :param region_id: region ID
+        :param items: item IDs
+        :param is_buy_order: boolean, the highest buy order or the lowest sell order
+        :return: dataframe with a price column indexed by type_id in the same order as items, NaN for items without
+        orders on that side
+        """
+        region_id = int(region_id)
+        type_ids = [int(item) for item in items]
+        now = time.time()
+
+        with self._lock:
+            for type_id in type_ids:
+                self._used[(region_id, type_id, is_buy_order)] = now
+
+        self._start()
+
+        missing = self._expired(region_id, type_ids, is_buy_order, now)
+        if len(missing) > 0:
+            with self._fetch_lock:
+                # somebody else could have fetched them while this waited
+                missing = self._expired(region_id, missing, is_buy_order, time.time())
+                if len(missing) > 0:
+                    self.fetch(region_id, missing)
+
+        return self._frame(region_id, type_ids, is_buy_order)
+
+    def fetch(self, region_id, items):
+        """
+        fetches the orders of the items in a region and publishes the prices of both sides
+
+        :param region_id: region ID
+        :param items: item IDs
+        """
+        orders = market.get_from_region(items, region_id, self.client, self.app_esi)
+        self.publish(region_id, market.summarize_orders(orders), items)
+
+    def publish(self, region_id, summary, items=None):
+        """
+        puts prices in the feed and tells the subscribers what changed
+
+        :param region_id: region ID
+        :param summary: order book summary from market.summarize_orders, None if there are no orders at all (like the
+        summary of an empty snapshot.OrderSnapshot)
+        :param items: item IDs the summary has all the orders of, None if it has the whole region. Items without orders
+        in the summary get a NaN price.
+        """
+        region_id = int(region_id)
+        best_prices = dict()
+        if summary is not None:
+            best_prices = {(int(type_id), bool(is_buy_order)): price
+                           for (type_id, is_buy_order), price in summary['best_price'].items()}
+        expires = time.time() + self.ttl
+
+        with self._lock:
+            if items is None:
+                # items that aren't on the market anymore don't have a price anymore
+                type_ids = {type_id for type_id, _ in best_prices}
+                type_ids.update(key[1] for key in self._prices if key[0] == region_id)
+            else:
+                type_ids = [int(item) for item in items]
+
+            for type_id in type_ids:
+                for is_buy_order in (True, False):
+                    price = best_prices.get((type_id, is_buy_order), np.nan)
+                    self._prices[(region_id, type_id, is_buy_order)] = (float(price), expires)
+
+            subscriptions = [(number, subscription) for number, subscription in self._subscriptions.items()
+                             if subscription[0] == region_id]
+
+        for number, (region_id, type_ids, is_buy_order, callback) in subscriptions:
+            prices = self._frame(region_id, type_ids, is_buy_order)
+            sent = tuple(prices['price'].fillna(-1.0))
+
+            # the refresh thread and scans can publish at the same time, only one of them sends a change
+            with self._lock:
+                if self._last_sent.get(number) == sent or number not in self._subscriptions:
+                    continue
+                self._last_sent[number] = sent
+
+            callback(prices)
+
+    def subscribe(self, region_id, items, is_buy_order, callback):
+        """
+        :param region_id: region ID
+        :param items: item IDs
+        :param is_buy_order: boolean
+        :param callback: function that gets called with the prices like prices gives them every time they changed,
+        from the thread that got the new prices
+        :return: id of the subscription for unsubscribe
+        """
+        number = next(self._ids)
+
+        with self._lock:
+            self._subscriptions[number] = (int(region_id), [int(item) for item in items], is_buy_order, callback)
+
+        self._start()
+        self._wake.set()
+        return number
+
+    def unsubscribe(self, number):
+        with self._lock:
+            self._subscriptions.pop(number, None)
+            self._last_sent.pop(number, None)
+
+    def ore_prices(self, region_id, ore_list, is_buy_order=False, ore_ids='ore id.csv'):
+        """
+        :param region_id: region ID
+        :param ore_list: ore file like ore.csv, the prices come in the same order as the ore in it
+        :param is_buy_order: boolean
+        :param ore_ids: file with the type ID of every ore
+        :return: numpy array with the price of every ore, the coefficients compression.compress takes
+        """
+        type_ids = pd.read_csv(ore_ids, index_col='name')['type id']
+        ore = pd.read_csv(ore_list).index
+
+        return self.prices(region_id, type_ids.loc[ore], is_buy_order)['price'].to_numpy()
+
+    def stop(self):
+        """
+        stops the background refreshes
+        """
+        self._stopped = True
+        self._wake.set()
+
+    def _expired(self, region_id, type_ids, is_buy_order, now):
+        with self._lock:
+            return [type_id for type_id in type_ids
+                    if self._prices.get((region_id, type_id, is_buy_order), (None, 0))[1] <= now]
+
+    def _frame(self, region_id, type_ids, is_buy_order):
+        with self._lock:
+            prices = [self._prices.get((region_id, type_id, is_buy_order), (np.nan, 0))[0] for type_id in type_ids]
+
+        return pd.DataFrame({'price': np.array(prices, dtype=float)}, index=pd.Index(type_ids, name='type_id'))
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+
+            self._thread = threading.Thread(target=self._refresh, daemon=True)
+            self._thread.start()
+
+    def _wanted(self, now):
+        """
+        :return: the (region_id, type_id) of prices that are in use, the ones asked for in the last ttl seconds and the
+        ones of the subscriptions
+        """
+        with self._lock:
+            wanted = {(key[0], key[1]) for key, used in self._used.items() if used > now - self.ttl}
+
+            for region_id, type_ids, _, _ in self._subscriptions.values():
+                wanted.update((region_id, type_id) for type_id in type_ids)
+
+        return wanted
+
+    def _refresh_times(self, now):
+        """
+        :return: dictionary with the (region_id, type_id) of every price in use and the time it has to be refreshed
+        """
+        wanted = self._wanted(now)
+
+        with self._lock:
+            # the prices of both sides expire at the same time
+            return {key: self._prices.get((key[0], key[1], False), (None, 0))[1] - self.refresh_margin
+                    for key in wanted}
+
+    def _refresh(self):
+        while not self._stopped:
+            self._wake.clear()
+
+            due = dict()
+            for (region_id, type_id), refresh_time in self._refresh_times(time.time()).items():
+                if refresh_time <= time.time():
+                    due.setdefault(region_id, list()).append(type_id)
+
+            for region_id, type_ids in due.items():
+                try:
+                    with self._fetch_lock:
+                        self.fetch(region_id, type_ids)
+                except Exception:
+                    traceback.print_exc()
+
+            now = time.time()
+            refresh_times = list(self._refresh_times(now).values())
+
+            if len(refresh_times) == 0:
+                wait = self.ttl
+            else:
+                # a fetch that failed gets tried again after the margin
+                wait = min(refresh_times) - now
+                if wait <= 0:
+                    wait = self.refresh_margin
+
+            self._wake.wait(max(1.0, wait))
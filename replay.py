@@ -0,0 +1,300 @@
+import datetime
+import hashlib
+import json
+import threading
+import time
+import zipfile
+
+import fetch
+
+
+ARCHIVE_VERSION = 1
+
+# parameters esipy fills in on every request that don't change what comes back
+_IGNORED_PARAMS = ('datasource', 'language', 'token')
+
+
+def _normalize(value):
+    if isinstance(value, (list, tuple)):
+        return [_normalize(item) for item in value]
+
+    return str(getattr(value, 'v', value))
+
+
+def _operation_name(path, path_params):
+    """
+    :param path: path of an esipy request, esipy fills in the path parameters once the request got sent
+    :param path_params: path parameters of the request
+    :return: name of the operation in fetch.OPERATIONS, or the path if it isn't in there
+    """
+    for name, template in fetch.OPERATIONS.items():
+        try:
+            if path in (template, template.format(**path_params)):
+                return name
+        except KeyError:
+            continue
+
+    return path
+
+
+def operation_key(operation):
+    """
+    the same request gets the same key, if it comes from esipy's app.op or from the fetch engine's op. So a scan
+    recorded with esipy can be replayed without downloading the swagger spec.
+
+    :param operation: esipy (request, response) tuple or fetch.Operation
+    :return: string key of the request
+    """
+    if isinstance(operation, fetch.Operation):
+        name = operation.name
+        params = dict(operation.params)
+    else:
+        request = operation[0]
+        name = _operation_name(request.path, request._p.get('path', dict()))
+
+        params = dict(fetch.DEFAULT_PARAMS.get(name, dict()))
+        params.update(request._p.get('path', dict()))
+        params.update(request._p.get('body', dict()))
+        params.update(request._p.get('query', list()))
+
+    params = {key: _normalize(value) for key, value in params.items() if key not in _IGNORED_PARAMS}
+
+    return json.dumps([name, sorted(params.items())])
+
+
+class _Entry(object):
+    def __init__(self, method, key, status, headers, body, latency, offset):
+        self.method = method
+        self.key = key
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.latency = latency
+        self.offset = offset
+
+
+class RecordingClient(object):
+    """
+    client that passes everything on to another client and keeps every request and response, headers included. save
+    writes them to a compressed archive a ReplayClient can serve a whole scan from.
+    """
+
+    def __init__(self, client, path=None):
+        """
+        :param client: esipy EsiClient or fetch.FetchEngine that does the actual requests
+        :param path: optional archive file, used when save gets called without a path
+        """
+        self.client = client
+        self.path = path
+        self.started = time.time()
+
+        self._entries = list()
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return getattr(self.client, 'cache', None)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def head(self, operation):
+        start = time.time()
+        response = self.client.head(operation)
+        self._record('HEAD', operation, response, time.time() - start, start)
+        return response
+
+    def request(self, operation):
+        start = time.time()
+        response = self.client.request(operation)
+        self._record('GET', operation, response, time.time() - start, start)
+        return response
+
+    def multi_request(self, operations):
+        operations = list(operations)
+        responses = [None] * len(operations)
+
+        for position, response in self.stream_request(operations):
+            responses[position] = response
+
+        return list(zip(operations, responses))
+
+    def stream_request(self, operations):
+        """
+        :param operations: list of requests
+        :return: generator that yields (position of the operation, response) in the order the responses come in
+        """
+        operations = list(operations)
+        start = time.time()
+
+        if hasattr(self.client, 'stream_request'):
+            responses = self.client.stream_request(operations)
+        else:
+            responses = enumerate(response for _, response in self.client.multi_request(operations))
+
+        # the latency of a request in a batch is how long it took to come in since the batch started
+        for position, response in responses:
+            self._record('GET', operations[position], response, time.time() - start, start)
+            yield position, response
+
+    def save(self, path=None):
+        """
+        :param path: archive file, the path given at the start by default
+        :return: the path the archive got written to
+        """
+        path = path or self.path
+        if path is None:
+            raise ValueError('no path to save the recording to')
+
+        with self._lock:
+            entries = list(self._entries)
+
+        index = {'version': ARCHIVE_VERSION, 'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                 'entries': list()}
+        bodies = dict()
+
+        for entry in entries:
+            digest = None
+            if entry.body is not None:
+                # pages that didn't change between scans only get stored once
+                digest = hashlib.sha1(entry.body).hexdigest()
+                bodies[digest] = entry.body
+
+            index['entries'].append({'method': entry.method, 'key': entry.key, 'status': entry.status,
+                                     'headers': entry.headers, 'body': digest, 'latency': entry.latency,
+                                     'offset': entry.offset})
+
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_LZMA) as archive:
+            archive.writestr('index.json', json.dumps(index))
+            for digest, body in bodies.items():
+                archive.writestr('bodies/' + digest, body)
+
+        return path
+
+    def _record(self, method, operation, response, latency, start):
+        header = getattr(response, 'header', None) or dict()
+        headers = {key: [str(value) for value in (values if isinstance(values, list) else [values])]
+                   for key, values in header.items()}
+
+        body = getattr(response, 'raw', None)
+        if body is not None and not isinstance(body, bytes):
+            body = bytes(body)
+
+        entry = _Entry(method, operation_key(operation), getattr(response, 'status', None), headers, body, latency,
+                       start - self.started)
+
+        with self._lock:
+            self._entries.append(entry)
+
+
+class _Operations(object):
+    def __getitem__(self, name):
+        def make_operation(**kwargs):
+            return fetch.Operation(name, **kwargs)
+
+        return make_operation
+
+
+class ReplayClient(object):
+    """
+    serves a scan from an archive of a RecordingClient without any network, as the client and the app like the fetch
+    engine. A request that's in the archive more than once (a daemon recording a few scans) gets the responses in the
+    order they were recorded, and the last one after that. A request that isn't in the archive raises a KeyError.
+    """
+
+    def __init__(self, path, simulate_latency=False, speed=1.0, raw_body_only=True):
+        """
+        :param path: archive file from RecordingClient.save
+        :param simulate_latency: wait as long as the original requests took
+        :param speed: how much faster than the original the latencies get replayed, 2 waits half as long
+        :param raw_body_only: only give the raw body like EsiClient(raw_body_only=True), otherwise decode the json
+        """
+        self.simulate_latency = simulate_latency
+        self.speed = speed
+        self.raw_body_only = raw_body_only
+
+        self.op = _Operations()
+
+        # (method, key): list of entries
+        self._entries = dict()
+        self._served = dict()
+        self._lock = threading.Lock()
+
+        with zipfile.ZipFile(path) as archive:
+            index = json.loads(archive.read('index.json'))
+
+            if index.get('version') != ARCHIVE_VERSION:
+                raise ValueError(f'{path} is a version {index.get("version")} archive, '
+                                 f'only version {ARCHIVE_VERSION} can be replayed')
+
+            bodies = {name[len('bodies/'):]: archive.read(name) for name in archive.namelist()
+                      if name.startswith('bodies/')}
+
+        self.created = index['created']
+
+        for entry in index['entries']:
+            self._entries.setdefault((entry['method'], entry['key']), list()).append(
+                _Entry(entry['method'], entry['key'], entry['status'], entry['headers'],
+                       bodies.get(entry['body']), entry['latency'], entry['offset']))
+
+    def __len__(self):
+        return sum(len(entries) for entries in self._entries.values())
+
+    def head(self, operation):
+        return self._serve('HEAD', operation)
+
+    def request(self, operation):
+        return self._serve('GET', operation)
+
+    def multi_request(self, operations):
+        operations = list(operations)
+        responses = [None] * len(operations)
+
+        for position, response in self.stream_request(operations):
+            responses[position] = response
+
+        return list(zip(operations, responses))
+
+    def stream_request(self, operations):
+        """
+        :param operations: list of requests
+        :return: generator that yields (position of the operation, response), when the latencies get simulated in the
+        order and at the time they came in when they were recorded
+        """
+        served = [self._serve('GET', operation, wait=False) for operation in operations]
+
+        if not self.simulate_latency:
+            for position, (response, _) in enumerate(served):
+                yield position, response
+            return
+
+        start = time.time()
+
+        for position in sorted(range(len(served)), key=lambda position: served[position][1] or 0):
+            response, latency = served[position]
+            time.sleep(max(0.0, start + (latency or 0) / self.speed - time.time()))
+            yield position, response
+
+    def _serve(self, method, operation, wait=True):
+        key = (method, operation_key(operation))
+
+        with self._lock:
+            entries = self._entries.get(key)
+            if entries is None:
+                raise KeyError(f'{method} {key[1]} is not in the recording')
+
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+
+        entry = entries[min(served, len(entries) - 1)]
+
+        if wait and self.simulate_latency and entry.latency:
+            time.sleep(entry.latency / self.speed)
+
+        headers = {name: values[0] for name, values in entry.headers.items() if values}
+        response = fetch.Response(entry.status, headers, entry.body, raw_body_only=self.raw_body_only)
+
+        if wait:
+            return response
+
+        return response, entry.latency
@@ -0,0 +1,402 @@
+"""
+headless trade scanner, runs calculation.main_program without the GUI so it can run under cron or systemd.
+
+    python scanner.py --config scan.json --output items.csv
+    python scanner.py --sell-region 10000002 --buy-region 10000043 --output items.parquet --daemon
+
+Everything main_program needs can be given as flags or in a json config file with the same names as the parameters of
+main_program, flags win over the config file. Nothing from PySide2 or the .ui file gets loaded.
+"""
+import argparse
+import datetime
+import email.utils
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import calculation
+import metrics
+
+
+# same defaults as the fields in EVE_test.ui
+DEFAULTS = {
+    'sell_station': 60003760,
+    'sell_region': 10000002,
+    'buy_region': 10000002,
+    'min_sell': 10000000,
+    'min_per_day_sold': 0,
+    'min_isk_volume': 1000000,
+    'min_daily_profit': 1000000,
+    'broker_fee': 0.04,
+    'transaction_tax': 0.02,
+    'buy_from_buy_orders': False,
+    'sell_to_buy_orders': False,
+    'sell_to_region': False,
+    'history_size': 30,
+    'days_not_sold_per_month': 7,
+    'fill_quantity': None,
+    'pull_buy_region': None,
+    'routes': None,
+}
+
+# ESI caches the region orders for 5 minutes, used when the Expires header can't be read
+ORDER_CACHE_TIME = 300
+
+# seconds after the cache expired before scanning again, so ESI has the new data ready
+EXPIRY_MARGIN = 5
+
+
+def parse_bool(value):
+    """
+    :param value: string like true, false, 1 or 0
+    :return: the boolean
+    """
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError(f'{value} is not true or false')
+
+
+def parse_fill_quantity(value):
+    """
+    :param value: 'volume_per_day' or a number
+    :return: what main_program takes as fill_quantity
+    """
+    if value == 'volume_per_day':
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not a number or volume_per_day')
+
+
+def parse_route(value):
+    """
+    :param value: route as sell_station:sell_region:buy_region
+    :return: tuple of ints like batch_scan takes them
+    """
+    parts = value.split(':')
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError(f'{value} is not sell_station:sell_region:buy_region')
+    return tuple(int(part) for part in parts)
+
+
+def make_parser():
+    """
+    :return: argparse parser for all the options, options that aren't given are None so the config file can fill them
+    """
+    parser = argparse.ArgumentParser(description='scan for items worth importing without the GUI')
+
+    parser.add_argument('--config', help='json file with the parameters of main_program')
+    parser.add_argument('--output', default='items.csv',
+                        help='file the items get written to, .csv or .parquet. {time} gets replaced by the scan time')
+
+    parser.add_argument('--sell-station', type=int)
+    parser.add_argument('--sell-region', type=int)
+    parser.add_argument('--buy-region', type=int)
+    parser.add_argument('--route', dest='routes', type=parse_route, action='append',
+                        help='sell_station:sell_region:buy_region, can be given more than once to scan a batch')
+    parser.add_argument('--min-sell', type=float)
+    parser.add_argument('--min-per-day-sold', type=float)
+    parser.add_argument('--min-isk-volume', type=float)
+    parser.add_argument('--min-daily-profit', type=float)
+    parser.add_argument('--broker-fee', type=float)
+    parser.add_argument('--transaction-tax', type=float)
+    parser.add_argument('--buy-from-buy-orders', type=parse_bool)
+    parser.add_argument('--sell-to-buy-orders', type=parse_bool)
+    parser.add_argument('--sell-to-region', type=parse_bool)
+    parser.add_argument('--history-size', type=int)
+    parser.add_argument('--days-not-sold-per-month', type=int)
+    parser.add_argument('--fill-quantity', type=parse_fill_quantity)
+    parser.add_argument('--pull-buy-region', type=parse_bool,
+                        help='true to pull the whole buy region, false to get the items one by one, picked by default')
+
+    parser.add_argument('--appinfo', default='appinfo.csv',
+                        help='appinfo.csv with the refresh token, needed to scan structure markets')
+    parser.add_argument('--no-auth', action='store_true', help="don't log in, only public markets can be scanned")
+    parser.add_argument('--history-db', default='history.sqlite', help='sqlite file the histories get kept in')
+    parser.add_argument('--type-db', default='types.sqlite', help='sqlite file the item names and volumes get kept in')
+    parser.add_argument('--archive', help='directory every region order snapshot gets archived in, for trends')
+    parser.add_argument('--archive-max-gb', type=float, help='oldest snapshots get deleted when the archive gets bigger')
+    parser.add_argument('--archive-max-days', type=float, help='snapshots older than this get deleted')
+
+    parser.add_argument('--daemon', action='store_true', help='keep scanning every time the ESI order cache expires')
+    parser.add_argument('--interval', type=float, default=ORDER_CACHE_TIME,
+                        help='minimum amount of seconds between scans in daemon mode')
+
+    parser.add_argument('--report', help='json file the timings and counters of every scan get written to, '
+                                         '{time} gets replaced by the scan time')
+    parser.add_argument('--metrics-port', type=int, help='serve the last scan report for Prometheus on this port')
+    parser.add_argument('--record', help='record every request and response of the scans to this archive')
+    parser.add_argument('--replay', help='run the scan from an archive made with --record, without any network')
+    parser.add_argument('--replay-speed', type=float,
+                        help='wait as long as the recorded requests took, divided by this, when replaying')
+    parser.add_argument('--profile', help='profile the scans with cProfile and tracemalloc and write the cProfile '
+                                          'stats to this file, makes the scans slower')
+
+    return parser
+
+
+def load_parameters(arguments):
+    """
+    :param arguments: parsed arguments from make_parser
+    :return: dictionary with the parameters for main_program, from the defaults, the config file and the flags
+    """
+    parameters = dict(DEFAULTS)
+
+    if arguments.config is not None:
+        with open(arguments.config) as config_file:
+            config = json.load(config_file)
+
+        unknown = set(config) - set(DEFAULTS)
+        if unknown:
+            raise ValueError(f'unknown parameters in {arguments.config}: {", ".join(sorted(unknown))}')
+
+        parameters.update(config)
+
+    for name in DEFAULTS:
+        value = getattr(arguments, name, None)
+        if value is not None:
+            parameters[name] = value
+
+    if parameters['routes'] is not None:
+        parameters['routes'] = [tuple(int(part) for part in route) for route in parameters['routes']]
+
+    return parameters
+
+
+def make_esi(appinfo=None, record=None):
+    """
+    :param appinfo: path of appinfo.csv to log in with its refresh token, None to only use public endpoints
+    :param record: optional archive path, every request and response gets recorded to it by a replay.RecordingClient
+    :return: esi client going through a request scheduler and esi app, the same way main.py makes them
+    """
+    from esipy import EsiApp
+    from esipy import EsiClient
+    from esipy import EsiSecurity
+    from esipy.utils import generate_code_verifier
+
+    import esicache
+    import scheduler
+
+    app_esi = EsiApp().get_latest_swagger
+
+    security = None
+    if appinfo is not None:
+        app_info = pd.read_csv(appinfo, index_col=0)
+
+        security = EsiSecurity(
+            redirect_uri=app_info['key']['redirect_uri'],
+            client_id=app_info['key']['client_id'],
+            code_verifier=generate_code_verifier()
+        )
+        security.update_token({
+            'access_token': '',
+            'expires_in': -1,
+            'refresh_token': app_info['key']['refresh_token']
+        })
+
+    client = EsiClient(retry_requests=True, headers={'User-Agent': "Bisnesspirate's EVEMarket app"},
+                       raw_body_only=True, security=security, cache=esicache.DiskCache())
+
+    if record is not None:
+        import replay
+        client = replay.RecordingClient(client, record)
+
+    # a daemon runs for days, it has to stay under the ESI error limit
+    return scheduler.RequestScheduler(client).view(scheduler.BULK), app_esi
+
+
+def scan(parameters, esi_client, esi_app, order_snapshots=None, history_store=None, type_catalog=None,
+         order_archive=None):
+    """
+    :param parameters: dictionary from load_parameters
+    :param esi_client: ESI client
+    :param esi_app: ESI app
+    :param order_snapshots: dictionary with order snapshots that gets kept between scans
+    :param history_store: optional historydb.HistoryStore
+    :param type_catalog: optional typecatalog.TypeCatalog
+    :param order_archive: optional orderarchive.OrderArchive
+    :return: dataframe with the items worth importing
+    """
+    settings = {name: value for name, value in parameters.items()
+                if name not in ('sell_station', 'sell_region', 'buy_region', 'routes')}
+
+    if parameters['routes']:
+        return calculation.batch_scan(parameters['routes'], esi_client=esi_client, esi_app=esi_app,
+                                      order_snapshots=order_snapshots, history_store=history_store,
+                                      type_catalog=type_catalog, order_archive=order_archive, **settings)
+
+    return calculation.main_program(parameters['sell_station'], parameters['sell_region'], parameters['buy_region'],
+                                    esi_client=esi_client, esi_app=esi_app, order_snapshots=order_snapshots,
+                                    history_store=history_store, type_catalog=type_catalog,
+                                    order_archive=order_archive, **settings)
+
+
+def write_items(items, output, scan_time=None):
+    """
+    writes the items to a temporary file first and then moves it, so whatever reads the output never sees half a file.
+
+    :param items: dataframe from scan
+    :param output: path ending in .csv or .parquet, {time} gets replaced by the scan time
+    :param scan_time: datetime of the scan, defaults to now
+    :return: path the items were written to
+    """
+    if scan_time is None:
+        scan_time = datetime.datetime.now(datetime.timezone.utc)
+
+    path = output.replace('{time}', scan_time.strftime('%Y%m%dT%H%M%SZ'))
+    temporary = path + '.tmp'
+
+    # the rows are named after the items
+    items = items.rename_axis('item')
+
+    if path.endswith('.parquet'):
+        # parquet needs string column names and a named index
+        items.to_parquet(temporary)
+    elif path.endswith('.csv'):
+        items.to_csv(temporary)
+    else:
+        raise ValueError(f'{output} has to end in .csv or .parquet')
+
+    os.replace(temporary, path)
+    return path
+
+
+def order_expiry(esi_client, esi_app, region_id):
+    """
+    :param esi_client: ESI client
+    :param esi_app: ESI app
+    :param region_id: region ID whose orders get scanned
+    :return: timestamp in seconds when ESI has new orders for the region, None if ESI didn't say
+    """
+    try:
+        response = esi_client.head(esi_app.op['get_markets_region_id_orders'](region_id=region_id, page=1))
+    except Exception:  # the next scan will find out if ESI is really down
+        return None
+
+    for key, value in response.header.items():
+        if key.lower() == 'expires':
+            value = value[0] if isinstance(value, list) else value
+            try:
+                return email.utils.parsedate_to_datetime(value).timestamp()
+            except (TypeError, ValueError):
+                return None
+
+    return None
+
+
+def next_scan(last_start, expiry, interval):
+    """
+    :param last_start: timestamp the last scan started
+    :param expiry: timestamp the ESI orders expire or None
+    :param interval: minimum amount of seconds between scans
+    :return: timestamp of the next scan, right after the ESI cache expires but never sooner than interval
+    """
+    earliest = last_start + interval
+
+    if expiry is None:
+        return earliest
+
+    return max(earliest, expiry + EXPIRY_MARGIN)
+
+
+def run(arguments):
+    """
+    :param arguments: parsed arguments from make_parser
+    :return: exit code
+    """
+    import historydb
+    import typecatalog
+
+    parameters = load_parameters(arguments)
+
+    if arguments.replay is not None:
+        import replay
+        esi_client = replay.ReplayClient(arguments.replay, simulate_latency=arguments.replay_speed is not None,
+                                         speed=arguments.replay_speed or 1.0)
+        esi_app = esi_client
+    else:
+        esi_client, esi_app = make_esi(None if arguments.no_auth else arguments.appinfo, arguments.record)
+
+    order_snapshots = dict()
+    if arguments.record is not None or arguments.replay is not None:
+        # a recording has to have every request of the scan in it, so nothing can come out of the stores on disk
+        history_store = historydb.HistoryStore(':memory:')
+        type_catalog = typecatalog.TypeCatalog(':memory:')
+    else:
+        history_store = historydb.HistoryStore(arguments.history_db)
+        type_catalog = typecatalog.TypeCatalog(arguments.type_db)
+
+    order_archive = None
+    if arguments.archive is not None:
+        import orderarchive
+        max_bytes = None if arguments.archive_max_gb is None else int(arguments.archive_max_gb * 1024 ** 3)
+        max_age = None if arguments.archive_max_days is None else arguments.archive_max_days * 24 * 3600
+        order_archive = orderarchive.OrderArchive(arguments.archive, max_bytes=max_bytes, max_age=max_age)
+
+    stop = threading.Event()
+    if arguments.daemon:
+        # systemd stops services with SIGTERM, finish cleanly instead of in the middle of writing a file
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    regions = [route[1] for route in parameters['routes']] if parameters['routes'] else [parameters['sell_region']]
+
+    last_report = metrics.ScanReport()
+    if arguments.metrics_port is not None:
+        metrics.serve_prometheus(arguments.metrics_port, lambda: last_report.prometheus())
+
+    while True:
+        start = time.time()
+        scan_time = datetime.datetime.now(datetime.timezone.utc)
+        report = metrics.ScanReport(profile=arguments.profile is not None, trace_memory=arguments.profile is not None)
+
+        try:
+            with metrics.recording(report, cache=getattr(esi_client, 'cache', None)):
+                items = scan(parameters, esi_client, esi_app, order_snapshots, history_store, type_catalog,
+                             order_archive)
+        except Exception as error:
+            if not arguments.daemon:
+                raise
+            # a daemon keeps going, ESI being down for a bit shouldn't need someone to restart it
+            print(f'{scan_time:%Y-%m-%d %H:%M:%S} scan failed: {error!r}', file=sys.stderr, flush=True)
+        else:
+            path = write_items(items, arguments.output, scan_time)
+            print(f'{scan_time:%Y-%m-%d %H:%M:%S} {len(items)} items written to {path}', flush=True)
+
+        last_report = report
+        if arguments.record is not None:
+            esi_client.scheduler.client.save()
+        if arguments.report is not None:
+            report.to_json(arguments.report.replace('{time}', scan_time.strftime('%Y%m%dT%H%M%SZ')))
+        if report.profile_stats is not None:
+            report.profile_stats.dump_stats(arguments.profile)
+
+        if not arguments.daemon:
+            return 0
+
+        expiries = [order_expiry(esi_client, esi_app, region_id) for region_id in set(regions)]
+        expiries = [expiry for expiry in expiries if expiry is not None]
+        wake_up = next_scan(start, max(expiries) if expiries else None, arguments.interval)
+
+        if stop.wait(max(0.0, wake_up - time.time())):
+            return 0
+
+
+def main(argv=None):
+    arguments = make_parser().parse_args(argv)
+
+    try:
+        return run(arguments)
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == '__main__':
+    sys.exit(main())
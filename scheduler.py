@@ -0,0 +1,313 @@
+import heapq
+import itertools
+import queue
+import threading
+import time
+
+
+# requests someone is waiting on in the GUI go before everything else
+INTERACTIVE = 0
+# big fetches like all the pages of a region or the histories of a scan
+BULK = 1
+
+# ESI statuses that count against the error limit and mean we should slow down
+_SLOW_DOWN = (420, 429, 502, 503, 504)
+
+
+def _header(response, name):
+    """
+    :param response: esipy or fetch engine response, both have the headers as lists
+    :param name: header name
+    :return: the header as an int, None if it isn't there or isn't a number
+    """
+    header = getattr(response, 'header', None) or dict()
+
+    for key, value in header.items():
+        if key.lower() == name.lower():
+            value = value[0] if isinstance(value, list) else value
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+
+    return None
+
+
+def _target(operation):
+    """
+    :param operation: esipy (request, response) tuple or fetch.Operation
+    :return: what the request is for without the page, so a structure that refuses one page is known to refuse them all
+    """
+    if isinstance(operation, tuple) and hasattr(operation[0], '_p'):
+        request = operation[0]
+        return request.path, tuple(sorted(request._p.get('path', dict()).items()))
+
+    if hasattr(operation, 'path'):
+        return operation.name, operation.path
+
+    return repr(operation)
+
+
+class _Batch(object):
+    def __init__(self):
+        self.results = queue.Queue()
+        self.cancelled = False
+
+
+class RequestScheduler(object):
+    """
+    sends all the requests of the market.py fetchers for a client, without getting banned by the ESI error limiter.
+
+    Every response's X-ESI-Error-Limit-Remain gets tracked and when it gets close to running out nothing gets sent
+    anymore until the error window resets. The amount of requests at the same time goes up slowly while responses come
+    back fast and without errors, and gets halved on errors or when ESI gets slow. Structures that refused us
+    (401/403) don't get asked again for a while, every try would cost an error. Interactive requests always go before
+    bulk ones.
+
+    Use view to get something with the same methods as the client that market.py can use.
+    """
+
+    def __init__(self, client, max_concurrency=20, min_concurrency=2, error_margin=20, forbidden_time=3600,
+                 slow_latency=5.0):
+        """
+        :param client: esipy EsiClient or fetch.FetchEngine that does the actual requests
+        :param max_concurrency: most requests at the same time
+        :param min_concurrency: least requests at the same time, also after a lot of errors
+        :param error_margin: stop sending when ESI says this many errors are left in the window
+        :param forbidden_time: seconds a structure that refused us doesn't get asked again
+        :param slow_latency: seconds, responses slower than this make the amount of requests go down
+        """
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.error_margin = error_margin
+        self.forbidden_time = forbidden_time
+        self.slow_latency = slow_latency
+
+        # float so it can grow by less than a request per response
+        self.concurrency = float(max(min_concurrency, max_concurrency // 2))
+        self.error_limit_remain = None
+        self.paused_until = 0.0
+
+        self.requests = 0
+        self.errors = 0
+        self.refused = 0
+        self.pauses = 0
+
+        self._condition = threading.Condition()
+        self._jobs = list()
+        self._order = itertools.count()
+        self._active = 0
+        self._workers = list()
+        # target: (time it can get asked again, the response that refused us, the error the client raised for it)
+        self._forbidden = dict()
+
+    def view(self, priority=BULK):
+        """
+        :param priority: INTERACTIVE or BULK
+        :return: client for market.py that sends everything through this scheduler with that priority
+        """
+        return ScheduledClient(self, priority)
+
+    def head(self, operation, priority=BULK):
+        return self._one('head', operation, priority)
+
+    def request(self, operation, priority=BULK):
+        return self._one('request', operation, priority)
+
+    def multi_request(self, operations, priority=BULK):
+        """
+        :param operations: list of requests
+        :param priority: INTERACTIVE or BULK
+        :return: list of (operation, response) in the same order as the operations, like esipy's multi_request
+        """
+        operations = list(operations)
+        responses = [None] * len(operations)
+
+        for position, response in self.stream_request(operations, priority):
+            responses[position] = response
+
+        return list(zip(operations, responses))
+
+    def stream_request(self, operations, priority=BULK):
+        """
+        :param operations: list of requests
+        :param priority: INTERACTIVE or BULK
+        :return: generator that yields (position of the operation, response) in the order the responses come in
+        """
+        operations = list(operations)
+        batch = _Batch()
+
+        with self._condition:
+            self._start_workers()
+            for position, operation in enumerate(operations):
+                heapq.heappush(self._jobs, (priority, next(self._order), batch, position, 'request', operation))
+            self._condition.notify_all()
+
+        try:
+            for _ in range(len(operations)):
+                position, response, error = batch.results.get()
+
+                if error is not None:
+                    raise error
+
+                yield position, response
+        finally:
+            # requests that didn't start yet don't get sent anymore if nobody wants them
+            batch.cancelled = True
+
+    def stats(self):
+        """
+        :return: dictionary with the current state of the scheduler
+        """
+        with self._condition:
+            return {
+                'concurrency': int(self.concurrency),
+                'active': self._active,
+                'queued': len(self._jobs),
+                'error_limit_remain': self.error_limit_remain,
+                'paused_for': max(0.0, self.paused_until - time.time()),
+                'requests': self.requests,
+                'errors': self.errors,
+                'refused': self.refused,
+                'pauses': self.pauses,
+                'forbidden': len(self._forbidden),
+            }
+
+    def _one(self, method, operation, priority):
+        batch = _Batch()
+
+        with self._condition:
+            self._start_workers()
+            heapq.heappush(self._jobs, (priority, next(self._order), batch, 0, method, operation))
+            self._condition.notify_all()
+
+        _, response, error = batch.results.get()
+
+        if error is not None:
+            raise error
+
+        return response
+
+    def _start_workers(self):
+        # one thread for every request that can run at the same time, most of them just wait for a free slot
+        while len(self._workers) < self.max_concurrency:
+            worker = threading.Thread(target=self._work, daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    wait = self.paused_until - time.time()
+
+                    if self._jobs and self._active < int(self.concurrency) and wait <= 0:
+                        break
+
+                    self._condition.wait(wait if wait > 0 else None)
+
+                _, _, batch, position, method, operation = heapq.heappop(self._jobs)
+
+                if batch.cancelled:
+                    continue
+
+                self._active += 1
+
+            try:
+                response, error = self._send(method, operation), None
+            except Exception as exception:
+                response, error = None, exception
+
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+            batch.results.put((position, response, error))
+
+    def _send(self, method, operation):
+        target = _target(operation)
+
+        with self._condition:
+            refused = self._forbidden.get(target)
+            if refused is not None and refused[0] > time.time():
+                if refused[2] is not None:
+                    raise refused[2]
+                return refused[1]
+
+        start = time.time()
+
+        try:
+            response = getattr(self.client, method)(operation)
+        except Exception as error:
+            # the fetch engine raises on error statuses, the response is on the error
+            self._observe(getattr(error, 'response', None), time.time() - start, target, error)
+            raise
+
+        self._observe(response, time.time() - start, target)
+        return response
+
+    def _observe(self, response, latency, target, error=None):
+        """
+        updates the error limit, the pause and the concurrency with a response, None when the request failed without
+        one. error is what the client raised, if it raised.
+        """
+        now = time.time()
+        status = getattr(response, 'status', None)
+
+        with self._condition:
+            self.requests += 1
+
+            remain = _header(response, 'X-ESI-Error-Limit-Remain')
+            reset = _header(response, 'X-ESI-Error-Limit-Reset')
+
+            if remain is not None:
+                self.error_limit_remain = remain
+
+            if status == 420 or (remain is not None and remain <= self.error_margin):
+                # wait for the error window to reset, ESI says how long that is
+                if self.paused_until <= now:
+                    self.pauses += 1
+                self.paused_until = max(self.paused_until, now + (reset if reset is not None else 60) + 1)
+
+            if status in (401, 403):
+                self._forbidden[target] = (now + self.forbidden_time, response, error)
+                self.refused += 1
+
+            if response is None or status in _SLOW_DOWN:
+                self.errors += 1
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            elif latency > self.slow_latency:
+                self.concurrency = max(self.min_concurrency, self.concurrency * 0.75)
+            else:
+                # one extra request at the same time for every full round of fast responses
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+
+            self._condition.notify_all()
+
+
+class ScheduledClient(object):
+    """
+    client for the market.py fetchers that sends everything through a RequestScheduler with one priority.
+    """
+
+    def __init__(self, scheduler, priority=BULK):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    @property
+    def cache(self):
+        # the response cache of the client, so a scan report can count its hits
+        return getattr(self.scheduler.client, 'cache', None)
+
+    def head(self, operation):
+        return self.scheduler.head(operation, self.priority)
+
+    def request(self, operation):
+        return self.scheduler.request(operation, self.priority)
+
+    def multi_request(self, operations):
+        return self.scheduler.multi_request(operations, self.priority)
+
+    def stream_request(self, operations):
+        return self.scheduler.stream_request(operations, self.priority)
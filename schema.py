@@ -0,0 +1,95 @@
+import pandas as pd
+
+
+# type IDs are always this type, as column and as index, so lookups between frames never have to convert them
+TYPE_ID = 'int32'
+
+# every range an ESI order can have, fixed so all pages end up with the same categories
+RANGES = ['station', 'solarsystem', 'region', '1', '2', '3', '4', '5', '10', '20', '30', '40']
+
+# the order columns we actually use, everything else ESI sends gets dropped when a page gets parsed
+ORDER_SCHEMA = {
+    'order_id': 'int64',
+    'type_id': TYPE_ID,
+    'is_buy_order': 'bool',
+    'price': 'float64',
+    'volume_remain': 'int32',
+    'location_id': 'int64',
+    'issued': 'datetime64[ns, UTC]',
+    'range': pd.CategoricalDtype(RANGES),
+}
+
+# history prices aren't used in any calculation so float32 is plenty, volumes can go past an int32 for minerals
+HISTORY_SCHEMA = {
+    'type_id': TYPE_ID,
+    'date': 'datetime64[ns]',
+    'average': 'float32',
+    'highest': 'float32',
+    'lowest': 'float32',
+    'order_count': 'int64',
+    'volume': 'int64',
+}
+
+
+def apply_schema(frame, schema):
+    """
+    keeps only the columns in the schema and gives them the types from the schema.
+
+    :param frame: dataframe with orders or history
+    :param schema: ORDER_SCHEMA or HISTORY_SCHEMA
+    :return: new dataframe with the columns of the schema that are in the frame
+    """
+    columns = dict()
+
+    for column in schema:
+        if column not in frame.columns:
+            continue
+
+        values = frame[column]
+        dtype = schema[column]
+
+        if str(dtype).startswith('datetime64'):
+            if values.dtype == object:
+                # pyswagger dates and datetimes have the actual value in .v
+                values = pd.Series([getattr(value, 'v', value) for value in values], index=frame.index)
+            values = pd.to_datetime(values, utc='UTC' in str(dtype))
+
+        columns[column] = values.astype(dtype)
+
+    return pd.DataFrame(columns, index=frame.index)
+
+
+def type_id_index(type_ids):
+    """
+    :param type_ids: type IDs as ints or strings
+    :return: index with the type IDs as TYPE_ID
+    """
+    return pd.Index([int(type_id) for type_id in type_ids], dtype=TYPE_ID)
+
+
+def schema_name(schema):
+    """
+    :param schema: ORDER_SCHEMA or HISTORY_SCHEMA
+    :return: 'orders' or 'history', what the frames of the schema are called in a scan report
+    """
+    if schema is ORDER_SCHEMA:
+        return 'orders'
+    if schema is HISTORY_SCHEMA:
+        return 'history'
+
+    return 'frame'
+
+
+def memory_report(frame):
+    """
+    :param frame: any dataframe
+    :return: dataframe with the type and the amount of bytes of every column, the index and the total
+    """
+    usage = frame.memory_usage(index=True, deep=True)
+    dtypes = frame.dtypes.astype(str)
+
+    report = pd.DataFrame({'dtype': [dtypes.get(column, str(frame.index.dtype)) for column in usage.index],
+                           'bytes': usage.to_numpy()}, index=usage.index)
+    report.loc['total'] = ['', usage.sum()]
+
+    return report
@@ -0,0 +1,216 @@
+import hashlib
+import threading
+
+import numpy as np
+import pandas as pd
+
+import market
+import schema
+
+
+def _page_key(response):
+    """
+    something that changes when the content of a page changes, the ETag if ESI sent one or else a hash of the raw body.
+
+    :param response: response of one page of orders
+    :return: key of the page, None if there's nothing to tell if the page changed
+    """
+    header = getattr(response, 'header', None) or dict()
+
+    for name in ('ETag', 'Etag', 'etag'):
+        if name in header:
+            etag = header[name]
+            return etag[0] if isinstance(etag, list) else etag
+
+    raw = getattr(response, 'raw', None)
+    if isinstance(raw, (bytes, bytearray)):
+        return hashlib.sha1(raw).hexdigest()
+
+    return None
+
+
+class OrderDelta(object):
+    """
+    what changed in the orders between two updates of an OrderSnapshot. All frames are indexed by order_id.
+    """
+
+    def __init__(self, inserted, updated, previous, removed):
+        """
+        :param inserted: orders that are new
+        :param updated: new version of the orders that changed
+        :param previous: old version of the orders that changed
+        :param removed: orders that are gone
+        """
+        self.inserted = inserted
+        self.updated = updated
+        self.previous = previous
+        self.removed = removed
+
+    def __len__(self):
+        return len(self.inserted) + len(self.updated) + len(self.removed)
+
+    def changed_types(self):
+        """
+        :return: array with all the type IDs that have an order that changed
+        """
+        type_ids = [frame['type_id'].to_numpy() for frame in (self.inserted, self.updated, self.removed)
+                    if 'type_id' in frame.columns]
+
+        if len(type_ids) == 0:
+            return np.array([], dtype=np.int64)
+
+        return np.unique(np.concatenate(type_ids))
+
+    def volume_change(self):
+        """
+        :return: series with the change in remaining volume, indexed by (type_id, is_buy_order)
+        """
+        columns = ['type_id', 'is_buy_order', 'volume_remain']
+        parts = list()
+
+        for frame, sign in ((self.inserted, 1), (self.updated, 1), (self.previous, -1), (self.removed, -1)):
+            if len(frame) > 0:
+                part = frame[columns].copy()
+                part['volume_remain'] = part['volume_remain'] * sign
+                parts.append(part)
+
+        if len(parts) == 0:
+            return pd.Series(dtype=np.int64)
+
+        return pd.concat(parts).groupby(['type_id', 'is_buy_order'])['volume_remain'].sum()
+
+
+class OrderSnapshot(object):
+    """
+    the orders of a region that get kept between scans. Every update takes all pages again, but only pages that
+    changed get parsed and only the orders that changed get replaced. The order book summary gets updated for just the
+    items that had orders change.
+
+    Scans that run at the same time (like an old scan that didn't reach a checkpoint yet and the one replacing it) can
+    share a snapshot, updates go one at a time.
+    """
+
+    def __init__(self, region_id=None):
+        """
+        :param region_id: region ID the orders are from
+        """
+        self.region_id = region_id
+
+        self.orders = pd.DataFrame()
+        self.summary = None
+        self.last_delta = None
+
+        self.pages_parsed = 0
+        self.pages_skipped = 0
+
+        self._page_keys = dict()
+        self._page_order_ids = dict()
+        self._lock = threading.Lock()
+
+    def update(self, pages):
+        """
+        :param pages: dictionary with the page number as key and the response of that page as value
+        :return: OrderDelta with what changed since the last update
+        """
+        with self._lock:
+            return self._update(pages)
+
+    def _update(self, pages):
+        page_keys = dict()
+        page_order_ids = dict()
+        fresh_pages = list()
+
+        for page in pages:
+            key = _page_key(pages[page])
+            page_keys[page] = key
+
+            if key is not None and self._page_keys.get(page) == key:
+                page_order_ids[page] = self._page_order_ids[page]
+                self.pages_skipped += 1
+                continue
+
+            page_orders = market.response_frame(pages[page], schema.ORDER_SCHEMA)
+            fresh_pages.append(page_orders)
+
+            if len(page_orders) > 0:
+                page_order_ids[page] = page_orders['order_id'].to_numpy()
+            else:
+                page_order_ids[page] = np.array([], dtype=np.int64)
+            self.pages_parsed += 1
+
+        if len(page_order_ids) > 0:
+            current_ids = pd.Index(np.concatenate(list(page_order_ids.values()))).unique()
+        else:
+            current_ids = pd.Index([], dtype=np.int64)
+
+        fresh_pages = [page_orders for page_orders in fresh_pages if len(page_orders) > 0]
+        if len(fresh_pages) > 0:
+            # orders can move between pages while we download them, the last one we see wins
+            fresh_orders = pd.concat(fresh_pages, ignore_index=True)
+            fresh_orders = fresh_orders.drop_duplicates('order_id', keep='last').set_index('order_id')
+        else:
+            fresh_orders = pd.DataFrame(index=pd.Index([], dtype=np.int64, name='order_id'))
+
+        delta = self._apply(current_ids, fresh_orders)
+
+        self._page_keys = page_keys
+        self._page_order_ids = page_order_ids
+
+        return delta
+
+    def frame(self):
+        """
+        :return: dataframe with all the orders in the same layout as request_all_orders_region gives them
+        """
+        with self._lock:
+            return self.orders.reset_index()
+
+    def _apply(self, current_ids, fresh_orders):
+        old_orders = self.orders
+
+        if len(old_orders) == 0:
+            empty = fresh_orders.iloc[:0]
+            delta = OrderDelta(inserted=fresh_orders, updated=empty, previous=empty, removed=empty)
+            self.orders = fresh_orders
+        else:
+            removed = old_orders.loc[old_orders.index.difference(current_ids)]
+
+            is_new = ~fresh_orders.index.isin(old_orders.index)
+            inserted = fresh_orders[is_new]
+            seen = fresh_orders[~is_new]
+
+            previous = old_orders.loc[seen.index, seen.columns]
+            changed = seen.ne(previous).any(axis=1)
+
+            delta = OrderDelta(inserted=inserted, updated=seen[changed], previous=previous[changed], removed=removed)
+
+            unchanged = old_orders.drop(removed.index).drop(delta.updated.index)
+            self.orders = pd.concat([unchanged, delta.updated, inserted])
+
+        self.orders.index.name = 'order_id'
+
+        self._update_summary(delta)
+        self.last_delta = delta
+
+        return delta
+
+    def _update_summary(self, delta):
+        if len(self.orders) == 0:
+            self.summary = None
+            return
+
+        if self.summary is None:
+            self.summary = market.summarize_orders(self.orders)
+            return
+
+        changed_types = delta.changed_types()
+        if len(changed_types) == 0:
+            return
+
+        kept = self.summary[~self.summary.index.get_level_values('type_id').isin(changed_types)]
+        changed_orders = self.orders[self.orders['type_id'].isin(changed_types)]
+
+        if len(changed_orders) > 0:
+            self.summary = pd.concat([kept, market.summarize_orders(changed_orders)])
+        else:
+            self.summary = kept
@@ -0,0 +1,85 @@
+"""
+works out the cheapest ore for a list of minerals at a lot of refine rates and prices at once, without the GUI.
+
+    python sweep.py --minerals minerals.csv --prices prices.csv --refine-rates 0.70:0.90:0.05 --output sweep.csv
+
+The minerals file has a mineral and an amount column like shopping list.csv, minerals that aren't in it come from the
+shopping list. The prices file has a row for every price scenario with the name of the scenario in the first column and
+a column with the price of every ore of the ore list.
+"""
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+import compression
+
+
+def parse_refine_rates(value):
+    """
+    :param value: comma separated rates like 0.7,0.8 or a range like 0.70:0.90:0.05 with the end included
+    :return: list of the refine rates
+    """
+    if ':' in value:
+        start, end, step = (float(part) for part in value.split(':'))
+        amount = int(round((end - start) / step)) + 1
+        return [round(start + step * number, 10) for number in range(amount)]
+
+    return [float(rate) for rate in value.split(',')]
+
+
+def read_prices(path, ore_list):
+    """
+    :param path: csv file with a price scenario per row
+    :param ore_list: file that has all the ore, the prices get put in the same order
+    :return: dataframe with the prices, a column for every ore
+    """
+    prices = pd.read_csv(path, index_col=0)
+    prices.columns = [str(column).strip() for column in prices.columns]
+
+    ore = [str(name).strip() for name in compression.get_reprocessor(ore_list).ore.index]
+    missing = [name for name in ore if name not in prices.columns]
+
+    if missing:
+        raise ValueError(f'{path} has no prices for {", ".join(missing)}')
+
+    return prices[ore]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='cheapest ore to reprocess for many refine rates and prices')
+    parser.add_argument('--minerals', required=True, help='csv file with the minerals you need')
+    parser.add_argument('--prices', required=True, help='csv file with a price scenario per row')
+    parser.add_argument('--refine-rates', default='0.7:0.9:0.05', help='like 0.7,0.8 or 0.70:0.90:0.05')
+    parser.add_argument('--ore-list', default='ore.csv', help='file that has all the ore, like ore.csv')
+    parser.add_argument('--processes', type=int, help='amount of processes, the amount of CPUs by default')
+    parser.add_argument('--time-limit', type=float, help='seconds every solve gets')
+    parser.add_argument('--output', help='csv file for the results, printed if not given')
+    arguments = parser.parse_args(argv)
+
+    minerals = pd.read_csv(arguments.minerals, index_col='mineral')
+    minerals.index = [str(mineral).strip() for mineral in minerals.index]
+    minerals.index.rename('mineral', inplace=True)
+
+    refine_rates = parse_refine_rates(arguments.refine_rates)
+    prices = read_prices(arguments.prices, arguments.ore_list)
+
+    cases = compression.parametric_cases(minerals, refine_rates, prices)
+    results = compression.sweep(cases, arguments.ore_list, processes=arguments.processes,
+                                time_limit=arguments.time_limit)
+
+    # which scenario every case is, parametric_cases goes through the scenarios for every refine rate
+    results.insert(1, 'scenario', np.tile(prices.index.to_numpy(), len(refine_rates)))
+
+    if arguments.output:
+        results.to_csv(arguments.output)
+    else:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None):
+            print(results)
+
+    return 0 if results['success'].all() else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+import schema
+
+
+# the type data main_program uses, everything else ESI sends about a type doesn't get kept
+TYPE_FIELDS = ['name', 'packaged_volume']
+
+
+class TypeCatalog(object):
+    """
+    keeps the names and volumes of every type that was ever looked up in sqlite and in memory. Type data only changes
+    with game patches, so after the first scan the item data doesn't have to be downloaded anymore. Call clear after a
+    patch that changed names or volumes.
+    """
+
+    def __init__(self, path='types.sqlite'):
+        """
+        :param path: file the types get saved in
+        """
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        # complete is 0 for types of which only the name is known, those came from the names endpoint
+        self._connection.execute('CREATE TABLE IF NOT EXISTS types '
+                                 '(type_id INTEGER PRIMARY KEY, name TEXT, packaged_volume REAL, complete INTEGER)')
+        self._connection.commit()
+
+        # type_id: (name, packaged_volume, complete), every lookup after this is a dictionary lookup
+        self._types = {type_id: (name, packaged_volume, bool(complete)) for type_id, name, packaged_volume, complete
+                       in self._connection.execute('SELECT type_id, name, packaged_volume, complete FROM types')}
+
+    def __len__(self):
+        return len(self._types)
+
+    def __contains__(self, type_id):
+        return int(type_id) in self._types
+
+    def missing_names(self, items):
+        """
+        :param items: item IDs
+        :return: list of the item IDs without a name in the catalog
+        """
+        return [type_id for type_id in dict.fromkeys(int(item) for item in items) if type_id not in self._types]
+
+    def missing_details(self, items):
+        """
+        :param items: item IDs
+        :return: list of the item IDs of which the catalog doesn't have everything in TYPE_FIELDS
+        """
+        types = self._types
+        return [type_id for type_id in dict.fromkeys(int(item) for item in items)
+                if type_id not in types or not types[type_id][2]]
+
+    def save_names(self, names):
+        """
+        :param names: dictionary with type_id: name, like the names endpoint gives them
+        """
+        rows = list()
+
+        with self._lock:
+            for type_id, name in names.items():
+                type_id = int(type_id)
+                # a type that's already complete keeps its volume
+                _, packaged_volume, complete = self._types.get(type_id, (None, None, False))
+                self._types[type_id] = (name, packaged_volume, complete)
+                rows.append((type_id, name, packaged_volume, int(complete)))
+
+            self._connection.executemany('REPLACE INTO types VALUES (?, ?, ?, ?)', rows)
+            self._connection.commit()
+
+    def save_types(self, types):
+        """
+        :param types: dataframe indexed by type ID with at least the name, packaged_volume can be missing for types ESI
+        doesn't give a volume
+        """
+        packaged_volumes = types['packaged_volume'] if 'packaged_volume' in types.columns else None
+        rows = list()
+
+        with self._lock:
+            for position, (type_id, name) in enumerate(zip(types.index, types['name'])):
+                packaged_volume = None
+                if packaged_volumes is not None and pd.notna(packaged_volumes.iloc[position]):
+                    packaged_volume = float(packaged_volumes.iloc[position])
+
+                self._types[int(type_id)] = (name, packaged_volume, True)
+                rows.append((int(type_id), name, packaged_volume, 1))
+
+            self._connection.executemany('REPLACE INTO types VALUES (?, ?, ?, ?)', rows)
+            self._connection.commit()
+
+    def frame(self, items):
+        """
+        :param items: item IDs that are in the catalog
+        :return: dataframe with the TYPE_FIELDS of the items in the same order, indexed by type_id
+        """
+        type_ids = [int(item) for item in items]
+        types = self._types
+
+        try:
+            rows = [types[type_id] for type_id in type_ids]
+        except KeyError as error:
+            raise KeyError(f'type {error.args[0]} is not in the catalog')
+
+        return pd.DataFrame({'name': [row[0] for row in rows],
+                             'packaged_volume': np.array([row[1] for row in rows], dtype='float64')},
+                            index=pd.Index(type_ids, dtype=schema.TYPE_ID, name='type_id'))
+
+    def clear(self):
+        """
+        forgets all the types, for after a game patch
+        """
+        with self._lock:
+            self._types.clear()
+            self._connection.execute('DELETE FROM types')
+            self._connection.commit()